@@ -1,95 +1,499 @@
+import atexit
+import hashlib
 import json
+import mimetypes
 import os
 import requests
 import re
-from flask import Flask, render_template, request, jsonify, redirect, url_for, Response
-from bs4 import BeautifulSoup
+import threading
+import time
+from collections import namedtuple
+from functools import lru_cache
+from html import escape
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+from concurrent.futures import TimeoutError as FuturesTimeout
+from flask import Flask, g, render_template, request, jsonify, redirect, url_for, Response
+from jinja2.utils import htmlsafe_json_dumps
+from markupsafe import Markup
+from requests.structures import CaseInsensitiveDict
+from urllib.parse import quote
+from werkzeug.utils import safe_join
+
+from breaker import BreakerRegistry
+from cache import ResponseCache, SingleFlight
+from card_actions import ActionLog
+from compression import ResponseCompressor
+from config_store import ConfigStore
+from events import EventBroker, fingerprint
+from html_pipeline import DeferExternalScripts, HtmlPipeline, NeutraliseDocumentWrite, RewriteUrls, UrlRewriter
+from http_client import BodyTooLarge, HttpClient, content_length, read_body
+import json_tree
+from metrics import SIZE_BUCKETS, Metrics
+from ratelimit import LimiterRegistry, RateLimited
+from scheduler import PollScheduler, SnapshotStore, SqliteSnapshotStore
+from service_import import MAX_BATCH_SERVICES, InvalidImport, import_format, parse_services
+from upstream import UpstreamPolicy
 
 app = Flask(__name__)
 
-CONFIG_FILE = 'config.json'
+# Path of the config file, the CONFIG_FILE environment variable overrides it
+CONFIG_FILE = os.environ.get('CONFIG_FILE', 'config.json')
+
+# Parsed configuration, reloaded only when the file changes on disk
+config_store = ConfigStore(CONFIG_FILE)
+
+# Counters and timings served at /metrics. Set PORTAL_METRICS=0 to switch
+# them off, recording then costs next to nothing.
+METRICS_ENABLED = os.environ.get('PORTAL_METRICS', '1') != '0'
+
+# Set SERVER_TIMING=1 to report the timed phases of every response in a
+# Server-Timing header, where browser developer tools show them
+SERVER_TIMING = os.environ.get('SERVER_TIMING') == '1'
 
-# URL mappings for form submissions and links
-# This maps external URLs to internal Docker network URLs
+metrics = Metrics(enabled=METRICS_ENABLED)
+metrics.counter('portal_requests_total', 'Requests served, by route, method and status')
+metrics.histogram('portal_request_seconds', 'Time to produce a response, by route')
+metrics.histogram('portal_response_bytes', 'Response body size, by route', buckets=SIZE_BUCKETS)
+metrics.histogram('portal_phase_seconds', 'Time spent in each phase of the work, by phase and service')
+metrics.histogram('portal_upstream_body_bytes', 'Upstream response body size, by service', buckets=SIZE_BUCKETS)
+metrics.counter('portal_upstream_errors_total', 'Failed upstream requests, by service and reason')
+metrics.counter('portal_upstream_throttled_total', 'Upstream requests held back by a rate limit, by service and outcome')
+
+# URL mappings for form submissions, links and other URLs in iframe content.
+# This maps external URLs to internal Docker network URLs. A top-level
+# "url_mappings" object in config.json replaces these defaults.
 URL_MAPPINGS = {
     "http://4.223.117.60:5100": "http://172.17.0.4:8080",
     # Add more mappings as needed
 }
 
+# HTML rewriting backend, "soup" (BeautifulSoup) or "stream" (token rewriter).
+# Can be overridden per service with an "html_backend" key in config.json.
+DEFAULT_HTML_BACKEND = 'soup'
+
+# Default timeout in seconds for a single upstream request.
+# Can be overridden per service with a "timeout" key in config.json.
+DEFAULT_SERVICE_TIMEOUT = 5
+
+# Seconds allowed to open a connection to an upstream
+HTTP_CONNECT_TIMEOUT = 3
+
+# Keep-alive connections kept open per upstream host, and requests allowed in
+# flight per host. Both can be overridden per host with a top-level
+# "upstream_hosts" key in config.json, e.g.
+# {"upstream_hosts": {"localhost:8080": {"pool_size": 4, "max_concurrency": 4}}}
+HTTP_POOL_SIZE = 10
+HTTP_MAX_PER_HOST = 10
+
+# Largest upstream body read into memory, in bytes. Services in "proxy" mode
+# stream their body instead and default to the larger PROXY_MAX_BODY_BYTES.
+# Both can be overridden per service with a "max_body_bytes" key in config.json.
+DEFAULT_MAX_BODY_BYTES = 10 * 1024 * 1024
+PROXY_MAX_BODY_BYTES = 200 * 1024 * 1024
+
+# Size of the chunks streamed to the client in proxy mode
+PROXY_CHUNK_SIZE = 64 * 1024
+
+# Upstream headers passed on to the client in proxy mode
+PROXY_HEADERS = (
+    'Content-Type', 'Content-Length', 'Content-Encoding',
+    'Cache-Control', 'ETag', 'Last-Modified', 'Expires'
+)
+
+# Default time budget in seconds for fetching all services on the dashboard.
+# Can be overridden with a top-level "dashboard_deadline" key in config.json.
+DEFAULT_DASHBOARD_DEADLINE = 3
+
+# Where the dashboard template receives the status updates streamed after its shell
+STATUS_UPDATES_MARKER = '<!-- status updates -->'
+
+# Maximum number of upstream fetches running at the same time
+FETCH_MAX_WORKERS = 16
+
+# Connection tests running at the same time for one /test-connections batch.
+# Kept below HTTP_MAX_PER_HOST so a batch of URLs on one host never waits for a slot.
+CONNECTION_TEST_CONCURRENCY = 8
+
+# Shared pool for concurrent upstream fetches. It lives for the whole process so
+# that a render never has to wait for slow fetches to finish when it returns.
+_fetch_executor = ThreadPoolExecutor(max_workers=FETCH_MAX_WORKERS, thread_name_prefix='fetch')
+
+# Separate pool for batch connection tests, so they can't hold up dashboard fetches
+_connection_test_executor = ThreadPoolExecutor(
+    max_workers=CONNECTION_TEST_CONCURRENCY, thread_name_prefix='connection-test'
+)
+
+def _upstream_host_settings(netloc):
+    """Return pool overrides for an upstream host from the config file."""
+    return load_config().get('upstream_hosts', {}).get(netloc, {})
+
+# Pooled client used for every request to an upstream service
+http_client = HttpClient(
+    pool_size=HTTP_POOL_SIZE,
+    max_per_host=HTTP_MAX_PER_HOST,
+    connect_timeout=HTTP_CONNECT_TIMEOUT,
+    read_timeout=DEFAULT_SERVICE_TIMEOUT,
+    host_settings=_upstream_host_settings
+)
+
+# Consecutive failures after which a service's circuit opens and it is no longer
+# contacted, and seconds before a single trial request checks whether it recovered.
+# Can be overridden per service with "failure_threshold" and "circuit_reset" keys
+# in config.json. Repeated failed trials double the wait up to CIRCUIT_MAX_RESET.
+CIRCUIT_FAILURE_THRESHOLD = 3
+CIRCUIT_RESET_TIMEOUT = 30
+CIRCUIT_MAX_RESET = 300
+
+# Health state of every upstream, keyed by service URL
+circuit_breakers = BreakerRegistry(
+    failure_threshold=CIRCUIT_FAILURE_THRESHOLD,
+    reset_timeout=CIRCUIT_RESET_TIMEOUT,
+    max_reset_timeout=CIRCUIT_MAX_RESET
+)
+
+# Seconds a request to a rate limited service may wait for its turn before the
+# last good response is served instead. Services are only limited when they set
+# "rate_limit" (requests per second, with "rate_burst" back to back) and/or
+# "max_concurrent" in config.json, the wait can be changed with "rate_limit_wait".
+RATE_LIMIT_WAIT = 1
+
+# Request admission of every upstream, keyed by service URL
+rate_limiters = LimiterRegistry(max_wait=RATE_LIMIT_WAIT)
+
+# Seconds a probed service status is reused before the upstream is probed again
+STATUS_CACHE_TTL = 10
+
+# Probed statuses keyed by service URL: url -> (probed_at, result)
+_status_cache = {}
+_status_cache_lock = threading.Lock()
+
+# Default seconds an upstream response is served from the cache.
+# Can be overridden per service with a "cache_ttl" key in config.json (0 disables caching).
+DEFAULT_CACHE_TTL = 30
+
+# Seconds an expired response may still be served while it is refreshed in the background
+CACHE_STALE_TTL = 300
+
+# Upper bound for the total size of cached upstream bodies
+CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# Raw upstream response as stored in the cache
+UpstreamResponse = namedtuple('UpstreamResponse', ['status_code', 'headers', 'content', 'encoding'])
+
+# Shared upstream response cache, keyed by service URL. Only successful responses are kept.
+response_cache = ResponseCache(
+    max_bytes=CACHE_MAX_BYTES,
+    stale_ttl=CACHE_STALE_TTL,
+    sizeof=lambda upstream: len(upstream.content),
+    cacheable=lambda upstream: upstream.status_code == 200
+)
+
+# Concurrent requests for the same upstream share one in-flight call
+upstream_calls = SingleFlight()
+
+# Rate limiting, circuit breaking and caching of upstream requests, shared with asgi.py
+upstream_policy = UpstreamPolicy(
+    circuit_breakers, rate_limiters, response_cache, metrics,
+    failure_threshold=CIRCUIT_FAILURE_THRESHOLD,
+    reset_timeout=CIRCUIT_RESET_TIMEOUT,
+    rate_limit_wait=RATE_LIMIT_WAIT,
+    cache_ttl=DEFAULT_CACHE_TTL
+)
+
+# Last processed result of every service with the response it was built from.
+# It is reused as long as the upstream response is unchanged, e.g. on a cache
+# hit or after a 304 Not Modified: service name -> (response, settings, result)
+_processed_results = {}
+_processed_results_lock = threading.Lock()
+
+# Part of every /iframe ETag. Bump it when render_iframe() output changes so
+# browsers don't keep pages rendered by an older version.
+IFRAME_RENDER_VERSION = 2
+
+# Seconds browsers may keep a versioned asset from /assets without asking again.
+# The URL changes with the file content, so this can be as long as allowed.
+ASSET_MAX_AGE = 365 * 24 * 3600
+
+# Rendered iframe page as stored in the render cache. encoded maps content
+# encodings to precompressed copies of body, empty for pages too small to be worth it.
+RenderedPage = namedtuple('RenderedPage', ['body', 'mimetype', 'encoded'])
+
+# Upper bound for the total size of rendered iframe pages kept in memory
+RENDER_CACHE_MAX_BYTES = 32 * 1024 * 1024
+
+# Seconds a rendered page is kept. Pages are keyed by their ETag, which changes
+# with the data, service config and URL mappings, so they never go stale.
+RENDER_CACHE_TTL = 3600
+
+# Text responses at least this large are sent gzip or brotli compressed
+COMPRESS_MIN_BYTES = 1024
+
+# Upper bound for the compressed bodies kept for reuse, in bytes
+COMPRESS_CACHE_BYTES = 16 * 1024 * 1024
+
+# Compresses responses, compressing every distinct body only once per encoding
+compressor = ResponseCompressor(min_bytes=COMPRESS_MIN_BYTES, cache_bytes=COMPRESS_CACHE_BYTES)
+
+# Rendered iframe pages keyed by ETag, served without parsing or templating
+rendered_pages = ResponseCache(
+    max_bytes=RENDER_CACHE_MAX_BYTES,
+    sizeof=lambda page: len(page.body) + sum(len(body) for body in page.encoded.values())
+)
+
+# Default seconds between background polls of a service.
+# Can be overridden per service with a "poll_interval" key in config.json (0 disables polling).
+DEFAULT_POLL_INTERVAL = 30
+
+# Maximum number of background polls running at the same time
+POLL_MAX_CONCURRENT = 4
+
+# Longest delay in seconds between polls of a service that keeps failing
+POLL_MAX_BACKOFF = 300
+
+# Snapshots older than this many seconds are not served, the upstream is asked instead.
+# A service's snapshot is also only served for two of its poll intervals, and not
+# at all when it isn't polled, so its cache_ttl decides how fresh the data is.
+SNAPSHOT_MAX_AGE = 600
+
+# SQLite database holding the snapshots, shared by all worker processes and kept
+# across restarts. Set the SNAPSHOT_DB environment variable to move it, or to an
+# empty string to keep snapshots in memory only.
+SNAPSHOT_DB = os.environ.get('SNAPSHOT_DB', os.path.join(os.path.dirname(os.path.abspath(CONFIG_FILE)), 'snapshots.db'))
+
+# File the "log" card actions are appended to, standard output when unset
+CARD_ACTION_LOG = os.environ.get('CARD_ACTION_LOG') or None
+
+# Log lines waiting for the background writer before new ones are dropped, and
+# the most lines written at once
+CARD_ACTION_QUEUE_SIZE = 10000
+CARD_ACTION_BATCH_SIZE = 500
+
+# Most actions accepted in one /card-actions request
+CARD_ACTIONS_MAX_BATCH = 100
+
+# Seconds between keep-alive comments on an idle /events stream
+EVENTS_KEEPALIVE = 15
+
+# Seconds a long-poll request to /events/poll waits for a change
+EVENTS_LONG_POLL_TIMEOUT = 25
+
+# Largest JSON data pushed to dashboards with a change event, in bytes
+EVENTS_MAX_DATA_BYTES = 64 * 1024
+
 def load_config():
-    """Load configuration from the config file."""
-    if os.path.exists(CONFIG_FILE):
-        with open(CONFIG_FILE, 'r') as f:
-            return json.load(f)
-    return {"services": []}
-
-def save_config(config):
-    """Save configuration to the config file."""
-    with open(CONFIG_FILE, 'w') as f:
-        json.dump(config, f, indent=2)
-
-def process_html_content(html_content):
+    """Load configuration from the config file.
+    
+    The returned dict is shared between requests, use config_store.update()
+    to change it.
+    """
+    with metrics.phase('config_load'):
+        return config_store.get()
+
+@lru_cache(maxsize=8)
+def _compile_url_rewriter(mappings):
+    """Compile URL mappings, given as a tuple of pairs, into a rewrite index."""
+    return UrlRewriter(dict(mappings))
+
+def get_url_rewriter():
+    """Return the compiled rewriter for the configured URL mappings."""
+    mappings = load_config().get('url_mappings', URL_MAPPINGS)
+    return _compile_url_rewriter(tuple(mappings.items()))
+
+def process_html_content(html_content, backend=DEFAULT_HTML_BACKEND, timer=None):
     """Process HTML content to ensure proper rendering in iframes.
     
-    This function handles parsing and preprocessing of HTML content
-    to ensure scripts and styles are properly isolated.
+    Scripts are deferred, document.write calls are neutralised and external
+    URLs are mapped to internal ones, all in a single pass over the document.
+    
+    Args:
+        timer (callable): Times the parse and rewrite phases, see HtmlPipeline
     """
     try:
-        # Try using BeautifulSoup to parse and clean the HTML
-        soup = BeautifulSoup(html_content, 'html.parser')
-        
-        # Process script tags to ensure they execute properly in iframe
-        for script in soup.find_all('script'):
-            # Add defer attribute to external scripts to ensure they load properly
-            if script.get('src'):
-                script['defer'] = 'defer'
-            
-            # Remove any document.write calls which can break iframe rendering
-            if script.string:
-                script.string = script.string.replace('document.write', '// document.write')
-        
-        return str(soup)
+        pipeline = HtmlPipeline([
+            DeferExternalScripts(),
+            NeutraliseDocumentWrite(),
+            RewriteUrls(get_url_rewriter())
+        ], backend=backend, timer=timer)
+        return pipeline.run(html_content)
     except Exception as e:
         # If parsing fails, return original content
         print(f"Error processing HTML content: {e}")
         return html_content
 
-def fetch_data_from_service(service):
-    """Fetch data from an external service."""
+def rewrite_html_urls(html_content, backend=DEFAULT_HTML_BACKEND):
+    """Map external URLs in HTML-looking content to internal ones."""
     try:
-        response = requests.get(service['url'], timeout=5)
-        if response.status_code == 200:
-            content_type = response.headers.get('content-type', '').lower()
-            
-            # Get the base URL of the service for proper link resolution
-            service_base_url = '/'.join(service['url'].split('/')[:3])  # Extract http(s)://domain.com
-            service_path = '/'.join(service['url'].split('/')[3:])  # Extract the path
-            
-            # Determine the data format based on content type
-            if 'application/json' in content_type:
-                data = response.json()
-            elif 'text/html' in content_type:
-                data = response.text
-                # Process HTML content
-                data = process_html_content(data)
-            else:
-                data = response.text
-                
-            return {
-                'name': service['name'],
-                'url': service['url'],
-                'status': 'Connected',
-                'data': data,
-                'base_url': service_base_url
-            }
+        return HtmlPipeline([RewriteUrls(get_url_rewriter())], backend=backend).run(html_content)
+    except Exception as e:
+        print(f"Error rewriting URLs: {e}")
+        # Fall back to unmodified content
+        return html_content
+
+def max_body_bytes(service):
+    """Return the largest upstream body allowed for a service."""
+    default = PROXY_MAX_BODY_BYTES if service.get('mode') == 'proxy' else DEFAULT_MAX_BODY_BYTES
+    return service.get('max_body_bytes', default)
+
+def to_upstream_response(response, max_bytes):
+    """Read a streamed requests response into an UpstreamResponse."""
+    with response:
+        content = read_body(response, max_bytes)
+        return UpstreamResponse(
+            status_code=response.status_code,
+            headers=CaseInsensitiveDict(response.headers),
+            content=content,
+            encoding=response.encoding
+        )
+
+def call_upstream(service, call, status_code=lambda result: result.status_code):
+    """Run a request to a service through its rate limiter and circuit breaker.
+    
+    Args:
+        service (dict): Service configuration
+        call (callable): Sends the request and returns its result
+        status_code (callable): Returns the HTTP status of the result
+    
+    Raises:
+        RateLimited: The service is over its rate limit and was not contacted
+        CircuitOpen: The service is failing and was not contacted
+    """
+    with upstream_policy.admission(service), upstream_policy.attempt(service) as attempt:
+        return attempt.finished(call(), status_code)
+
+def request_upstream(service, previous=None):
+    """Send a GET request to a service and return the raw UpstreamResponse.
+    
+    Args:
+        service (dict): Service configuration
+        previous (UpstreamResponse): Earlier response whose validators are sent
+            along. It is returned as is when the upstream answers 304.
+    """
+    timeout = service.get('timeout', DEFAULT_SERVICE_TIMEOUT)
+    
+    def call():
+        # requests has no hook for the connection setup, so it counts towards the TTFB
+        with metrics.phase('upstream_ttfb', service=service['name']):
+            response = http_client.get(
+                service['url'], read_timeout=timeout, stream=True, headers=upstream_policy.conditional_headers(previous)
+            )
+        if upstream_policy.not_modified(previous, response.status_code):
+            response.close()
+            return previous
+        with metrics.phase('upstream_download', service=service['name']):
+            upstream = to_upstream_response(response, max_body_bytes(service))
+        metrics.observe('portal_upstream_body_bytes', len(upstream.content), service=service['name'])
+        return upstream
+    
+    return call_upstream(service, call)
+
+def fetch_upstream(service, force=False):
+    """Return the upstream response for a service, served from the cache when possible.
+    
+    Args:
+        service (dict): Service configuration
+        force (bool): Bypass the cache and always contact the upstream
+    """
+    timeout = service.get('timeout', DEFAULT_SERVICE_TIMEOUT)
+    
+    response, refresh = upstream_policy.cached_response(service, force=force)
+    if response is not None:
+        if refresh:
+            threading.Thread(
+                target=_refresh_upstream, args=(service,), daemon=True, name=f"cache-refresh-{service['url']}"
+            ).start()
+        return response
+    
+    # Revalidate the last response, even an expired one, so an unchanged
+    # upstream only has to answer 304
+    previous = upstream_policy.previous_response(service)
+    try:
+        # Callers joining an in-flight request wait at most one timeout for it
+        response = upstream_calls.do(service['url'], lambda: request_upstream(service, previous), timeout=timeout)
+    except RateLimited:
+        return upstream_policy.last_good_response(service)
+    upstream_policy.store_response(service, response)
+    return response
+
+def _refresh_upstream(service):
+    """Replace a stale cache entry in the background, keeping it on failure."""
+    error = None
+    try:
+        previous = upstream_policy.previous_response(service)
+        response = upstream_calls.do(service['url'], lambda: request_upstream(service, previous))
+        upstream_policy.store_response(service, response)
+    except Exception as e:
+        error = e
+    finally:
+        upstream_policy.refresh_done(service, error)
+
+def build_service_result(service, response):
+    """Turn an UpstreamResponse into the service data shown on the dashboard."""
+    if response.status_code == 200:
+        content_type = response.headers.get('content-type', '').lower()
+        
+        # Get the base URL of the service for proper link resolution
+        service_base_url = '/'.join(service['url'].split('/')[:3])  # Extract http(s)://domain.com
+        service_path = '/'.join(service['url'].split('/')[3:])  # Extract the path
+        
+        # Determine the data format based on content type
+        if 'application/json' in content_type:
+            try:
+                with metrics.phase('json_parse', service=service['name']):
+                    data = json.loads(response.content)
+            except ValueError as e:
+                # Only this service's card shows the error, the rest of the page renders as usual
+                metrics.inc('portal_upstream_errors_total', service=service['name'], reason='invalid_json')
+                return {
+                    'name': service['name'],
+                    'url': service['url'],
+                    'status': f'Error: Invalid JSON from service: {e}',
+                    'data': None
+                }
+        elif 'text/html' in content_type:
+            data = response.content.decode(response.encoding or 'utf-8', errors='replace')
+            # Process HTML content
+            data = process_html_content(
+                data, backend=service.get('html_backend', DEFAULT_HTML_BACKEND), timer=metrics.timer(service=service['name'])
+            )
         else:
-            return {
-                'name': service['name'],
-                'url': service['url'],
-                'status': f'Error: HTTP {response.status_code}',
-                'data': None
-            }
-    except requests.exceptions.RequestException as e:
+            data = response.content.decode(response.encoding or 'utf-8', errors='replace')
+            
+        return {
+            'name': service['name'],
+            'url': service['url'],
+            'status': 'Connected',
+            'data': data,
+            'data_hash': fingerprint(data),
+            'content_type': content_type,
+            'base_url': service_base_url
+        }
+    else:
+        return {
+            'name': service['name'],
+            'url': service['url'],
+            'status': f'Error: HTTP {response.status_code}',
+            'data': None
+        }
+
+def processed_service_result(service, response):
+    """Return build_service_result(), reusing the last result for an unchanged response."""
+    settings = (service['url'], service.get('html_backend', DEFAULT_HTML_BACKEND), get_url_rewriter())
+    with _processed_results_lock:
+        processed = _processed_results.get(service['name'])
+    if processed and processed[0] is response and processed[1] == settings:
+        return processed[2]
+    
+    result = build_service_result(service, response)
+    with _processed_results_lock:
+        _processed_results[service['name']] = (response, settings, result)
+    return result
+
+def fetch_data_from_service(service, force=False):
+    """Fetch data from an external service."""
+    try:
+        response = fetch_upstream(service, force=force)
+        return processed_service_result(service, response)
+    except (requests.exceptions.RequestException, TimeoutError) as e:
         return {
             'name': service['name'],
             'url': service['url'],
@@ -97,38 +501,345 @@ def fetch_data_from_service(service):
             'data': None
         }
 
-def fetch_service_data(services):
+def _probe_status_code(url, timeout):
+    """Return the HTTP status of a URL from the response headers only."""
+    response = http_client.head(url, read_timeout=timeout, allow_redirects=True)
+    if response.status_code in (405, 501):
+        # HEAD not supported, read the status line only
+        response = http_client.get(url, read_timeout=timeout, stream=True)
+        response.close()
+    return response.status_code
+
+def probe_status(status_code):
+    """Return the dashboard status for a probed HTTP status."""
+    if status_code == 200:
+        return 'Connected'
+    return f'Error: HTTP {status_code}'
+
+def cached_probe_result(service, max_age=STATUS_CACHE_TTL):
+    """Return the probed status of a service if it is recent enough, or None.
+    
+    Args:
+        service (dict): Service configuration
+        max_age (float): Oldest result accepted in seconds, None for any age
+    """
+    with _status_cache_lock:
+        cached = _status_cache.get(service['url'])
+    if cached and (max_age is None or time.monotonic() - cached[0] < max_age):
+        return dict(cached[1], name=service['name'])
+    return None
+
+def store_probe_result(service, status):
+    """Cache and return the probed status of a service."""
+    result = {
+        'name': service['name'],
+        'url': service['url'],
+        'status': status,
+        'data': None
+    }
+    with _status_cache_lock:
+        _status_cache[service['url']] = (time.monotonic(), result)
+    return result
+
+def probe_service(service):
+    """Check whether a service is reachable without downloading its body.
+    
+    A HEAD request is sent first. Upstreams that don't allow HEAD get a
+    streamed GET that is closed as soon as the headers have arrived. The
+    result is cached for STATUS_CACHE_TTL seconds.
+    """
+    cached = cached_probe_result(service)
+    if cached:
+        return cached
+    
+    timeout = service.get('timeout', DEFAULT_SERVICE_TIMEOUT)
+    
+    def probe():
+        return call_upstream(service, lambda: _probe_status_code(service['url'], timeout), status_code=lambda code: code)
+    
+    try:
+        status = probe_status(upstream_calls.do(('probe', service['url']), probe, timeout=timeout))
+    except RateLimited as e:
+        # Keep showing the last probed status rather than an error
+        return cached_probe_result(service, max_age=None) or store_probe_result(service, f'Error: {str(e)}')
+    except (requests.exceptions.RequestException, TimeoutError) as e:
+        status = f'Error: {str(e)}'
+    
+    return store_probe_result(service, status)
+
+# Status and data changes pushed to dashboards through /events. JSON data up
+# to EVENTS_MAX_DATA_BYTES is sent along, larger documents are loaded by the
+# viewer page by page instead.
+event_broker = EventBroker(max_data_bytes=EVENTS_MAX_DATA_BYTES)
+
+# Log of the card actions, written in bulk in the background. Whatever is still
+# queued when the process exits is written before it does.
+action_log = ActionLog(path=CARD_ACTION_LOG, max_queued=CARD_ACTION_QUEUE_SIZE, batch_size=CARD_ACTION_BATCH_SIZE)
+atexit.register(action_log.close)
+
+# Latest result of every service, kept warm by the background scheduler.
+# Every stored result, and every newer one stored by another worker, is
+# checked for changes to push to the dashboards.
+if SNAPSHOT_DB:
+    snapshot_store = SqliteSnapshotStore(SNAPSHOT_DB, on_put=event_broker.publish)
+else:
+    snapshot_store = SnapshotStore(on_put=event_broker.publish)
+
+scheduler = PollScheduler(
+    services=lambda: config_store.services(),
+    poll=lambda service: fetch_data_from_service(service, force=True),
+    store=snapshot_store,
+    default_interval=DEFAULT_POLL_INTERVAL,
+    max_concurrent=POLL_MAX_CONCURRENT,
+    max_backoff=POLL_MAX_BACKOFF
+)
+
+def start_background_tasks():
+    """Start polling services in the background."""
+    scheduler.start()
+
+def snapshot_max_age(service):
+    """Return the oldest snapshot of a service that may be served in seconds, or None for none.
+    
+    Snapshots are only kept fresh by the background poll, so they are skipped
+    for services that aren't polled and while the scheduler isn't running.
+    """
+    interval = scheduler.interval(service)
+    if not interval or not scheduler.running:
+        return None
+    return min(SNAPSHOT_MAX_AGE, 2 * interval)
+
+def latest_snapshot(service):
+    """Return the result of the last recent fetch of a service, or None."""
+    max_age = snapshot_max_age(service)
+    if max_age is None:
+        return None
+    snapshot = snapshot_store.get(service['name'], url=service['url'], max_age=max_age)
+    return snapshot['result'] if snapshot else None
+
+def latest_service_data(service, force=False):
+    """Return the latest data of a service, from its snapshot when there is one.
+    
+    Only services without a recent snapshot, or a forced refresh, wait for
+    the upstream. The fetched result becomes the new snapshot.
+    """
+    if not force:
+        result = latest_snapshot(service)
+        if result:
+            return result
+    
+    service_data = fetch_data_from_service(service, force=force)
+    snapshot_store.put(service['name'], service_data)
+    return service_data
+
+def split_by_snapshot(services):
+    """Return snapshot results by service name, and the services without one."""
+    results = {}
+    unknown = []
+    for service in services:
+        result = latest_snapshot(service)
+        if result:
+            results[service['name']] = result
+        else:
+            unknown.append(service)
+    return results, unknown
+
+def dashboard_statuses(services, deadline=None):
+    """Return the status of every service for the dashboard.
+    
+    Services with a snapshot are answered from memory, the rest are probed
+    concurrently within the deadline.
+    """
+    results, unknown = split_by_snapshot(services)
+    for result in fetch_service_data(unknown, deadline=deadline, fetch=probe_service):
+        results[result['name']] = result
+    
+    return [results[service['name']] for service in services]
+
+def pending_service_result(service):
+    """Build the result for a service whose fetch has not finished yet."""
+    return {
+        'name': service['name'],
+        'url': service['url'],
+        'status': 'Pending',
+        'data': None
+    }
+
+def fetch_service_data(services, deadline=None, fetch=None):
     """Fetch data from multiple services in parallel.
     
     Args:
         services (list): List of service configurations
+        deadline (float): Seconds to wait for all services. Services that are
+            still running when it expires are reported as pending.
+        fetch (callable): Function used for each service. Defaults to a full
+            fetch_data_from_service; pass probe_service for status only.
         
     Returns:
         list: List of service data with connection status
     """
     if not services:
         return []
-        
-    # Fetch data from each service
+    
+    fetch = fetch or fetch_data_from_service
+    
+    # Start every fetch at once on the shared pool
+    futures = [_fetch_executor.submit(fetch, service) for service in services]
+    wait(futures, timeout=deadline)
+    
     service_data = []
-    for service in services:
-        service_data.append(fetch_data_from_service(service))
+    for service, future in zip(services, futures):
+        if not future.done():
+            # Leave the fetch running in the background, but don't wait for it
+            service_data.append(pending_service_result(service))
+            continue
+        
+        error = future.exception()
+        if error:
+            service_data.append({
+                'name': service['name'],
+                'url': service['url'],
+                'status': f'Error: {str(error)}',
+                'data': None
+            })
+            continue
+        
+        service_data.append(future.result())
     
     return service_data
 
+def probe_as_completed(services, deadline=None):
+    """Probe services concurrently and yield each result as soon as it arrives.
+    
+    Services that have not answered when the deadline expires are left out,
+    their probes keep running in the background.
+    """
+    futures = {_fetch_executor.submit(probe_service, service): service for service in services}
+    try:
+        for future in as_completed(futures, timeout=deadline):
+            error = future.exception()
+            if error:
+                service = futures[future]
+                yield {
+                    'name': service['name'],
+                    'url': service['url'],
+                    'status': f'Error: {str(error)}',
+                    'data': None
+                }
+            else:
+                yield future.result()
+    except FuturesTimeout:
+        return
+
+def status_update_script(result):
+    """Return the script that sets a dashboard card to a probed status."""
+    update = {'name': result['name'], 'status': result['status']}
+    return Markup(f'<script>applyStatus({htmlsafe_json_dumps(update)});</script>\n')
+
+def render_dashboard_shell(services):
+    """Render the dashboard and split it where the status updates are streamed.
+    
+    Args:
+        services (list): Snapshot or pending result of every service
+        
+    Returns:
+        tuple: HTML before and after the status updates
+    """
+    with metrics.phase('template_render'):
+        html = render_template(
+            'index.html', services=services, circuits=circuit_breakers.states(),
+            events_version=event_broker.cursor(), status_updates=[Markup(STATUS_UPDATES_MARKER)]
+        )
+    head, tail = html.split(STATUS_UPDATES_MARKER, 1)
+    return head, tail
+
+def streamed_html(req, chunks):
+    """Build a response that sends HTML chunks as they are produced.
+    
+    Each chunk is compressed and flushed on its own, so the browser can
+    render it before the next one exists.
+    """
+    body = (chunk.encode('utf-8') for chunk in chunks)
+    encoding = compressor.negotiate(req)
+    if encoding:
+        body = compressor.compress_stream(body, encoding)
+    
+    response = Response(body, mimetype='text/html')
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    # Reverse proxies such as nginx would otherwise hold the chunks back
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+def record_request(route, method, response, started):
+    """Count a served request and add its Server-Timing header if enabled."""
+    if not metrics.enabled:
+        return
+    metrics.inc('portal_requests_total', route=route, method=method, status=response.status_code)
+    metrics.observe('portal_request_seconds', time.perf_counter() - started, route=route)
+    if response.content_length is not None:
+        metrics.observe('portal_response_bytes', response.content_length, route=route)
+    if SERVER_TIMING:
+        timing = metrics.server_timing()
+        if timing:
+            response.headers['Server-Timing'] = timing
+
+@app.before_request
+def start_request_metrics():
+    """Start timing the request."""
+    if metrics.enabled:
+        g.request_started = time.perf_counter()
+        metrics.start_request()
+
+# Registered before compress_response, so it runs after it and sees the compressed size
+@app.after_request
+def record_request_metrics(response):
+    """Record the request in the metrics."""
+    if metrics.enabled and 'request_started' in g:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        record_request(route, request.method, response, g.request_started)
+    return response
+
+@app.after_request
+def compress_response(response):
+    """Compress text responses for clients that accept gzip or brotli."""
+    return compressor.compress_response(request, response)
+
 @app.route('/')
 def index():
-    """Render the main dashboard."""
+    """Render the main dashboard.
+    
+    The page is sent at once with every service it has no snapshot of shown
+    as pending. Those services are probed meanwhile, and a script setting the
+    card's status is streamed into the page as each probe finishes.
+    """
     config = load_config()
-    services = fetch_service_data(config.get('services', []))
-    return render_template('index.html', services=services)
+    deadline = config.get('dashboard_deadline', DEFAULT_DASHBOARD_DEADLINE)
+    services = config.get('services', [])
+    # Only status badges are shown here, each iframe fetches its own content
+    results, unknown = split_by_snapshot(services)
+    head, tail = render_dashboard_shell(
+        [results.get(service['name']) or pending_service_result(service) for service in services]
+    )
+    
+    def generate():
+        yield head
+        for result in probe_as_completed(unknown, deadline=deadline):
+            yield status_update_script(result)
+        yield tail
+    
+    return streamed_html(request, generate())
 
 @app.route('/draggable')
 def index_draggable():
     """Render the draggable version of the dashboard."""
     config = load_config()
-    services = fetch_service_data(config.get('services', []))
-    return render_template('index_draggable.html', services=services)
+    deadline = config.get('dashboard_deadline', DEFAULT_DASHBOARD_DEADLINE)
+    services = dashboard_statuses(config.get('services', []), deadline=deadline)
+    return render_template(
+        'index_draggable.html', services=services, circuits=circuit_breakers.states(), events_version=event_broker.cursor()
+    )
 
 @app.route('/refresh-service-data')
 def refresh_service_data():
@@ -137,33 +848,317 @@ def refresh_service_data():
     if not service_name:
         return jsonify({'error': 'No service name provided'}), 400
     
-    config = load_config()
-    
-    # Find the service by name
-    service = next((s for s in config.get('services', []) if s['name'] == service_name), None)
+    service = config_store.service_by_name(service_name)
     if not service:
         return jsonify({'error': 'Service not found'}), 404
     
-    # Fetch fresh data
-    service_data = fetch_data_from_service(service)
+    # Fetch fresh data, skipping the cache when asked to
+    force = request.args.get('force', '').lower() in ('1', 'true')
+    service_data = latest_service_data(service, force=force)
     
     return jsonify(service_data)
 
+def _events_since():
+    """Return the last event version the client has seen."""
+    return event_broker.parse_cursor(request.headers.get('Last-Event-ID') or request.args.get('since'))
+
+@app.route('/events')
+def events():
+    """Push service status and data changes to dashboards as Server-Sent Events.
+    
+    Updates come from the background poller, so every connected client shares
+    one upstream fetch per service.
+    """
+    start_background_tasks()
+    since = _events_since()
+    
+    def stream():
+        version = since
+        yield 'retry: 5000\n\n'
+        while True:
+            version, changes = event_broker.changes_since(version, timeout=EVENTS_KEEPALIVE)
+            if not changes:
+                yield ': keep-alive\n\n'
+                continue
+            for change in changes:
+                yield f"id: {event_broker.cursor(version)}\nevent: service\ndata: {json.dumps(change)}\n\n"
+    
+    return Response(stream(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+@app.route('/events/poll')
+def events_poll():
+    """Long-poll fallback for /events for clients without EventSource."""
+    start_background_tasks()
+    version, changes = event_broker.changes_since(_events_since(), timeout=EVENTS_LONG_POLL_TIMEOUT)
+    return jsonify({'version': event_broker.cursor(version), 'events': changes})
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Serve counters and timings in the Prometheus text format."""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/cache-stats')
+def cache_stats():
+    """Report counters of the caches, the card action log and the state of rate limited upstreams."""
+    stats = response_cache.stats()
+    stats['single_flight'] = upstream_calls.stats()
+    stats['rendered_pages'] = rendered_pages.stats()
+    stats['card_action_log'] = action_log.stats()
+    stats['rate_limits'] = {
+        url: state for url, state in rate_limiters.states().items()
+        if state['rate'] or state['max_concurrent']
+    }
+    return jsonify(stats)
+
+def proxy_upstream(upstream, max_bytes, on_close=None):
+    """Stream an upstream response to the client in chunks without buffering it.
+    
+    The body is passed through as received, still compressed if the upstream
+    compressed it, so the forwarded Content-Length and Content-Encoding stay
+    valid. A body without a Content-Length that grows past max_bytes aborts the
+    response, so the client sees a failed transfer rather than a short body.
+    on_close is called once the upstream response has been closed.
+    """
+    headers = {name: upstream.headers[name] for name in PROXY_HEADERS if name in upstream.headers}
+    
+    def close():
+        upstream.close()
+        if on_close:
+            on_close()
+    
+    if upstream.status_code == 304:
+        # The browser revalidated its copy with the upstream's own validators
+        close()
+        return Response(status=304, headers=headers)
+    
+    if upstream.status_code != 200:
+        close()
+        return f"Error: HTTP {upstream.status_code}", 502
+    
+    declared = content_length(upstream)
+    if declared is not None and declared > max_bytes:
+        close()
+        return f"Error: Response body of {declared} bytes exceeds the {max_bytes} byte limit", 502
+    
+    def generate():
+        sent = 0
+        try:
+            for chunk in upstream.raw.stream(PROXY_CHUNK_SIZE, decode_content=False):
+                sent += len(chunk)
+                if sent > max_bytes:
+                    # Fail the transfer so the client can't take the cut-off body for a complete one
+                    print(f"Proxied body exceeded {max_bytes} bytes, aborting the response")
+                    raise BodyTooLarge(f"Response body exceeds the {max_bytes} byte limit")
+                yield chunk
+        finally:
+            close()
+    
+    return Response(generate(), headers=headers, direct_passthrough=True)
+
+@lru_cache(maxsize=64)
+def load_asset(filename):
+    """Return the version hash and content of a static file, or None if there is no such file.
+    
+    Assets are small and only change on deploy, so they are held in memory.
+    """
+    path = safe_join(app.static_folder, filename)
+    if path is None or not os.path.isfile(path):
+        return None
+    with open(path, 'rb') as f:
+        body = f.read()
+    return hashlib.sha1(body).hexdigest()[:12], body
+
+def asset_version(filename):
+    """Return a short hash of a static file's content, or None if there is no such file."""
+    asset = load_asset(filename)
+    return asset[0] if asset else None
+
+def asset_url(filename):
+    """Return the URL of a static file that changes whenever the file does."""
+    return f'/assets/{asset_version(filename)}/{filename}'
+
+@app.route('/assets/<version>/<path:filename>')
+def versioned_asset(version, filename):
+    """Serve a static file under its versioned URL, cacheable for as long as browsers allow."""
+    asset = load_asset(filename)
+    if asset is None:
+        return "Asset not found", 404
+    
+    current, body = asset
+    response = Response(body, mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+    response.set_etag(current)
+    response.make_conditional(request)
+    if version == current:
+        response.headers['Cache-Control'] = f'public, max-age={ASSET_MAX_AGE}, immutable'
+    else:
+        # An outdated URL must not pin the current content in the browser
+        response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/iframe/<service_name>/data')
+def iframe_data(service_name):
+    """Serve the JSON data shown by the viewer in a service iframe."""
+    service = config_store.service_by_name(service_name)
+    if not service:
+        return jsonify({'error': 'Service not found'}), 404
+    
+    return iframe_data_response(request, latest_service_data(service))
+
 @app.route('/iframe/<service_name>')
 def iframe_content(service_name):
     """Serve content for a specific service iframe."""
-    config = load_config()
-    
-    # Find the service by name
-    service = next((s for s in config.get('services', []) if s['name'] == service_name), None)
+    service = config_store.service_by_name(service_name)
     if not service:
         return "Service not found", 404
     
-    # Fetch service data
-    service_data = fetch_data_from_service(service)
+    if service.get('mode') == 'proxy':
+        # Proxied pages aren't cached, so there is nothing to fall back on when over the limit
+        admission = upstream_policy.admission(service)
+        try:
+            admission.acquire()
+        except RateLimited as e:
+            return f"Error: {str(e)}", 503, {'Retry-After': '1'}
+        try:
+            # The limiter slot is held until the body has been streamed, only the breaker is left to pass
+            with upstream_policy.attempt(service) as attempt:
+                upstream = attempt.finished(http_client.get(
+                    service['url'], read_timeout=service.get('timeout', DEFAULT_SERVICE_TIMEOUT), stream=True,
+                    headers=browser_validators(request.headers)
+                ))
+        except requests.exceptions.RequestException as e:
+            admission.release()
+            return f"Error: {str(e)}", 502
+        
+        # Only HTML needs rewriting, everything else is passed through as it arrives
+        if upstream.status_code == 304 or 'text/html' not in upstream.headers.get('content-type', '').lower():
+            return proxy_upstream(upstream, max_body_bytes(service), on_close=admission.release)
+        
+        try:
+            service_data = build_service_result(service, to_upstream_response(upstream, max_body_bytes(service)))
+        except BodyTooLarge as e:
+            return f"Error: {str(e)}", 502
+        finally:
+            admission.release()
+    else:
+        # Fetch service data
+        service_data = latest_service_data(service)
+    
+    return conditional_iframe(request, service_name, service, service_data)
+
+def browser_validators(headers):
+    """Return the browser's conditional request headers, to forward in proxy mode."""
+    return {name: headers[name] for name in ('If-None-Match', 'If-Modified-Since') if name in headers}
+
+def iframe_etag(service_name, service, service_data):
+    """Return the ETag of the iframe page rendered from the given service data.
     
+    It covers everything the page depends on: the data, the service config
+    and the URL mappings, so it doubles as the key of the render cache.
+    JSON pages are a shell that loads the data from /iframe/<name>/data, so
+    only the viewer assets count for them, not the data.
+    """
+    if isinstance(service_data['data'], (dict, list)):
+        content = ['json', asset_url('json-viewer.css'), asset_url('json-viewer.js')]
+    else:
+        content = service_data.get('data_hash') or fingerprint(service_data['data'])
+    
+    return fingerprint([
+        IFRAME_RENDER_VERSION,
+        service_name,
+        service,
+        service_data.get('content_type'),
+        load_config().get('url_mappings', URL_MAPPINGS),
+        content
+    ])
+
+def render_page(render):
+    """Render a response with render() and turn it into a RenderedPage for the render cache."""
+    with metrics.phase('template_render'):
+        response = render()
+    body = response.get_data()
+    with metrics.phase('compress'):
+        encoded = compressor.precompress(body)
+    return RenderedPage(body=body, mimetype=response.mimetype, encoded=encoded)
+
+def conditional_iframe(req, service_name, service, service_data):
+    """Serve the iframe page from the render cache, or 304 when the browser's copy is current.
+    
+    Args:
+        req: The incoming Flask or werkzeug request
+    """
     if not service_data.get('data'):
-        return f"Error: {service_data.get('status', 'No data available')}", 500
+        return render_iframe(service_name, service, service_data)
+    
+    etag = iframe_etag(service_name, service, service_data)
+    return cached_response(req, etag, lambda: render_iframe(service_name, service, service_data))
+
+def iframe_data_response(req, service_data):
+    """Serve the JSON data of a service for the viewer, compressed and revalidatable.
+    
+    With a "path" query parameter (a JSON pointer, "" for the root) only the
+    value at that path is returned, with one page of its children described
+    by json_tree.page(). "offset" and "limit" select the page. Without it the
+    whole document is returned.
+    """
+    data = service_data.get('data')
+    if not isinstance(data, (dict, list)):
+        return json_error(service_data.get('status', 'No JSON data available'), 404)
+    
+    data_hash = service_data.get('data_hash') or fingerprint(data)
+    if 'path' not in req.args:
+        etag = fingerprint(['data', data_hash])
+        return cached_response(req, etag, lambda: Response(json.dumps(data), mimetype='application/json'))
+    
+    pointer = req.args.get('path', '')
+    offset = req.args.get('offset', 0, type=int)
+    limit = req.args.get('limit', json_tree.DEFAULT_PAGE_SIZE, type=int)
+    try:
+        node = json_tree.page(data, pointer, offset=offset, limit=limit)
+    except json_tree.PathNotFound as e:
+        return json_error(str(e), 404)
+    
+    etag = fingerprint(['page', data_hash, pointer, offset, limit])
+    return cached_response(req, etag, lambda: Response(json.dumps(node), mimetype='application/json'))
+
+def json_error(message, status):
+    """Build a JSON error response without needing an application context."""
+    return Response(json.dumps({'error': message}), status=status, mimetype='application/json')
+
+def cached_response(req, etag, render):
+    """Serve a page from the render cache, rendering it on a miss.
+    
+    Answers 304 when the browser's copy is current, and sends a precompressed
+    copy to clients that accept one.
+    
+    Args:
+        req: The incoming Flask or werkzeug request
+        etag (str): Identifies the page content, used as the cache key
+        render (callable): Returns the page as a Response
+    """
+    # Weak, since the same page is also served compressed
+    if req.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        page = rendered_pages.get_or_fetch(etag, lambda: render_page(render), RENDER_CACHE_TTL)
+        encoding = compressor.negotiate(req)
+        if encoding in page.encoded:
+            response = Response(page.encoded[encoding], mimetype=page.mimetype)
+            response.headers['Content-Encoding'] = encoding
+        else:
+            response = Response(page.body, mimetype=page.mimetype)
+    response.vary.add('Accept-Encoding')
+    response.set_etag(etag, weak=True)
+    # Browsers keep the page but revalidate it on every load, which costs a 304 at most
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def render_iframe(service_name, service, service_data):
+    """Build the iframe page for the fetched data of a service."""
+    if not service_data.get('data'):
+        return Response(f"Error: {service_data.get('status', 'No data available')}", status=500)
     
     # For HTML content, process and return directly to be rendered in iframe
     content_type = 'text/plain'
@@ -175,311 +1170,34 @@ def iframe_content(service_name):
         content_type = 'text/html'
         html_content = service_data['data']
         
-        # URL rewriting for form actions and links
-        try:
-            soup = BeautifulSoup(html_content, 'html.parser')
-            
-            # Look for form elements with action attribute
-            for form in soup.find_all('form'):
-                action = form.get('action')
-                if action:
-                    # Check for each mapping and replace if found in the action URL
-                    for external_url, internal_url in URL_MAPPINGS.items():
-                        if external_url in action:
-                            new_action = action.replace(external_url, internal_url)
-                            form['action'] = new_action
-                            print(f"Rewrote form action from {action} to {new_action}")
-                            break
-            
-            # Update links too if needed
-            for link in soup.find_all('a'):
-                href = link.get('href')
-                if href:
-                    # Check for each mapping and replace if found in the href URL
-                    for external_url, internal_url in URL_MAPPINGS.items():
-                        if external_url in href:
-                            new_href = href.replace(external_url, internal_url)
-                            link['href'] = new_href
-                            print(f"Rewrote link href from {href} to {new_href}")
-                            break
-            
-            # Return the modified HTML
-            return Response(str(soup), mimetype=content_type)
-        except Exception as e:
-            print(f"Error rewriting URLs: {e}")
-            # Fall back to unmodified content
-            return Response(html_content, mimetype=content_type)
+        # Real HTML responses were already rewritten in a single pass when fetched,
+        # other HTML-looking text only needs its form actions and links mapped
+        if 'text/html' not in service_data.get('content_type', ''):
+            html_content = rewrite_html_urls(html_content, backend=service.get('html_backend', DEFAULT_HTML_BACKEND))
+        
+        return Response(html_content, mimetype=content_type)
         
     # For other types, wrap in a simple HTML template
     if isinstance(service_data['data'], (dict, list)):
-        # Format JSON data with syntax highlighting and collapsible sections
+        # A small shell around the cached viewer assets, the data is loaded separately
         html_template = f"""
         <!DOCTYPE html>
         <html>
         <head>
             <meta charset="UTF-8">
             <meta name="viewport" content="width=device-width, initial-scale=1.0">
-            <title>{service_name} Content</title>
-            <style>
-                body {{
-                    font-family: 'Arial', sans-serif;
-                    margin: 0;
-                    padding: 16px;
-                    overflow: auto;
-                    height: 100%;
-                    box-sizing: border-box;
-                    background-color: #f8f9fa;
-                    color: #333;
-                    line-height: 1.5;
-                }}
-                .json-container {{
-                    background-color: white;
-                    border-radius: 6px;
-                    box-shadow: 0 1px 3px rgba(0,0,0,0.1);
-                    padding: 16px;
-                    overflow: auto;
-                }}
-                .json-key {{
-                    color: #0066cc;
-                    font-weight: bold;
-                }}
-                .json-value {{
-                    margin-left: 10px;
-                }}
-                .json-string {{
-                    color: #008800;
-                }}
-                .json-number {{
-                    color: #aa0000;
-                }}
-                .json-boolean {{
-                    color: #0000dd;
-                    font-weight: bold;
-                }}
-                .json-null {{
-                    color: #999;
-                    font-style: italic;
-                }}
-                .collapsible {{
-                    cursor: pointer;
-                    user-select: none;
-                }}
-                .collapsible::before {{
-                    content: '▼';
-                    display: inline-block;
-                    margin-right: 5px;
-                    transition: transform 0.2s;
-                }}
-                .collapsed::before {{
-                    transform: rotate(-90deg);
-                }}
-                .collapsed + ul, .collapsed + pre {{
-                    display: none;
-                }}
-                ul {{
-                    list-style-type: none;
-                    padding-left: 20px;
-                    margin: 0;
-                }}
-                li {{
-                    padding: 3px 0;
-                }}
-                .json-toolbar {{
-                    margin-bottom: 10px;
-                    padding-bottom: 10px;
-                    border-bottom: 1px solid #eee;
-                }}
-                .json-toolbar button {{
-                    background-color: #f0f0f0;
-                    border: 1px solid #ddd;
-                    border-radius: 4px;
-                    padding: 5px 10px;
-                    margin-right: 8px;
-                    cursor: pointer;
-                    font-size: 14px;
-                }}
-                .json-toolbar button:hover {{
-                    background-color: #e8e8e8;
-                }}
-                .json-toolbar button:active {{
-                    background-color: #ddd;
-                }}
-                pre {{
-                    white-space: pre-wrap;
-                    margin: 0;
-                    font-family: monospace;
-                }}
-                img, video {{
-                    max-width: 100%;
-                    height: auto;
-                }}
-            </style>
+            <title>{escape(service_name)} Content</title>
+            <link rel="stylesheet" href="{asset_url('json-viewer.css')}">
+            <script src="{asset_url('json-viewer.js')}" defer></script>
         </head>
         <body>
             <div class="json-toolbar">
-                <button onclick="expandAll()">Expand All</button>
-                <button onclick="collapseAll()">Collapse All</button>
-                <button onclick="copyToClipboard()">Copy JSON</button>
+                <button id="expand-all">Expand All</button>
+                <button id="collapse-all">Collapse All</button>
+                <button id="copy-json">Copy JSON</button>
             </div>
-            <div class="json-container" id="json-container">
+            <div class="json-container" id="json-container" data-src="/iframe/{quote(service_name, safe='')}/data">
             </div>
-            
-            <script>
-                // Store the original JSON data
-                const jsonData = {json.dumps(service_data['data'])};
-                
-                // Function to create interactive JSON viewer
-                function renderJSON(data, container) {{
-                    if (Array.isArray(data)) {{
-                        renderArray(data, container);
-                    }} else if (data && typeof data === 'object') {{
-                        renderObject(data, container);
-                    }} else {{
-                        renderPrimitive(data, container);
-                    }}
-                }}
-                
-                function renderObject(obj, container) {{
-                    const keys = Object.keys(obj);
-                    if (keys.length === 0) {{
-                        const emptyObj = document.createElement('span');
-                        emptyObj.className = 'json-value';
-                        emptyObj.textContent = '{{ }}';
-                        container.appendChild(emptyObj);
-                        return;
-                    }}
-                    
-                    const objSpan = document.createElement('span');
-                    objSpan.className = 'collapsible';
-                    objSpan.textContent = '{{ ';
-                    objSpan.addEventListener('click', function(e) {{
-                        e.stopPropagation();
-                        this.classList.toggle('collapsed');
-                    }});
-                    container.appendChild(objSpan);
-                    
-                    const list = document.createElement('ul');
-                    container.appendChild(list);
-                    
-                    keys.forEach((key, index) => {{
-                        const listItem = document.createElement('li');
-                        list.appendChild(listItem);
-                        
-                        const keySpan = document.createElement('span');
-                        keySpan.className = 'json-key';
-                        keySpan.textContent = `"${{key}}": `;
-                        listItem.appendChild(keySpan);
-                        
-                        renderJSON(obj[key], listItem);
-                        
-                        if (index < keys.length - 1) {{
-                            const comma = document.createTextNode(',');
-                            listItem.appendChild(comma);
-                        }}
-                    }});
-                    
-                    const closingBrace = document.createTextNode(' }}');
-                    container.appendChild(closingBrace);
-                }}
-                
-                function renderArray(arr, container) {{
-                    if (arr.length === 0) {{
-                        const emptyArr = document.createElement('span');
-                        emptyArr.className = 'json-value';
-                        emptyArr.textContent = '[ ]';
-                        container.appendChild(emptyArr);
-                        return;
-                    }}
-                    
-                    const arrSpan = document.createElement('span');
-                    arrSpan.className = 'collapsible';
-                    arrSpan.textContent = '[ ';
-                    arrSpan.addEventListener('click', function(e) {{
-                        e.stopPropagation();
-                        this.classList.toggle('collapsed');
-                    }});
-                    container.appendChild(arrSpan);
-                    
-                    const list = document.createElement('ul');
-                    container.appendChild(list);
-                    
-                    arr.forEach((item, index) => {{
-                        const listItem = document.createElement('li');
-                        list.appendChild(listItem);
-                        
-                        renderJSON(item, listItem);
-                        
-                        if (index < arr.length - 1) {{
-                            const comma = document.createTextNode(',');
-                            listItem.appendChild(comma);
-                        }}
-                    }});
-                    
-                    const closingBracket = document.createTextNode(' ]');
-                    container.appendChild(closingBracket);
-                }}
-                
-                function renderPrimitive(value, container) {{
-                    const valueSpan = document.createElement('span');
-                    valueSpan.className = 'json-value';
-                    
-                    if (typeof value === 'string') {{
-                        valueSpan.className += ' json-string';
-                        valueSpan.textContent = `"${{value}}"`;
-                    }} else if (typeof value === 'number') {{
-                        valueSpan.className += ' json-number';
-                        valueSpan.textContent = value;
-                    }} else if (typeof value === 'boolean') {{
-                        valueSpan.className += ' json-boolean';
-                        valueSpan.textContent = value;
-                    }} else if (value === null) {{
-                        valueSpan.className += ' json-null';
-                        valueSpan.textContent = 'null';
-                    }} else {{
-                        valueSpan.textContent = value;
-                    }}
-                    
-                    container.appendChild(valueSpan);
-                }}
-                
-                // Expand all collapsible elements
-                function expandAll() {{
-                    document.querySelectorAll('.collapsible').forEach(el => {{
-                        el.classList.remove('collapsed');
-                    }});
-                }}
-                
-                // Collapse all collapsible elements
-                function collapseAll() {{
-                    document.querySelectorAll('.collapsible').forEach(el => {{
-                        el.classList.add('collapsed');
-                    }});
-                }}
-                
-                // Copy JSON to clipboard
-                function copyToClipboard() {{
-                    const textArea = document.createElement('textarea');
-                    textArea.value = JSON.stringify(jsonData, null, 2);
-                    document.body.appendChild(textArea);
-                    textArea.select();
-                    document.execCommand('copy');
-                    document.body.removeChild(textArea);
-                    
-                    // Show feedback
-                    const button = document.querySelector('button:nth-child(3)');
-                    const originalText = button.textContent;
-                    button.textContent = 'Copied!';
-                    setTimeout(() => {{
-                        button.textContent = originalText;
-                    }}, 1500);
-                }}
-                
-                // Initialize the JSON viewer
-                document.addEventListener('DOMContentLoaded', function() {{
-                    const container = document.getElementById('json-container');
-                    renderJSON(jsonData, container);
-                }});
-            </script>
         </body>
         </html>
         """
@@ -526,41 +1244,74 @@ def iframe_content(service_name):
     
     return Response(html_template, mimetype='text/html')
 
-@app.route('/card-action', methods=['POST'])
-def card_action():
-    """Process actions from cards/iframes."""
-    data = request.json
-    if not data:
-        return jsonify({'error': 'No data provided'}), 400
+def process_card_action(data, log_lines):
+    """Handle one action sent by a card or iframe.
+    
+    Args:
+        data (dict): The action, with serviceId, action and optional data
+        log_lines (list): Log lines of the action are appended here, to be
+            queued on the action log by the caller
+    
+    Returns:
+        tuple: Result dict and HTTP status
+    """
+    if not data or not isinstance(data, dict):
+        return {'error': 'No data provided'}, 400
     
     service_id = data.get('serviceId')
     action = data.get('action')
-    action_data = data.get('data', {})
+    action_data = data.get('data') or {}
     
     if not service_id or not action:
-        return jsonify({'error': 'Missing required parameters'}), 400
+        return {'error': 'Missing required parameters'}, 400
     
     # Map service_id to service name (assuming service_id is the sanitized service name)
-    config = load_config()
-    service = None
-    
-    for s in config.get('services', []):
-        if s['name'].lower().replace(' ', '_') == service_id:
-            service = s
-            break
-    
+    service = config_store.service_by_id(service_id)
     if not service:
-        return jsonify({'error': 'Service not found'}), 404
-    
-    # Handle different actions
-    result = {'success': True, 'message': f'Action {action} processed'}
+        return {'error': 'Service not found'}, 404
     
     if action == 'log':
-        print(f"Log from {service['name']}: {action_data.get('message', 'No message')}")
+        message = action_data.get('message', 'No message') if isinstance(action_data, dict) else action_data
+        log_lines.append(f"Log from {service['name']}: {message}")
     
     # Add more action handlers as needed
     
-    return jsonify(result)
+    return {'success': True, 'message': f'Action {action} processed'}, 200
+
+@app.route('/card-action', methods=['POST'])
+def card_action():
+    """Process actions from cards/iframes."""
+    log_lines = []
+    result, status = process_card_action(request.get_json(silent=True), log_lines)
+    if log_lines:
+        action_log.submit(log_lines)
+    return jsonify(result), status
+
+@app.route('/card-actions', methods=['POST'])
+def card_actions():
+    """Process a batch of card actions in one request.
+    
+    Takes a JSON list of actions as sent to /card-action, or an object with an
+    "actions" list. Beacons may send it with any content type. Every action
+    is handled on its own, the ones that fail are reported by their index.
+    """
+    body = request.get_json(force=True, silent=True)
+    actions = body.get('actions') if isinstance(body, dict) else body
+    if not isinstance(actions, list):
+        return jsonify({'error': 'Expected a list of actions'}), 400
+    if len(actions) > CARD_ACTIONS_MAX_BATCH:
+        return jsonify({'error': f'At most {CARD_ACTIONS_MAX_BATCH} actions can be sent at once'}), 413
+    
+    log_lines = []
+    errors = []
+    for index, data in enumerate(actions):
+        result, status = process_card_action(data, log_lines)
+        if status != 200:
+            errors.append({'index': index, 'error': result['error']})
+    if log_lines:
+        action_log.submit(log_lines)
+    
+    return jsonify({'processed': len(actions) - len(errors), 'errors': errors})
 
 @app.route('/settings', methods=['GET', 'POST'])
 def settings():
@@ -571,28 +1322,69 @@ def settings():
         service_url = request.form.get('service_url')
         
         if service_name and service_url:
-            config = load_config()
-            
-            # Check if service with the same name already exists
-            service_exists = any(s['name'] == service_name for s in config.get('services', []))
-            
-            if not service_exists:
-                # Add the new service
-                if 'services' not in config:
-                    config['services'] = []
+            def add_service(config):
+                # Check if service with the same name already exists
+                if any(s['name'] == service_name for s in config.get('services', [])):
+                    return
                 
-                config['services'].append({
+                # Add the new service
+                config.setdefault('services', []).append({
                     'name': service_name,
                     'url': service_url
                 })
-                
-                save_config(config)
+            
+            config_store.update(add_service)
         
         return redirect(url_for('settings'))
     
     # GET request - show settings page
     config = load_config()
-    return render_template('settings.html', services=config.get('services', []))
+    return render_template('settings.html', services=config.get('services', []), circuits=circuit_breakers.states())
+
+@app.route('/import-services', methods=['POST'])
+def import_services():
+    """Add many services at once from an uploaded JSON or CSV file.
+    
+    The file is sent as the "file" field of a form, or as the request body.
+    Every entry is validated first and nothing is saved unless all of them
+    are valid. The services are then written in a single config update.
+    Services whose name already exists are skipped, or replaced when the
+    "replace" parameter is set.
+    """
+    upload = request.files.get('file')
+    if upload:
+        content = upload.read().decode('utf-8-sig', errors='replace')
+        format = import_format(upload.filename, upload.mimetype)
+    else:
+        content = request.get_data(as_text=True)
+        format = import_format(mimetype=request.mimetype)
+    
+    try:
+        services = parse_services(content, format)
+    except InvalidImport as e:
+        return jsonify({'status': 'Error', 'errors': e.errors}), 400
+    
+    replace = request.values.get('replace', '').lower() in ('1', 'true', 'on')
+    summary = {'added': [], 'updated': [], 'skipped': []}
+    
+    def add_services(config):
+        existing = config.setdefault('services', [])
+        positions = {s['name']: index for index, s in enumerate(existing)}
+        for service in services:
+            if service['name'] not in positions:
+                existing.append(service)
+                summary['added'].append(service['name'])
+            elif replace:
+                existing[positions[service['name']]] = service
+                summary['updated'].append(service['name'])
+            else:
+                summary['skipped'].append(service['name'])
+    
+    config_store.update(add_services)
+    # Replaced services may point somewhere else now, don't wait out their old interval
+    for name in summary['updated']:
+        scheduler.poll_soon(name)
+    return jsonify(dict(summary, status='Imported'))
 
 @app.route('/test-connection', methods=['POST'])
 def test_connection():
@@ -602,32 +1394,98 @@ def test_connection():
     if not url:
         return jsonify({'status': 'Error', 'message': 'No URL provided'}), 400
     
+    return jsonify(check_connection(url))
+
+@app.route('/test-connections', methods=['POST'])
+def test_connections():
+    """Test many connections concurrently, streaming each result as it completes.
+    
+    The body is JSON with a "urls" list or a "services" list of name/url
+    objects. Without a body every configured service is tested. The
+    response is newline-delimited JSON, one line per URL in the order the
+    tests finish, each with the url (and name) and the check_connection()
+    result.
+    """
     try:
-        response = requests.get(url, timeout=5)
-        if response.status_code == 200:
-            content_type = response.headers.get('content-type', '').lower()
-            if 'application/json' in content_type:
-                data_preview = 'Valid JSON data received'
-            elif 'text/html' in content_type:
-                data_preview = 'HTML content received'
-            else:
-                data_preview = 'Data received'
-                
-            return jsonify({
-                'status': 'Connected',
-                'message': f'Connection successful: {response.status_code}',
-                'preview': data_preview
-            })
-        else:
-            return jsonify({
-                'status': 'Error',
-                'message': f'HTTP Error: {response.status_code}'
-            })
+        targets = connection_test_targets(request.get_json(silent=True))
+    except ValueError as e:
+        return jsonify({'status': 'Error', 'message': str(e)}), 400
+    
+    def generate():
+        futures = {_connection_test_executor.submit(check_connection, target['url']): target for target in targets}
+        try:
+            for future in as_completed(futures):
+                yield json.dumps(dict(futures[future], **future.result())) + '\n'
+        finally:
+            # The client went away, don't test the URLs still waiting
+            for future in futures:
+                future.cancel()
+    
+    return Response(generate(), mimetype='application/x-ndjson', headers={'X-Accel-Buffering': 'no'})
+
+def connection_test_targets(body):
+    """Return the name/url pairs a batch connection test checks.
+    
+    Raises:
+        ValueError: The request body is not a valid batch
+    """
+    if not body:
+        return [{'name': s['name'], 'url': s['url']} for s in config_store.services()]
+    if not isinstance(body, dict):
+        raise ValueError('Expected an object with "urls" or "services"')
+    
+    if isinstance(body.get('urls'), list):
+        targets = [{'url': url} for url in body['urls'] if isinstance(url, str)]
+    elif isinstance(body.get('services'), list):
+        targets = [
+            {'name': s.get('name'), 'url': s['url']} for s in body['services']
+            if isinstance(s, dict) and isinstance(s.get('url'), str)
+        ]
+    else:
+        targets = []
+    
+    if not targets:
+        raise ValueError('No URLs to test')
+    if len(targets) > MAX_BATCH_SERVICES:
+        raise ValueError(f'At most {MAX_BATCH_SERVICES} URLs can be tested at once')
+    return targets
+
+def check_connection(url):
+    """Test a connection to a URL from its response headers, without reading the body."""
+    started = time.monotonic()
+    try:
+        response = http_client.get(url, read_timeout=DEFAULT_SERVICE_TIMEOUT, stream=True)
+        response.close()
+        result = connection_test_result(response.status_code, response.headers.get('content-type', ''))
     except requests.exceptions.RequestException as e:
-        return jsonify({
+        result = {
             'status': 'Error',
             'message': f'Connection failed: {str(e)}'
-        })
+        }
+    result['elapsed_ms'] = round((time.monotonic() - started) * 1000)
+    return result
+
+def connection_test_result(status_code, content_type):
+    """Describe the outcome of a connection test from the response headers."""
+    if status_code != 200:
+        return {
+            'status': 'Error',
+            'message': f'HTTP Error: {status_code}'
+        }
+    
+    content_type = content_type.lower()
+    if 'application/json' in content_type:
+        data_preview = 'Valid JSON data received'
+    elif 'text/html' in content_type:
+        data_preview = 'HTML content received'
+    else:
+        data_preview = 'Data received'
+    
+    return {
+        'status': 'Connected',
+        'message': f'Connection successful: {status_code}',
+        'preview': data_preview
+    }
 
 @app.route('/remove-service', methods=['POST'])
 def remove_service():
@@ -637,14 +1495,41 @@ def remove_service():
     if not service_name:
         return jsonify({'status': 'Error', 'message': 'No service name provided'}), 400
     
-    config = load_config()
+    unused_urls = set()
     
-    # Remove the service with the given name
-    config['services'] = [s for s in config.get('services', []) if s['name'] != service_name]
+    def drop_service(config):
+        # Remove the service with the given name
+        services = config.get('services', [])
+        config['services'] = [s for s in services if s['name'] != service_name]
+        unused_urls.update(s['url'] for s in services if s['name'] == service_name)
+        unused_urls.difference_update(s['url'] for s in config['services'])
     
-    save_config(config)
+    config_store.update(drop_service)
+    forget_service(service_name, unused_urls)
     
     return redirect(url_for('settings'))
 
+def forget_service(name, unused_urls):
+    """Drop everything kept about a removed service.
+    
+    Args:
+        name (str): Name of the removed service
+        unused_urls (set): Its URLs that no remaining service uses, whose
+            cached responses and probed statuses are dropped too
+    """
+    # Also deletes the shared row, so other workers don't load it again
+    snapshot_store.remove(name)
+    event_broker.remove(name)
+    with _processed_results_lock:
+        _processed_results.pop(name, None)
+    with _status_cache_lock:
+        for url in unused_urls:
+            _status_cache.pop(url, None)
+    for url in unused_urls:
+        response_cache.invalidate(url)
+
 if __name__ == '__main__':
+    # The reloader runs the app in a child process, only poll from that one
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_background_tasks()
     app.run(debug=True, host='0.0.0.0') 
\ No newline at end of file
@@ -0,0 +1,628 @@
+import asyncio
+import io
+import json
+import time
+
+import httpx
+import requests
+from asgiref.wsgi import WsgiToAsgi
+from flask import jsonify
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+from werkzeug.exceptions import HTTPException
+from werkzeug.routing import Map, Rule
+from werkzeug.wrappers import Request, Response
+
+import app as portal
+from cache import AsyncSingleFlight
+from http_client import AsyncHttpClient, BodyTooLarge, content_length, read_body_async
+from ratelimit import RateLimited
+
+# ASGI entry point of the portal, for production use:
+#
+#     gunicorn -c gunicorn.conf.py asgi:application
+#
+# The routes that wait on upstreams run as coroutines on a non-blocking HTTP
+# client, so a slow upstream holds no worker thread. All other routes are
+# handed to the Flask app in app.py, which they share caches, snapshots and
+# config with.
+
+# Errors that mean an upstream could not be reached or read
+UPSTREAM_ERRORS = (httpx.HTTPError, httpx.InvalidURL, requests.exceptions.RequestException, TimeoutError)
+
+http = AsyncHttpClient(
+    pool_size=portal.HTTP_POOL_SIZE,
+    max_per_host=portal.HTTP_MAX_PER_HOST,
+    connect_timeout=portal.HTTP_CONNECT_TIMEOUT,
+    read_timeout=portal.DEFAULT_SERVICE_TIMEOUT,
+    host_settings=portal._upstream_host_settings
+)
+
+# Concurrent requests for the same upstream share one in-flight call
+upstream_calls = AsyncSingleFlight()
+
+# Background tasks, referenced here so they are not garbage collected early
+_background = set()
+
+flask_app = WsgiToAsgi(portal.app)
+
+
+class StreamingResponse:
+    """A response whose body is produced by an async iterator."""
+
+    def __init__(self, body, status=200, headers=None, on_close=None):
+        self.body = body
+        self.status = status
+        self.headers = headers or {}
+        self.on_close = on_close
+
+
+def _spawn(coroutine):
+    """Run a coroutine in the background without awaiting it."""
+    task = asyncio.ensure_future(coroutine)
+    _background.add(task)
+    task.add_done_callback(_background.discard)
+    return task
+
+
+def _error_result(service, error):
+    return {
+        'name': service['name'],
+        'url': service['url'],
+        'status': f'Error: {str(error)}',
+        'data': None
+    }
+
+
+async def _to_upstream_response(response, max_bytes):
+    """Read a streamed httpx response into an UpstreamResponse."""
+    content = await read_body_async(response, max_bytes)
+    return portal.UpstreamResponse(
+        status_code=response.status_code,
+        headers=CaseInsensitiveDict(response.headers),
+        content=content,
+        encoding=get_encoding_from_headers(response.headers)
+    )
+
+
+async def call_upstream(service, call, status_code=lambda result: result.status_code):
+    """Await a request to a service through its rate limiter and circuit breaker, see app.call_upstream()."""
+    async with portal.upstream_policy.admission(service):
+        with portal.upstream_policy.attempt(service) as attempt:
+            return attempt.finished(await call(), status_code)
+
+
+class _ConnectTrace:
+    """Adds up the DNS, TCP and TLS setup time of an httpx request from its trace events."""
+
+    def __init__(self):
+        self.seconds = 0.0
+        self._started = None
+
+    async def __call__(self, event, info):
+        if not event.startswith(('connection.connect_tcp.', 'connection.start_tls.')):
+            return
+        if event.endswith('.started'):
+            self._started = time.perf_counter()
+        elif event.endswith(('.complete', '.failed')) and self._started is not None:
+            self.seconds += time.perf_counter() - self._started
+            self._started = None
+
+
+async def request_upstream(service, previous=None):
+    """Send a GET request to a service, see app.request_upstream()."""
+    timeout = service.get('timeout', portal.DEFAULT_SERVICE_TIMEOUT)
+    headers = portal.upstream_policy.conditional_headers(previous)
+    metrics = portal.metrics
+    name = service['name']
+
+    async def call():
+        connect = _ConnectTrace() if metrics.enabled else None
+        extensions = {'trace': connect} if connect else None
+        started = time.perf_counter()
+        async with http.stream(
+            'GET', service['url'], read_timeout=timeout, headers=headers, extensions=extensions
+        ) as response:
+            if connect:
+                metrics.record_phase('upstream_connect', connect.seconds, service=name)
+                metrics.record_phase('upstream_ttfb', time.perf_counter() - started - connect.seconds, service=name)
+            if portal.upstream_policy.not_modified(previous, response.status_code):
+                return previous
+            with metrics.phase('upstream_download', service=name):
+                upstream = await _to_upstream_response(response, portal.max_body_bytes(service))
+            metrics.observe('portal_upstream_body_bytes', len(upstream.content), service=name)
+            return upstream
+
+    return await call_upstream(service, call)
+
+
+async def fetch_upstream(service, force=False):
+    """Return the upstream response for a service, using the shared response cache, see app.fetch_upstream()."""
+    policy = portal.upstream_policy
+    timeout = service.get('timeout', portal.DEFAULT_SERVICE_TIMEOUT)
+
+    response, refresh = policy.cached_response(service, force=force)
+    if response is not None:
+        if refresh:
+            _spawn(_refresh_upstream(service))
+        return response
+
+    previous = policy.previous_response(service)
+    try:
+        response = await upstream_calls.do(service['url'], lambda: request_upstream(service, previous), timeout=timeout)
+    except RateLimited:
+        return policy.last_good_response(service)
+    policy.store_response(service, response)
+    return response
+
+
+async def _refresh_upstream(service):
+    """Replace a stale cache entry in the background, keeping it on failure."""
+    error = None
+    try:
+        previous = portal.upstream_policy.previous_response(service)
+        response = await upstream_calls.do(service['url'], lambda: request_upstream(service, previous))
+        portal.upstream_policy.store_response(service, response)
+    except Exception as e:
+        error = e
+    finally:
+        portal.upstream_policy.refresh_done(service, error)
+
+
+async def fetch_data_from_service(service, force=False):
+    """Fetch data from an external service without blocking the event loop."""
+    try:
+        response = await fetch_upstream(service, force=force)
+        # Parsing and HTML rewriting is CPU work, keep it off the event loop
+        return await asyncio.to_thread(portal.processed_service_result, service, response)
+    except UPSTREAM_ERRORS as e:
+        return _error_result(service, e)
+
+
+async def latest_service_data(service, force=False):
+    """Return the latest data of a service, from its snapshot when there is one."""
+    if not force:
+        # Snapshots may live in SQLite, keep its I/O off the event loop
+        result = await asyncio.to_thread(portal.latest_snapshot, service)
+        if result:
+            return result
+
+    service_data = await fetch_data_from_service(service, force=force)
+    await asyncio.to_thread(portal.snapshot_store.put, service['name'], service_data)
+    return service_data
+
+
+async def _probe_status_code(url, timeout):
+    """Return the HTTP status of a URL from the response headers only."""
+    async with http.stream('HEAD', url, read_timeout=timeout) as response:
+        status_code = response.status_code
+    if status_code in (405, 501):
+        # HEAD not supported, read the status line only
+        async with http.stream('GET', url, read_timeout=timeout) as response:
+            status_code = response.status_code
+    return status_code
+
+
+async def probe_service(service):
+    """Check whether a service is reachable without downloading its body."""
+    cached = portal.cached_probe_result(service)
+    if cached:
+        return cached
+
+    url = service['url']
+    timeout = service.get('timeout', portal.DEFAULT_SERVICE_TIMEOUT)
+
+    def probe():
+        return call_upstream(service, lambda: _probe_status_code(url, timeout), status_code=lambda code: code)
+
+    try:
+        status = portal.probe_status(await upstream_calls.do(('probe', url), probe, timeout=timeout))
+    except RateLimited as e:
+        return portal.cached_probe_result(service, max_age=None) or portal.store_probe_result(service, f'Error: {str(e)}')
+    except UPSTREAM_ERRORS as e:
+        status = f'Error: {str(e)}'
+
+    return portal.store_probe_result(service, status)
+
+
+async def probe_as_completed(services, deadline=None):
+    """Probe services concurrently and yield each result as soon as it arrives.
+
+    Probes still running at the deadline are left out and finish in the
+    background, so their result is cached for the next render.
+    """
+    async def probe(service):
+        try:
+            return await probe_service(service)
+        except Exception as e:
+            return _error_result(service, e)
+
+    if not services:
+        return
+    probes = [_spawn(probe(service)) for service in services]
+    try:
+        for next_done in asyncio.as_completed(probes, timeout=deadline):
+            yield await next_done
+    except asyncio.TimeoutError:
+        return
+
+
+def json_response(data, status=200):
+    """Build a JSON response the same way the Flask routes do."""
+    with portal.app.app_context():
+        response = jsonify(data)
+    response.status_code = status
+    return response
+
+
+async def index(request):
+    """Render the main dashboard, streaming card statuses in as probes finish."""
+    config = portal.load_config()
+    deadline = config.get('dashboard_deadline', portal.DEFAULT_DASHBOARD_DEADLINE)
+    services = config.get('services', [])
+    results, unknown = await asyncio.to_thread(portal.split_by_snapshot, services)
+    with portal.app.app_context():
+        head, tail = portal.render_dashboard_shell(
+            [results.get(service['name']) or portal.pending_service_result(service) for service in services]
+        )
+
+    async def chunks():
+        yield head
+        async for result in probe_as_completed(unknown, deadline=deadline):
+            yield portal.status_update_script(result)
+        yield tail
+
+    headers = {'Content-Type': 'text/html; charset=utf-8', 'Vary': 'Accept-Encoding', 'X-Accel-Buffering': 'no'}
+    encoding = portal.compressor.negotiate(request)
+    encoder = portal.compressor.stream_encoder(encoding) if encoding else None
+    if encoder:
+        headers['Content-Encoding'] = encoding
+
+    async def body():
+        # Each chunk is compressed and flushed on its own, see ResponseCompressor.compress_stream()
+        async for chunk in chunks():
+            chunk = chunk.encode('utf-8')
+            yield encoder.compress(chunk) if encoder else chunk
+        if encoder:
+            yield encoder.finish()
+
+    return StreamingResponse(body(), headers=headers)
+
+
+async def refresh_service_data(request):
+    """Refresh data for a specific service."""
+    service_name = request.args.get('name')
+    if not service_name:
+        return json_response({'error': 'No service name provided'}, 400)
+
+    service = portal.config_store.service_by_name(service_name)
+    if not service:
+        return json_response({'error': 'Service not found'}, 404)
+
+    force = request.args.get('force', '').lower() in ('1', 'true')
+    return json_response(await latest_service_data(service, force=force))
+
+
+async def iframe_content(request, service_name):
+    """Serve content for a specific service iframe."""
+    service = portal.config_store.service_by_name(service_name)
+    if not service:
+        return Response("Service not found", status=404)
+
+    if service.get('mode') == 'proxy':
+        return await proxy_service(request, service_name, service)
+
+    service_data = await latest_service_data(service)
+    # Rendering and compressing a large page is CPU work, keep it off the event loop
+    return await asyncio.to_thread(portal.conditional_iframe, request, service_name, service, service_data)
+
+
+async def iframe_data(request, service_name):
+    """Serve the JSON data shown by the viewer in a service iframe."""
+    service = portal.config_store.service_by_name(service_name)
+    if not service:
+        return json_response({'error': 'Service not found'}, 404)
+
+    service_data = await latest_service_data(service)
+    # Serialising and compressing a large document is CPU work, keep it off the event loop
+    return await asyncio.to_thread(portal.iframe_data_response, request, service_data)
+
+
+async def proxy_service(request, service_name, service):
+    """Stream a proxy-mode service to the client, buffering only HTML."""
+    max_bytes = portal.max_body_bytes(service)
+    timeout = service.get('timeout', portal.DEFAULT_SERVICE_TIMEOUT)
+    admission = portal.upstream_policy.admission(service)
+    try:
+        await admission.acquire_async()
+    except RateLimited as e:
+        return Response(f"Error: {str(e)}", status=503, headers={'Retry-After': '1'})
+    upstream = http.stream(
+        'GET', service['url'], read_timeout=timeout, headers=portal.browser_validators(request.headers)
+    )
+    try:
+        # The limiter slot is held until the body has been streamed, only the breaker is left to pass
+        with portal.upstream_policy.attempt(service) as attempt:
+            response = attempt.finished(await upstream.__aenter__())
+    except UPSTREAM_ERRORS as e:
+        admission.release()
+        return Response(f"Error: {str(e)}", status=502)
+
+    closed = False
+
+    async def close():
+        nonlocal closed
+        if not closed:
+            closed = True
+            admission.release()
+            await upstream.__aexit__(None, None, None)
+
+    headers = {name: response.headers[name] for name in portal.PROXY_HEADERS if name in response.headers}
+
+    if response.status_code == 304:
+        # The browser revalidated its copy with the upstream's own validators
+        await close()
+        return Response(status=304, headers=headers)
+
+    # Only HTML needs rewriting, everything else is passed through as it arrives
+    if 'text/html' in response.headers.get('content-type', '').lower():
+        try:
+            upstream_response = await _to_upstream_response(response, max_bytes)
+        except (BodyTooLarge, *UPSTREAM_ERRORS) as e:
+            return Response(f"Error: {str(e)}", status=502)
+        finally:
+            await close()
+        service_data = await asyncio.to_thread(portal.build_service_result, service, upstream_response)
+        return await asyncio.to_thread(portal.conditional_iframe, request, service_name, service, service_data)
+
+    if response.status_code != 200:
+        await close()
+        return Response(f"Error: HTTP {response.status_code}", status=502)
+
+    declared = content_length(response)
+    if declared is not None and declared > max_bytes:
+        await close()
+        return Response(f"Error: Response body of {declared} bytes exceeds the {max_bytes} byte limit", status=502)
+
+    async def body():
+        sent = 0
+        async for chunk in response.aiter_raw(portal.PROXY_CHUNK_SIZE):
+            sent += len(chunk)
+            if sent > max_bytes:
+                # Fail the transfer so the client can't take the cut-off body for a complete one
+                print(f"Proxied body exceeded {max_bytes} bytes, aborting the response")
+                raise BodyTooLarge(f"Response body exceeds the {max_bytes} byte limit")
+            yield chunk
+
+    return StreamingResponse(body(), headers=headers, on_close=close)
+
+
+async def test_connection(request):
+    """Test a connection to a service URL."""
+    url = request.form.get('url')
+    if not url:
+        return json_response({'status': 'Error', 'message': 'No URL provided'}, 400)
+
+    return json_response(await check_connection(url))
+
+
+async def test_connections(request):
+    """Test many connections concurrently, see app.test_connections()."""
+    try:
+        body = json.loads(request.get_data(as_text=True) or 'null')
+    except ValueError:
+        body = None
+    try:
+        targets = portal.connection_test_targets(body)
+    except ValueError as e:
+        return json_response({'status': 'Error', 'message': str(e)}, 400)
+
+    slots = asyncio.Semaphore(portal.CONNECTION_TEST_CONCURRENCY)
+
+    async def check(target):
+        async with slots:
+            return dict(target, **await check_connection(target['url']))
+
+    async def stream():
+        tests = [asyncio.ensure_future(check(target)) for target in targets]
+        try:
+            for next_done in asyncio.as_completed(tests):
+                yield (json.dumps(await next_done) + '\n').encode('utf-8')
+        finally:
+            # The client went away, don't test the URLs still waiting
+            for test in tests:
+                test.cancel()
+
+    return StreamingResponse(stream(), headers={
+        'Content-Type': 'application/x-ndjson',
+        'X-Accel-Buffering': 'no'
+    })
+
+
+async def check_connection(url):
+    """Test a connection to a URL from its response headers, see app.check_connection()."""
+    started = time.monotonic()
+    try:
+        async with http.stream('GET', url, read_timeout=portal.DEFAULT_SERVICE_TIMEOUT) as response:
+            result = portal.connection_test_result(response.status_code, response.headers.get('content-type', ''))
+    except UPSTREAM_ERRORS as e:
+        result = {'status': 'Error', 'message': f'Connection failed: {str(e)}'}
+    result['elapsed_ms'] = round((time.monotonic() - started) * 1000)
+    return result
+
+
+def _events_since(request):
+    """Return the last event version the client has seen."""
+    return portal.event_broker.parse_cursor(request.headers.get('Last-Event-ID') or request.args.get('since'))
+
+
+async def events(request):
+    """Push service status and data changes to dashboards as Server-Sent Events."""
+    portal.start_background_tasks()
+    since = _events_since(request)
+
+    async def stream():
+        version = since
+        yield b'retry: 5000\n\n'
+        while True:
+            version, changes = await portal.event_broker.wait_for_changes(version, timeout=portal.EVENTS_KEEPALIVE)
+            if not changes:
+                yield b': keep-alive\n\n'
+                continue
+            for change in changes:
+                yield f"id: {portal.event_broker.cursor(version)}\nevent: service\ndata: {json.dumps(change)}\n\n".encode('utf-8')
+
+    return StreamingResponse(stream(), headers={
+        'Content-Type': 'text/event-stream',
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+
+async def events_poll(request):
+    """Long-poll fallback for /events for clients without EventSource."""
+    portal.start_background_tasks()
+    since = _events_since(request)
+    version, changes = await portal.event_broker.wait_for_changes(since, timeout=portal.EVENTS_LONG_POLL_TIMEOUT)
+    return json_response({'version': portal.event_broker.cursor(version), 'events': changes})
+
+
+# Routes served asynchronously, everything else goes to the Flask app
+url_map = Map([
+    Rule('/', endpoint=index),
+    Rule('/refresh-service-data', endpoint=refresh_service_data),
+    Rule('/iframe/<service_name>', endpoint=iframe_content),
+    Rule('/iframe/<service_name>/data', endpoint=iframe_data),
+    Rule('/test-connection', endpoint=test_connection, methods=['POST']),
+    Rule('/test-connections', endpoint=test_connections, methods=['POST']),
+    Rule('/events', endpoint=events),
+    Rule('/events/poll', endpoint=events_poll),
+])
+
+
+def build_environ(scope, body):
+    """Build a WSGI environ from an ASGI scope so werkzeug can parse the request."""
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': io.StringIO(),
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            environ[name] = value
+            continue
+        key = f'HTTP_{name}'
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+
+async def _read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+
+async def _send_streaming(response, receive, send):
+    """Send a streaming response, stopping as soon as the client disconnects."""
+    async def wait_for_disconnect():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    headers = [(name.lower().encode('latin-1'), str(value).encode('latin-1')) for name, value in response.headers.items()]
+    disconnected = asyncio.ensure_future(wait_for_disconnect())
+    try:
+        await send({'type': 'http.response.start', 'status': response.status, 'headers': headers})
+        async for chunk in response.body:
+            if disconnected.done():
+                break
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        disconnected.cancel()
+        await response.body.aclose()
+        if response.on_close:
+            await response.on_close()
+
+
+def record_streaming_request(route, method, response, started):
+    """Count a streamed request, see app.record_request()."""
+    metrics = portal.metrics
+    if not metrics.enabled:
+        return
+    metrics.inc('portal_requests_total', route=route, method=method, status=response.status)
+    metrics.observe('portal_request_seconds', time.perf_counter() - started, route=route)
+    if portal.SERVER_TIMING:
+        timing = metrics.server_timing()
+        if timing:
+            response.headers['Server-Timing'] = timing
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            portal.start_background_tasks()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await http.aclose()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    """ASGI application serving the portal."""
+    if scope['type'] == 'lifespan':
+        return await _lifespan(receive, send)
+
+    try:
+        rule, values = url_map.bind('localhost').match(scope['path'], method=scope['method'], return_rule=True)
+    except HTTPException:
+        # Not an async route, let Flask handle it (including 404 and 405)
+        return await flask_app(scope, receive, send)
+
+    started = time.perf_counter()
+    portal.metrics.start_request()
+    environ = build_environ(scope, await _read_body(receive))
+    request = Request(environ)
+    try:
+        response = await rule.endpoint(request, **values)
+    except Exception as e:
+        print(f"Error handling {scope['path']}: {e}")
+        response = Response('Internal Server Error', status=500)
+
+    if isinstance(response, StreamingResponse):
+        # Only the time until the stream starts is known here
+        record_streaming_request(rule.rule, scope['method'], response, started)
+        return await _send_streaming(response, receive, send)
+
+    # Compressing a large body takes a while, other requests keep being served meanwhile
+    await asyncio.to_thread(portal.compressor.compress_response, request, response)
+    portal.record_request(rule.rule, scope['method'], response, started)
+
+    headers = [
+        (name.lower().encode('latin-1'), value.encode('latin-1'))
+        for name, value in response.get_wsgi_headers(environ).items()
+    ]
+    body = b'' if scope['method'] == 'HEAD' else response.get_data()
+    await send({'type': 'http.response.start', 'status': response.status_code, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': body})
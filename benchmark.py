@@ -0,0 +1,296 @@
+"""Offline benchmark of the portal against a farm of simulated upstreams.
+
+Starts the sample service from external_service.py as the upstream farm, runs
+the portal in a separate process with a config pointing at it, and drives the
+dashboard, iframe and refresh routes at a fixed concurrency. Latency
+percentiles, throughput, upstream calls and the portal's memory are printed and
+saved as JSON, which a later run can be compared against:
+
+    python benchmark.py --output baseline.json
+    python benchmark.py --baseline baseline.json
+
+The comparison exits with status 1 when a scenario got worse than the
+tolerance allows.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from urllib.parse import quote, urlencode
+
+import httpx
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+import external_service
+
+# Simulated upstreams by service name, as /api/sim query parameters
+PROFILES = {
+    'json-fast': {'latency': 5, 'size': 2000},
+    'json-slow': {'latency': 300, 'jitter': 100, 'size': 2000},
+    'json-large': {'latency': 20, 'size': 2000000},
+    'html-page': {'latency': 20, 'size': 50000, 'format': 'html'},
+    'flaky': {'latency': 20, 'error_rate': 0.3, 'size': 2000},
+    'slow-drip': {'size': 200000, 'drip': 1, 'chunks': 20}
+}
+
+# Commands starting the portal, {port} is replaced by a free port
+SERVERS = {
+    'asgi': [sys.executable, '-m', 'uvicorn', 'asgi:application', '--port', '{port}', '--log-level', 'warning'],
+    'flask': [sys.executable, '-m', 'flask', 'run', '--port', '{port}', '--with-threads']
+}
+
+SCENARIOS = ('dashboard', 'iframe', 'refresh')
+
+# Relative change in a metric that counts as a regression
+DEFAULT_TOLERANCE = 0.25
+
+# Latency changes below this many milliseconds are treated as noise
+LATENCY_NOISE_MS = 5
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    """Request handler that doesn't log every request of the farm."""
+
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+def start_farm():
+    """Serve the simulated upstreams on a free local port."""
+    server = make_server('127.0.0.1', 0, external_service.app, threaded=True, request_handler=QuietRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def write_config(path, farm_url, poll_interval):
+    """Write a portal config with one service per profile."""
+    services = [
+        {'name': name, 'url': f'{farm_url}/api/sim?{urlencode(params)}', 'poll_interval': poll_interval}
+        for name, params in PROFILES.items()
+    ]
+    with open(path, 'w') as f:
+        json.dump({'services': services}, f, indent=2)
+
+
+def start_portal(server, port, config_path, verbose=False):
+    """Start the portal in its own process and wait until it answers."""
+    command = [part.format(port=port) for part in SERVERS[server]]
+    env = dict(os.environ, CONFIG_FILE=config_path, FLASK_APP='app')
+    output = None if verbose else subprocess.DEVNULL
+    process = subprocess.Popen(
+        command, cwd=os.path.dirname(os.path.abspath(__file__)), env=env, stdout=output, stderr=output
+    )
+
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'Portal exited with status {process.returncode}, run with --verbose for its output')
+        try:
+            httpx.get(f'http://127.0.0.1:{port}/cache-stats', timeout=1)
+            return process
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError('Portal did not start within 30 seconds')
+
+
+def rss_bytes(pid):
+    """Return the resident memory of a process, or None where /proc is unavailable."""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def percentile(values, pct):
+    """Return the pct-th percentile of values by the nearest-rank method."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(math.ceil(pct / 100 * len(ordered)), 1)
+    return ordered[rank - 1]
+
+
+def scenario_paths(scenario):
+    """Return the portal paths a scenario requests, in turn."""
+    if scenario == 'dashboard':
+        return ['/']
+    if scenario == 'iframe':
+        return [f'/iframe/{quote(name, safe="")}' for name in PROFILES]
+    # Like the dashboard's refresh button, which skips the snapshot and the cache
+    return [f'/refresh-service-data?{urlencode({"name": name, "force": 1})}' for name in PROFILES]
+
+
+async def drive(base_url, paths, total, concurrency):
+    """Send total requests over paths with concurrency requests in flight.
+
+    Returns:
+        tuple: Latency in seconds of every request, number of failed
+            requests, and the wall time of the whole run
+    """
+    latencies = []
+    errors = 0
+    sent = 0
+
+    async def worker(client):
+        nonlocal errors, sent
+        while sent < total:
+            path = paths[sent % len(paths)]
+            sent += 1
+            start = time.perf_counter()
+            try:
+                response = await client.get(path)
+                await response.aread()
+                if response.status_code >= 400:
+                    errors += 1
+            except httpx.HTTPError:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+    return latencies, errors, elapsed
+
+
+def run_scenario(scenario, base_url, total, concurrency, portal_pid):
+    """Run one scenario and return its metrics."""
+    calls_before = external_service.request_counts['total']
+    latencies, errors, elapsed = asyncio.run(drive(base_url, scenario_paths(scenario), total, concurrency))
+    upstream_calls = external_service.request_counts['total'] - calls_before
+
+    def ms(value):
+        return round(value * 1000, 2) if value is not None else None
+
+    return {
+        'requests': len(latencies),
+        'concurrency': concurrency,
+        'errors': errors,
+        'p50_ms': ms(percentile(latencies, 50)),
+        'p95_ms': ms(percentile(latencies, 95)),
+        'p99_ms': ms(percentile(latencies, 99)),
+        'throughput_rps': round(len(latencies) / elapsed, 2) if elapsed else None,
+        'upstream_calls': upstream_calls,
+        'rss_bytes': rss_bytes(portal_pid)
+    }
+
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """Return a description of every metric that regressed against a baseline."""
+    regressions = []
+    for scenario, metrics in results['scenarios'].items():
+        before = baseline.get('scenarios', {}).get(scenario)
+        if not before:
+            continue
+        for metric in ('p50_ms', 'p95_ms', 'p99_ms', 'upstream_calls', 'rss_bytes', 'throughput_rps'):
+            old, new = before.get(metric), metrics.get(metric)
+            if old is None or new is None:
+                continue
+            if metric == 'throughput_rps':
+                worse = new < old * (1 - tolerance)
+            else:
+                worse = new > old * (1 + tolerance)
+                if metric.endswith('_ms'):
+                    worse = worse and new - old > LATENCY_NOISE_MS
+            if worse:
+                regressions.append(f'{scenario} {metric}: {old} -> {new}')
+    return regressions
+
+
+def print_results(results):
+    header = f"{'scenario':<10} {'reqs':>6} {'errors':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'req/s':>8} {'upstream':>9} {'rss MB':>7}"
+    print(header)
+    print('-' * len(header))
+    for scenario, m in results['scenarios'].items():
+        rss = f"{m['rss_bytes'] / 1024 / 1024:.1f}" if m['rss_bytes'] else '-'
+        print(
+            f"{scenario:<10} {m['requests']:>6} {m['errors']:>6} {m['p50_ms']:>9} {m['p95_ms']:>9} "
+            f"{m['p99_ms']:>9} {m['throughput_rps']:>8} {m['upstream_calls']:>9} {rss:>7}"
+        )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--server', choices=sorted(SERVERS), default='asgi', help='How to run the portal')
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument('--requests', type=int, default=200, help='Requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=16, help='Requests in flight at once')
+    parser.add_argument('--poll-interval', type=float, default=30, help='Background poll interval of the services')
+    parser.add_argument('--warmup', type=int, default=1, help='Unmeasured passes over each scenario first')
+    parser.add_argument('--output', default='benchmark_results.json', help='Where to save the results')
+    parser.add_argument('--baseline', help='Earlier results to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE, help='Allowed relative change')
+    parser.add_argument('--verbose', action='store_true', help="Show the portal's output")
+    args = parser.parse_args(argv)
+
+    farm = start_farm()
+    workdir = tempfile.mkdtemp(prefix='portal-benchmark-')
+    config_path = os.path.join(workdir, 'config.json')
+    write_config(config_path, f'http://127.0.0.1:{farm.port}', args.poll_interval)
+
+    port = free_port()
+    portal = start_portal(args.server, port, config_path, verbose=args.verbose)
+    base_url = f'http://127.0.0.1:{port}'
+    results = {
+        'created': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'settings': {
+            'server': args.server,
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+            'poll_interval': args.poll_interval,
+            'profiles': PROFILES
+        },
+        'scenarios': {}
+    }
+    try:
+        for scenario in args.scenarios:
+            paths = scenario_paths(scenario)
+            if args.warmup:
+                asyncio.run(drive(base_url, paths, len(paths) * args.warmup, args.concurrency))
+            results['scenarios'][scenario] = run_scenario(scenario, base_url, args.requests, args.concurrency, portal.pid)
+    finally:
+        portal.terminate()
+        portal.wait(timeout=10)
+        farm.shutdown()
+
+    print_results(results)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'\nResults saved to {args.output}')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print(f'\nRegressions against {args.baseline}:')
+            for regression in regressions:
+                print(f'  {regression}')
+            return 1
+        print(f'\nNo regressions against {args.baseline}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
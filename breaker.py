@@ -0,0 +1,147 @@
+import threading
+import time
+
+import requests
+
+
+class CircuitOpen(requests.exceptions.ConnectionError):
+    """Raised instead of contacting an upstream whose circuit is open."""
+
+
+class CircuitBreaker:
+    """Health state of one upstream, used to fail fast while it is down.
+
+    The circuit is closed while calls succeed. After failure_threshold
+    consecutive failures it opens and every call is refused at once with
+    the last error. Once reset_timeout has passed it half-opens and lets a
+    single trial call through: success closes the circuit, failure opens it
+    again with the reset timeout doubled, up to max_reset_timeout.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=3, reset_timeout=30, max_reset_timeout=300, clock=time.monotonic):
+        """Create a breaker.
+
+        Args:
+            failure_threshold (int): Consecutive failures that open the circuit
+            reset_timeout (float): Seconds the circuit stays open before a trial call
+            max_reset_timeout (float): Longest open period after repeated failed trials
+            clock (callable): Returns the current time in seconds
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._trips = 0
+        self._opened_at = None
+        self._trial_running = False
+        self._last_error = None
+        self._latency = None
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._current_state()
+
+    def allow(self):
+        """Check that a call may go to the upstream.
+
+        Raises:
+            CircuitOpen: The circuit is open, or a half-open trial is already running
+        """
+        with self._lock:
+            state = self._current_state()
+            if state == self.CLOSED:
+                return
+            if state == self.HALF_OPEN and not self._trial_running:
+                self._trial_running = True
+                return
+            raise CircuitOpen(f'{self._last_error} (circuit open, retrying in {self._retry_in():.0f}s)')
+
+    def record_success(self, latency):
+        """Record a successful call and close the circuit."""
+        with self._lock:
+            self._track_latency(latency)
+            self._state = self.CLOSED
+            self._failures = 0
+            self._trips = 0
+            self._opened_at = None
+            self._trial_running = False
+
+    def record_failure(self, error, latency):
+        """Record a failed call, opening the circuit at the threshold."""
+        with self._lock:
+            self._track_latency(latency)
+            self._failures += 1
+            self._last_error = str(error)
+            if self._trial_running or self._failures >= self.failure_threshold:
+                self._state = self.OPEN
+                self._opened_at = self._clock()
+                self._trips += 1
+            self._trial_running = False
+
+    def snapshot(self):
+        """Return the health state as a dict for display."""
+        with self._lock:
+            state = self._current_state()
+            return {
+                'state': state,
+                'failures': self._failures,
+                'last_error': self._last_error,
+                'latency_ms': round(self._latency * 1000) if self._latency is not None else None,
+                'retry_in': round(self._retry_in()) if state == self.OPEN else None
+            }
+
+    def _current_state(self):
+        if self._state == self.OPEN and self._retry_in() <= 0:
+            self._state = self.HALF_OPEN
+        return self._state
+
+    def _open_period(self):
+        return min(self.reset_timeout * 2 ** max(self._trips - 1, 0), max(self.max_reset_timeout, self.reset_timeout))
+
+    def _retry_in(self):
+        if self._opened_at is None:
+            return 0
+        return max(0.0, self._opened_at + self._open_period() - self._clock())
+
+    def _track_latency(self, latency):
+        # Exponentially weighted, recent calls count the most
+        self._latency = latency if self._latency is None else 0.8 * self._latency + 0.2 * latency
+
+
+class BreakerRegistry:
+    """One CircuitBreaker per upstream, created on first use."""
+
+    def __init__(self, **defaults):
+        """Create a registry.
+
+        Args:
+            **defaults: Arguments for every new CircuitBreaker
+        """
+        self.defaults = defaults
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, **settings):
+        """Return the breaker for key, applying any per-upstream settings."""
+        with self._lock:
+            breaker = self._breakers.get(key)
+            if breaker is None:
+                breaker = CircuitBreaker(**self.defaults)
+                self._breakers[key] = breaker
+        for name, value in settings.items():
+            setattr(breaker, name, value)
+        return breaker
+
+    def states(self):
+        """Return the health state of every known upstream by key."""
+        with self._lock:
+            breakers = dict(self._breakers)
+        return {key: breaker.snapshot() for key, breaker in breakers.items()}
@@ -0,0 +1,306 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+
+
+class CacheEntry:
+    """A cached value together with its size and freshness information."""
+
+    def __init__(self, value, size, ttl):
+        self.value = value
+        self.size = size
+        self.ttl = ttl
+        self.stored_at = time.monotonic()
+
+    def age(self):
+        """Seconds since the value was stored."""
+        return time.monotonic() - self.stored_at
+
+
+class ResponseCache:
+    """In-process LRU cache bounded by total bytes, with stale-while-revalidate.
+
+    Entries younger than their TTL are served as they are. Entries past their
+    TTL but within stale_ttl are still served, while a single background
+    refresh replaces them. Anything older is fetched again by the caller.
+    """
+
+    def __init__(self, max_bytes, stale_ttl=0, sizeof=len, cacheable=None):
+        """Create a cache.
+
+        Args:
+            max_bytes (int): Upper bound for the summed size of all entries
+            stale_ttl (float): Seconds an expired entry may still be served
+            sizeof (callable): Returns the size in bytes of a value
+            cacheable (callable): Returns False for values that must not be stored
+        """
+        self.max_bytes = max_bytes
+        self.stale_ttl = stale_ttl
+        self._sizeof = sizeof
+        self._cacheable = cacheable or (lambda value: True)
+        self._entries = OrderedDict()
+        self._size = 0
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self._counters = {
+            'hits': 0,
+            'stale_hits': 0,
+            'misses': 0,
+            'bypasses': 0,
+            'evictions': 0,
+            'refresh_errors': 0
+        }
+
+    def get_or_fetch(self, key, fetch, ttl, force=False):
+        """Return the value for key, calling fetch() when it is not cached.
+
+        Args:
+            key: Cache key, usually the upstream URL
+            fetch (callable): Produces a fresh value, may raise
+            ttl (float): Seconds a fresh value is served without refreshing
+            force (bool): Skip the cache and always call fetch()
+
+        Returns:
+            The cached or freshly fetched value
+        """
+        value, refresh = self.lookup(key, force=force)
+        if value is None:
+            return self._fetch_and_store(key, fetch, ttl)
+
+        if refresh:
+            threading.Thread(
+                target=self._refresh, args=(key, fetch, ttl), daemon=True,
+                name=f'cache-refresh-{key}'
+            ).start()
+        return value
+
+    def lookup(self, key, force=False):
+        """Look up key without fetching anything.
+
+        Returns:
+            tuple: (value, refresh). value is None when the caller must fetch.
+            refresh is True for a stale value: the caller should refresh it in
+            the background and call refresh_done(key) afterwards.
+        """
+        with self._lock:
+            if force:
+                self._counters['bypasses'] += 1
+                return None, False
+
+            entry = self._entries.get(key)
+            if entry:
+                age = entry.age()
+                if age < entry.ttl:
+                    self._entries.move_to_end(key)
+                    self._counters['hits'] += 1
+                    return entry.value, False
+
+                if age < entry.ttl + self.stale_ttl:
+                    self._entries.move_to_end(key)
+                    self._counters['stale_hits'] += 1
+                    refresh = key not in self._refreshing
+                    if refresh:
+                        self._refreshing.add(key)
+                    return entry.value, refresh
+
+            self._counters['misses'] += 1
+            return None, False
+
+    def peek(self, key):
+        """Return the stored value for key regardless of its age, or None.
+
+        Used to revalidate an expired value instead of fetching it again.
+        Doesn't count as a hit or change the LRU order.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry.value if entry else None
+
+    def refresh_done(self, key, error=None):
+        """Mark the background refresh of key as finished."""
+        with self._lock:
+            self._refreshing.discard(key)
+            if error:
+                self._counters['refresh_errors'] += 1
+
+    def put(self, key, value, ttl):
+        """Store a value, evicting least recently used entries to stay in budget."""
+        if ttl <= 0 or not self._cacheable(value):
+            return
+
+        size = self._sizeof(value)
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old:
+                self._size -= old.size
+
+            self._entries[key] = CacheEntry(value, size, ttl)
+            self._size += size
+
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= evicted.size
+                self._counters['evictions'] += 1
+
+    def invalidate(self, key):
+        """Drop the entry for key if there is one."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry:
+                self._size -= entry.size
+
+    def clear(self):
+        """Drop every entry and reset the counters."""
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+            for name in self._counters:
+                self._counters[name] = 0
+
+    def stats(self):
+        """Return hit/miss counters and the current size of the cache."""
+        with self._lock:
+            stats = dict(self._counters)
+            stats['entries'] = len(self._entries)
+            stats['bytes'] = self._size
+            stats['max_bytes'] = self.max_bytes
+        return stats
+
+    def _fetch_and_store(self, key, fetch, ttl):
+        value = fetch()
+        self.put(key, value, ttl)
+        return value
+
+    def _refresh(self, key, fetch, ttl):
+        """Replace a stale entry in the background, keeping it on failure."""
+        error = None
+        try:
+            self._fetch_and_store(key, fetch, ttl)
+        except Exception as e:
+            error = e
+            print(f"Error refreshing cache entry {key}: {e}")
+        finally:
+            self.refresh_done(key, error)
+
+
+class _Call:
+    """An in-flight call whose result is shared by every waiting caller."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Coalesce concurrent calls for the same key into a single call.
+
+    The first caller for a key runs the function. Callers arriving while it is
+    running wait for that call and receive the same result or exception,
+    instead of starting their own.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self._counters = {'calls': 0, 'shared': 0, 'wait_timeouts': 0}
+
+    def do(self, key, fn, timeout=None):
+        """Run fn() once for all concurrent callers with the same key.
+
+        Args:
+            key: Identifies identical calls, usually the upstream URL
+            fn (callable): The call to make
+            timeout (float): Seconds a waiting caller waits for the shared call
+
+        Raises:
+            TimeoutError: A waiting caller gave up before the shared call finished
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+                self._counters['calls'] += 1
+            else:
+                self._counters['shared'] += 1
+
+        if not leader:
+            if not call.done.wait(timeout):
+                with self._lock:
+                    self._counters['wait_timeouts'] += 1
+                raise TimeoutError(f'Timed out waiting for a shared request to {key}')
+            if call.error:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stats(self):
+        """Return how many calls were made and how many callers shared one."""
+        with self._lock:
+            stats = dict(self._counters)
+            stats['in_flight'] = len(self._calls)
+        return stats
+
+
+class AsyncSingleFlight:
+    """SingleFlight for coroutines running on one event loop.
+
+    The shared call runs as its own task, so it completes even if the caller
+    that started it goes away.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._counters = {'calls': 0, 'shared': 0, 'wait_timeouts': 0}
+
+    async def do(self, key, fn, timeout=None):
+        """Await fn() once for all concurrent callers with the same key.
+
+        Args:
+            key: Identifies identical calls, usually the upstream URL
+            fn (callable): Returns the coroutine to run
+            timeout (float): Seconds a waiting caller waits for the shared call
+
+        Raises:
+            TimeoutError: A waiting caller gave up before the shared call finished
+        """
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._calls[key] = task
+            self._counters['calls'] += 1
+            task.add_done_callback(lambda done: self._forget(key, done))
+            return await asyncio.shield(task)
+
+        self._counters['shared'] += 1
+        try:
+            return await asyncio.wait_for(asyncio.shield(task), timeout)
+        except asyncio.TimeoutError:
+            self._counters['wait_timeouts'] += 1
+            raise TimeoutError(f'Timed out waiting for a shared request to {key}')
+
+    def stats(self):
+        """Return how many calls were made and how many callers shared one."""
+        stats = dict(self._counters)
+        stats['in_flight'] = len(self._calls)
+        return stats
+
+    def _forget(self, key, task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
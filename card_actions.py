@@ -0,0 +1,124 @@
+import queue
+import sys
+import threading
+
+
+class ActionLog:
+    """Log lines sent by card actions, written in bulk by a background thread.
+
+    submit() only puts lines on a bounded queue, so request threads never
+    wait for the log to be written. The writer takes everything queued, up
+    to batch_size lines, and writes it with a single call. Lines arriving
+    while the queue is full are dropped and counted.
+    """
+
+    def __init__(self, path=None, max_queued=10000, batch_size=500):
+        """Create a log.
+
+        Args:
+            path (str): File the lines are appended to, None for standard output
+            max_queued (int): Lines waiting to be written before new ones are dropped
+            batch_size (int): Most lines written at once
+        """
+        self.path = path
+        self.batch_size = batch_size
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._condition = threading.Condition()
+        self._submitted = 0
+        self._written = 0
+        self._dropped = 0
+        self._errors = 0
+        self._batches = 0
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def submit(self, lines):
+        """Queue lines to be written, without waiting for them.
+
+        Returns:
+            int: Number of lines queued, the rest were dropped
+        """
+        self._start()
+        queued = 0
+        for line in lines:
+            try:
+                self._queue.put_nowait(line)
+                queued += 1
+            except queue.Full:
+                break
+        with self._condition:
+            self._submitted += queued
+            self._dropped += len(lines) - queued
+        return queued
+
+    def flush(self, timeout=None):
+        """Wait until every line submitted so far has been written.
+
+        Returns:
+            bool: Whether they were written within the timeout
+        """
+        with self._condition:
+            target = self._submitted
+            return self._condition.wait_for(lambda: self._written >= target, timeout)
+
+    def close(self, timeout=5):
+        """Write what is still queued and stop the writer."""
+        self.flush(timeout)
+        self._stopped.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def stats(self):
+        """Return the queue length and line counters."""
+        with self._condition:
+            return {
+                'queued': self._queue.qsize(),
+                'written': self._written - self._errors,
+                'dropped': self._dropped,
+                'write_errors': self._errors,
+                'batches': self._batches
+            }
+
+    def _start(self):
+        if self._thread is not None:
+            return
+        with self._condition:
+            if self._thread is None:
+                self._stopped.clear()
+                self._thread = threading.Thread(target=self._run, name='card-action-log', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                batch = [self._queue.get(timeout=0.5)]
+            except queue.Empty:
+                continue
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            failed = False
+            try:
+                self._write(batch)
+            except OSError as e:
+                failed = True
+                print(f'Error writing {len(batch)} card action log lines: {e}')
+            with self._condition:
+                self._written += len(batch)
+                self._batches += 1
+                if failed:
+                    self._errors += len(batch)
+                self._condition.notify_all()
+
+    def _write(self, lines):
+        text = ''.join(f'{line}\n' for line in lines)
+        if self.path:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(text)
+        else:
+            sys.stdout.write(text)
+            sys.stdout.flush()
@@ -0,0 +1,151 @@
+import gzip
+import hashlib
+import zlib
+
+try:
+    import brotli
+except ImportError:  # Brotli is optional, gzip is always available
+    brotli = None
+
+from cache import ResponseCache
+
+# Media types worth compressing, anything starting with text/ is too
+COMPRESSIBLE_TYPES = (
+    'application/json',
+    'application/javascript',
+    'application/xml',
+    'image/svg+xml'
+)
+
+
+def is_compressible(mimetype):
+    """Return whether a media type is text that compresses well."""
+    mimetype = (mimetype or '').lower()
+    return mimetype.startswith('text/') or mimetype in COMPRESSIBLE_TYPES
+
+
+class ResponseCompressor:
+    """Negotiated gzip/brotli compression of response bodies.
+
+    Compressed bodies are cached by a hash of their content, so identical
+    bodies (the same dashboard, asset or iframe page) are only compressed
+    once per encoding.
+    """
+
+    def __init__(self, min_bytes=1024, gzip_level=6, brotli_quality=5, cache_bytes=16 * 1024 * 1024,
+                 cache_ttl=3600):
+        """Create a compressor.
+
+        Args:
+            min_bytes (int): Smaller bodies are sent uncompressed
+            gzip_level (int): gzip compression level, 1-9
+            brotli_quality (int): Brotli quality, 0-11
+            cache_bytes (int): Upper bound for the compressed bodies kept for reuse
+            cache_ttl (float): Seconds a compressed body is kept
+        """
+        self.min_bytes = min_bytes
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.cache_ttl = cache_ttl
+        self.cache = ResponseCache(max_bytes=cache_bytes)
+
+    @property
+    def encodings(self):
+        """Supported encodings, most preferred first."""
+        return ('br', 'gzip') if brotli else ('gzip',)
+
+    def negotiate(self, request):
+        """Return the best encoding the client accepts, or None.
+
+        Args:
+            request: A Flask or werkzeug request
+        """
+        accepted = request.accept_encodings
+        for encoding in self.encodings:
+            if accepted[encoding]:
+                return encoding
+        return None
+
+    def compress(self, body, encoding):
+        """Return body compressed with encoding, reusing an earlier result for the same body."""
+        key = (hashlib.sha1(body).hexdigest(), encoding)
+        return self.cache.get_or_fetch(key, lambda: self._compress(body, encoding), self.cache_ttl)
+
+    def precompress(self, body):
+        """Return body compressed with every supported encoding, empty if it is too small."""
+        if len(body) < self.min_bytes:
+            return {}
+        return {encoding: self._compress(body, encoding) for encoding in self.encodings}
+
+    def compress_response(self, request, response):
+        """Compress a response in place if the client and the body allow it.
+
+        Streamed, already encoded, small and non-text responses are left alone.
+        """
+        if not is_compressible(response.mimetype):
+            return response
+        response.vary.add('Accept-Encoding')
+
+        if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+                or 'Content-Encoding' in response.headers):
+            return response
+
+        encoding = self.negotiate(request)
+        body = response.get_data()
+        if not encoding or len(body) < self.min_bytes:
+            return response
+
+        response.set_data(self.compress(body, encoding))
+        response.headers['Content-Encoding'] = encoding
+        # The compressed body is a different representation of the same content
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+        return response
+
+    def stream_encoder(self, encoding):
+        """Return an encoder for a body sent in chunks, see compress_stream()."""
+        if encoding == 'br':
+            return _BrotliStream(self.brotli_quality)
+        return _GzipStream(self.gzip_level)
+
+    def compress_stream(self, chunks, encoding):
+        """Compress an iterable of byte chunks.
+
+        Every chunk is flushed, so the client can show it before the rest arrives.
+        """
+        encoder = self.stream_encoder(encoding)
+        for chunk in chunks:
+            yield encoder.compress(chunk)
+        yield encoder.finish()
+
+    def _compress(self, body, encoding):
+        if encoding == 'br':
+            return brotli.compress(body, quality=self.brotli_quality)
+        return gzip.compress(body, compresslevel=self.gzip_level)
+
+
+class _GzipStream:
+    """gzip encoder that flushes after every chunk."""
+
+    def __init__(self, level):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, chunk):
+        return self._compressor.compress(chunk) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+class _BrotliStream:
+    """Brotli encoder that flushes after every chunk."""
+
+    def __init__(self, quality):
+        self._compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, chunk):
+        return self._compressor.process(chunk) + self._compressor.flush()
+
+    def finish(self):
+        return self._compressor.finish()
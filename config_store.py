@@ -0,0 +1,142 @@
+import copy
+import json
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows, fall back to in-process locking only
+    fcntl = None
+
+
+def service_id(name):
+    """Return the sanitised id of a service name, as used by the dashboard cards."""
+    return name.lower().replace(' ', '_')
+
+
+class ConfigStore:
+    """The parsed config file, held in memory and indexed by service name and id.
+
+    The file is only read again when its mtime, inode or size changes, so a
+    lookup normally costs one stat() call. Writes go to a temporary file that
+    is renamed over the original, under an exclusive lock file so several
+    worker processes can update the config safely.
+
+    The returned config is shared between requests and must be treated as
+    read-only. Use update() to change it.
+    """
+
+    def __init__(self, path, default=None):
+        self.path = path
+        self.default = default or {'services': []}
+        self._lock = threading.RLock()
+        self._signature = None
+        self._config = copy.deepcopy(self.default)
+        self._by_name = {}
+        self._by_id = {}
+
+    def get(self):
+        """Return the current config, reloading it if the file has changed."""
+        signature = self._stat()
+        if signature != self._signature:
+            with self._lock:
+                if signature != self._signature:
+                    self._load(signature)
+        return self._config
+
+    def services(self):
+        """Return the list of configured services."""
+        return self.get().get('services', [])
+
+    def service_by_name(self, name):
+        """Return the service with the given name, or None."""
+        self.get()
+        return self._by_name.get(name)
+
+    def service_by_id(self, sanitised_id):
+        """Return the service whose sanitised name matches, or None."""
+        self.get()
+        return self._by_id.get(sanitised_id)
+
+    def update(self, change):
+        """Apply change() to a fresh copy of the config and save the result.
+
+        The file is re-read and written under the same lock, so concurrent
+        updates from other processes are not lost.
+
+        Args:
+            change (callable): Receives a copy of the config and modifies it in place
+
+        Returns:
+            dict: The saved config
+        """
+        with self._file_lock():
+            signature = self._stat()
+            self._load(signature)
+            config = copy.deepcopy(self._config)
+            change(config)
+            self._write(config)
+            return config
+
+    def _stat(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_ino, stat.st_size)
+
+    def _load(self, signature):
+        if signature is None:
+            config = copy.deepcopy(self.default)
+        else:
+            with open(self.path, 'r') as f:
+                config = json.load(f)
+        self._set(config, signature)
+
+    def _set(self, config, signature):
+        services = config.get('services', [])
+        self._by_name = {s['name']: s for s in services}
+        self._by_id = {service_id(s['name']): s for s in services}
+        self._config = config
+        self._signature = signature
+
+    def _write(self, config):
+        """Write the config atomically and make it the current in-memory copy."""
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.config.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(config, f, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            try:
+                os.replace(temp_path, self.path)
+            except OSError:
+                # A file bind-mounted into a container can't be replaced, rewrite it in place
+                with open(self.path, 'w') as f:
+                    json.dump(config, f, indent=2)
+                os.remove(temp_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+        with self._lock:
+            self._set(copy.deepcopy(config), self._stat())
+
+    @contextmanager
+    def _file_lock(self):
+        """Hold an exclusive lock shared by every process using this config file."""
+        with self._lock:
+            if fcntl is None:
+                yield
+                return
+
+            with open(self.path + '.lock', 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
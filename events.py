@@ -0,0 +1,180 @@
+import asyncio
+import hashlib
+import json
+import secrets
+import threading
+
+
+def fingerprint(data):
+    """Return a short hash identifying the content of a service's data."""
+    if data is None:
+        return None
+    if isinstance(data, str):
+        encoded = data.encode('utf-8', errors='replace')
+    else:
+        encoded = json.dumps(data, sort_keys=True, default=str).encode('utf-8')
+    return hashlib.sha1(encoded).hexdigest()
+
+
+class EventBroker:
+    """Latest change of every service, versioned so clients can catch up.
+
+    Every change that alters a service's status or data bumps a global
+    version. Clients remember the last version they have seen and ask for
+    everything newer, so a slow client simply receives the newest state of
+    each service instead of a backlog, and no per-client queues are needed.
+
+    Versions only mean something to the broker that counted them, and every
+    worker process has its own. Clients therefore get a cursor that names the
+    broker's epoch along with the version, and a cursor from another epoch,
+    such as another worker or a restarted one, starts over from version 0
+    so the client receives the full current state.
+    """
+
+    def __init__(self, max_data_bytes=None):
+        """Create a broker.
+
+        Args:
+            max_data_bytes (int): Largest JSON data sent along with an event.
+                Larger data is only flagged as changed. None sends any size.
+        """
+        self.max_data_bytes = max_data_bytes
+        self.epoch = secrets.token_hex(4)
+        self._condition = threading.Condition()
+        self._version = 0
+        self._latest = {}
+        # Event set on the next publish, per event loop with coroutines waiting
+        self._loop_events = {}
+
+    @property
+    def version(self):
+        """The version of the newest change."""
+        with self._condition:
+            return self._version
+
+    def cursor(self, version=None):
+        """Return the cursor a client passes back to continue after version, the newest by default."""
+        if version is None:
+            version = self.version
+        return f'{self.epoch}-{version}'
+
+    def parse_cursor(self, cursor):
+        """Return the version a client's cursor continues from.
+
+        Cursors from another epoch, malformed ones and versions this broker
+        has not reached yet all return 0, so the client is sent everything.
+        """
+        epoch, _, version = str(cursor or '').partition('-')
+        if epoch != self.epoch:
+            return 0
+        try:
+            version = int(version)
+        except ValueError:
+            return 0
+        return version if 0 <= version <= self.version else 0
+
+    def publish(self, result):
+        """Record the latest result of a service, waking clients if it changed.
+
+        Returns:
+            bool: True when the status or data differs from the previous result
+        """
+        name = result['name']
+        data_hash = result.get('data_hash') or fingerprint(result.get('data'))
+        with self._condition:
+            previous = self._latest.get(name)
+            if previous and previous['status'] == result['status'] and previous['data_hash'] == data_hash:
+                return False
+
+            self._version += 1
+            data_changed = not previous or previous['data_hash'] != data_hash
+            self._latest[name] = {
+                'name': name,
+                'status': result['status'],
+                'data': result.get('data'),
+                'data_hash': data_hash,
+                'inline': self._fits_inline(result.get('data')) if data_changed else previous['inline'],
+                'version': self._version,
+                'data_version': self._version if data_changed else previous['data_version']
+            }
+            self._condition.notify_all()
+            self._wake_loops()
+            return True
+
+    def remove(self, name):
+        """Forget the latest result of a service that no longer exists."""
+        with self._condition:
+            self._latest.pop(name, None)
+
+    def changes_since(self, since, timeout=None):
+        """Wait until there are changes newer than since and return them.
+
+        Args:
+            since (int): The last version the client has seen
+            timeout (float): Seconds to wait for a change
+
+        Returns:
+            tuple: The newest version and a list of change events, empty on timeout
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self._version > since, timeout=timeout)
+            return self._changes(since)
+
+    async def wait_for_changes(self, since, timeout=None):
+        """Wait for changes newer than since without blocking the event loop, see changes_since()."""
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while True:
+            with self._condition:
+                if self._version > since:
+                    return self._changes(since)
+                event = self._loop_events.get(loop)
+                if event is None:
+                    event = self._loop_events[loop] = asyncio.Event()
+            remaining = None if deadline is None else deadline - loop.time()
+            try:
+                await asyncio.wait_for(event.wait(), remaining)
+            except TimeoutError:
+                with self._condition:
+                    return self._changes(since)
+
+    def _changes(self, since):
+        changes = [
+            self._client_event(event, since)
+            for event in self._latest.values() if event['version'] > since
+        ]
+        return self._version, changes
+
+    def _wake_loops(self):
+        """Wake the coroutines waiting in wait_for_changes(), from whichever thread published."""
+        for loop, event in self._loop_events.items():
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                # The loop was closed while nothing was waiting on it any more
+                pass
+        self._loop_events.clear()
+
+    def _client_event(self, event, since):
+        """Build the event sent to a client that has seen everything up to since.
+
+        JSON data is included when it changed and is small enough, so the card
+        can update in place. Other content is only flagged as changed, the
+        iframe reloads it.
+        """
+        payload = {
+            'name': event['name'],
+            'status': event['status'],
+            'version': event['version'],
+            'data_changed': event['data_version'] > since
+        }
+        if payload['data_changed'] and event['inline']:
+            payload['data'] = event['data']
+        return payload
+
+    def _fits_inline(self, data):
+        if not isinstance(data, (dict, list)):
+            return False
+        if self.max_data_bytes is None:
+            return True
+        return len(json.dumps(data, default=str)) <= self.max_data_bytes
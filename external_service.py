@@ -1,9 +1,26 @@
-from flask import Flask, jsonify
+from flask import Flask, jsonify, request, Response
+import json
 import random
+import threading
+import time
+from collections import Counter
 from datetime import datetime
 
 app = Flask(__name__)
 
+# Requests served per endpoint, reported by /api/stats
+request_counts = Counter()
+_counts_lock = threading.Lock()
+
+# Largest body /api/sim generates, in bytes
+SIM_MAX_SIZE = 50 * 1024 * 1024
+
+@app.before_request
+def count_request():
+    with _counts_lock:
+        request_counts[request.path] += 1
+        request_counts['total'] += 1
+
 @app.route('/api/data')
 def get_data():
     """Simple API endpoint that returns random data."""
@@ -23,5 +40,80 @@ def health_check():
         'version': '1.0.0'
     })
 
+@app.route('/api/sim')
+def simulate():
+    """Simulated upstream with tunable behaviour, used by benchmark.py.
+
+    Query parameters:
+        latency: Milliseconds to wait before answering (default 0)
+        jitter: Random extra milliseconds, up to this many (default 0)
+        error_rate: Fraction of requests answered with a 503 (default 0)
+        size: Approximate body size in bytes (default 200)
+        format: json or html (default json)
+        drip: Seconds over which the body is sent in chunks (default 0)
+        chunks: Number of chunks for drip (default 10)
+    """
+    latency = request.args.get('latency', 0, type=float) + random.uniform(0, request.args.get('jitter', 0, type=float))
+    time.sleep(latency / 1000)
+
+    if random.random() < request.args.get('error_rate', 0, type=float):
+        return jsonify({'status': 'error', 'message': 'Simulated failure'}), 503
+
+    size = min(request.args.get('size', 200, type=int), SIM_MAX_SIZE)
+    if request.args.get('format', 'json') == 'html':
+        body, mimetype = _sim_html(size), 'text/html'
+    else:
+        body, mimetype = _sim_json(size), 'application/json'
+
+    drip = request.args.get('drip', 0, type=float)
+    if drip <= 0:
+        return Response(body, mimetype=mimetype)
+
+    chunks = max(request.args.get('chunks', 10, type=int), 1)
+    step = -(-len(body) // chunks)
+
+    def generate():
+        for start in range(0, len(body), step):
+            yield body[start:start + step]
+            time.sleep(drip / chunks)
+
+    return Response(generate(), mimetype=mimetype)
+
+@app.route('/api/stats')
+def stats():
+    """Requests served per endpoint since the last reset."""
+    with _counts_lock:
+        counts = dict(request_counts)
+    if request.args.get('reset'):
+        reset_stats()
+    return jsonify(counts)
+
+def reset_stats():
+    """Forget all counted requests."""
+    with _counts_lock:
+        request_counts.clear()
+
+def _sim_json(size):
+    items = []
+    length = 0
+    while length < size:
+        item = json.dumps({'id': len(items), 'value': random.randint(1, 100), 'label': f'item {len(items)}'})
+        items.append(item)
+        length += len(item) + 2
+    return '{"items": [' + ', '.join(items) + ']}'
+
+def _sim_html(size):
+    rows = []
+    length = 0
+    while length < size:
+        row = f'<tr><td><a href="/api/sim?id={len(rows)}">Item {len(rows)}</a></td><td>{random.randint(1, 100)}</td></tr>'
+        rows.append(row)
+        length += len(row)
+    return (
+        '<!DOCTYPE html><html><head><title>Simulated service</title>'
+        '<link rel="stylesheet" href="/static/style.css"></head>'
+        f'<body><h1>Simulated service</h1><table>{"".join(rows)}</table></body></html>'
+    )
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5001, debug=True) 
\ No newline at end of file
+    app.run(host='0.0.0.0', port=5001, debug=True)
@@ -0,0 +1,18 @@
+import multiprocessing
+import os
+
+# Production server settings, used by the Docker image:
+#
+#     gunicorn -c gunicorn.conf.py asgi:application
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+
+# Each worker runs an event loop, so a few workers handle many slow upstreams.
+# Every worker polls the services itself, keep the count low.
+workers = int(os.environ.get('WEB_CONCURRENCY', min(multiprocessing.cpu_count(), 4)))
+worker_class = 'uvicorn.workers.UvicornWorker'
+
+# Event streams stay open, the keep-alive comments keep them from timing out
+timeout = 60
+graceful_timeout = 10
+keepalive = 5
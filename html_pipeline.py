@@ -0,0 +1,274 @@
+import html
+import re
+from contextlib import nullcontext
+from html.parser import HTMLParser
+
+from bs4 import BeautifulSoup
+
+# Elements whose content is raw text rather than markup
+RAW_TEXT_ELEMENTS = ('script', 'style')
+
+# Attributes that hold one or more URLs
+URL_ATTRIBUTES = frozenset(['href', 'src', 'srcset', 'action', 'formaction', 'poster', 'data'])
+
+# Scheme and host (with port) of an absolute URL
+ORIGIN_PATTERN = re.compile(r'[a-zA-Z][a-zA-Z0-9+.-]*://[^/?#\s"\'()<>,;]+')
+
+
+class UrlRewriter:
+    """Compiled index of external to internal URL mappings.
+
+    Mappings are grouped by origin (scheme and host), so rewriting a value
+    costs one scan for origins plus a dict lookup for each one found,
+    however many mappings there are. Mappings with a path are tried
+    longest first within their origin.
+    """
+
+    def __init__(self, mappings):
+        self._by_origin = {}
+        self._other = []
+        for external_url, internal_url in mappings.items():
+            match = ORIGIN_PATTERN.match(external_url)
+            if match:
+                self._by_origin.setdefault(match.group(0), []).append((external_url, internal_url))
+            else:
+                # Not an absolute URL, fall back to a plain substring replace
+                self._other.append((external_url, internal_url))
+
+        for candidates in self._by_origin.values():
+            candidates.sort(key=lambda mapping: len(mapping[0]), reverse=True)
+
+    def rewrite(self, value):
+        """Return value with every mapped external URL replaced by its internal URL."""
+        if self._by_origin and '://' in value:
+            value = self._rewrite_origins(value)
+        for external_url, internal_url in self._other:
+            if external_url in value:
+                value = value.replace(external_url, internal_url)
+        return value
+
+    def _rewrite_origins(self, value):
+        parts = []
+        position = 0
+        for match in ORIGIN_PATTERN.finditer(value):
+            candidates = self._by_origin.get(match.group(0))
+            if not candidates or match.start() < position:
+                continue
+
+            for external_url, internal_url in candidates:
+                if value.startswith(external_url, match.start()):
+                    parts.append(value[position:match.start()])
+                    parts.append(internal_url)
+                    position = match.start() + len(external_url)
+                    break
+
+        if not parts:
+            return value
+        parts.append(value[position:])
+        return ''.join(parts)
+
+
+class HtmlTransform:
+    """A rewrite step applied to every element while an HTML document is walked.
+
+    start_tag receives the tag name and its attributes as a dict, which it may
+    modify in place. element_text receives the text of script and style
+    elements and returns the text to use instead.
+    """
+
+    def start_tag(self, tag, attrs):
+        pass
+
+    def element_text(self, tag, text):
+        return text
+
+
+class DeferExternalScripts(HtmlTransform):
+    """Add defer to external scripts so they load properly in an iframe."""
+
+    def start_tag(self, tag, attrs):
+        if tag == 'script' and attrs.get('src'):
+            attrs['defer'] = 'defer'
+
+
+class NeutraliseDocumentWrite(HtmlTransform):
+    """Comment out document.write calls, which break iframe rendering."""
+
+    def element_text(self, tag, text):
+        if tag != 'script':
+            return text
+        return text.replace('document.write', '// document.write')
+
+
+class RewriteUrls(HtmlTransform):
+    """Point URLs in attributes, inline CSS and meta refresh at internal URLs."""
+
+    def __init__(self, rewriter):
+        self.rewriter = rewriter
+
+    def start_tag(self, tag, attrs):
+        for name, value in attrs.items():
+            if not value or not isinstance(value, str):
+                continue
+            if name in URL_ATTRIBUTES or name == 'style' or (
+                tag == 'meta' and name == 'content' and
+                str(attrs.get('http-equiv', '')).lower() == 'refresh'
+            ):
+                attrs[name] = self.rewriter.rewrite(value)
+
+    def element_text(self, tag, text):
+        if tag != 'style':
+            return text
+        return self.rewriter.rewrite(text)
+
+
+def _no_timer(phase):
+    return nullcontext()
+
+
+def _rewrite_with_soup(document, transforms, timer=_no_timer):
+    """Parse the document once with BeautifulSoup and apply every transform."""
+    with timer('html_parse'):
+        soup = BeautifulSoup(document, 'html.parser')
+
+    with timer('html_rewrite'):
+        for element in soup.find_all(True):
+            for transform in transforms:
+                transform.start_tag(element.name, element.attrs)
+
+            if element.name in RAW_TEXT_ELEMENTS and element.string:
+                text = element.string
+                for transform in transforms:
+                    text = transform.element_text(element.name, text)
+                if text != element.string:
+                    element.string = text
+
+        return str(soup)
+
+
+class _TokenRewriter(HTMLParser):
+    """Re-emit an HTML document token by token, applying transforms on the way.
+
+    Markup that no transform touches is copied through unchanged, so no tree
+    is ever built and the output stays as close to the input as possible.
+    """
+
+    def __init__(self, transforms):
+        super().__init__(convert_charrefs=False)
+        self.transforms = transforms
+        self.output = []
+        self._raw_text_tag = None
+        self._raw_text = []
+
+    def handle_starttag(self, tag, attrs):
+        self._start_tag(tag, attrs, self_closing=False)
+        if tag in RAW_TEXT_ELEMENTS:
+            self._raw_text_tag = tag
+            self._raw_text = []
+
+    def handle_startendtag(self, tag, attrs):
+        self._start_tag(tag, attrs, self_closing=True)
+
+    def handle_endtag(self, tag):
+        if tag == self._raw_text_tag:
+            self._flush_raw_text()
+        self.output.append(f'</{tag}>')
+
+    def handle_data(self, data):
+        if self._raw_text_tag:
+            self._raw_text.append(data)
+        else:
+            self.output.append(data)
+
+    def handle_entityref(self, name):
+        self.output.append(f'&{name};')
+
+    def handle_charref(self, name):
+        self.output.append(f'&#{name};')
+
+    def handle_comment(self, data):
+        self.output.append(f'<!--{data}-->')
+
+    def handle_decl(self, decl):
+        self.output.append(f'<!{decl}>')
+
+    def handle_pi(self, data):
+        self.output.append(f'<?{data}>')
+
+    def unknown_decl(self, data):
+        self.output.append(f'<![{data}]>')
+
+    def close(self):
+        super().close()
+        if self._raw_text_tag:
+            self._flush_raw_text()
+        return ''.join(self.output)
+
+    def _start_tag(self, tag, attrs, self_closing):
+        original = dict(attrs)
+        updated = dict(attrs)
+        for transform in self.transforms:
+            transform.start_tag(tag, updated)
+
+        if updated == original:
+            self.output.append(self.get_starttag_text())
+            return
+
+        parts = [tag]
+        for name, value in updated.items():
+            if value is None:
+                parts.append(name)
+            else:
+                parts.append(f'{name}="{html.escape(value, quote=True)}"')
+        self.output.append(f"<{' '.join(parts)}{'/' if self_closing else ''}>")
+
+    def _flush_raw_text(self):
+        text = ''.join(self._raw_text)
+        for transform in self.transforms:
+            text = transform.element_text(self._raw_text_tag, text)
+        self.output.append(text)
+        self._raw_text_tag = None
+        self._raw_text = []
+
+
+def _rewrite_with_tokens(document, transforms, timer=_no_timer):
+    """Stream the document through html.parser without building a tree."""
+    # Parsing and rewriting are one pass here
+    with timer('html_rewrite'):
+        rewriter = _TokenRewriter(transforms)
+        rewriter.feed(document)
+        return rewriter.close()
+
+
+# Available rewriting backends by name. "soup" matches the output of the
+# previous BeautifulSoup processing exactly and is the default. "stream" avoids
+# building a document tree and keeps untouched markup as it was, so its output
+# is the same document but not the same text: attribute order, entities like
+# &nbsp;, boolean attributes and void tags are left as the upstream wrote them.
+BACKENDS = {
+    'soup': _rewrite_with_soup,
+    'stream': _rewrite_with_tokens
+}
+
+
+class HtmlPipeline:
+    """A list of transforms applied to HTML documents in a single pass."""
+
+    def __init__(self, transforms, backend='soup', timer=None):
+        """Create a pipeline.
+
+        Args:
+            transforms (list): Transforms applied to every document
+            backend (str): Name of the backend in BACKENDS
+            timer (callable): Called with a phase name ("html_parse" or
+                "html_rewrite"), returns a context manager timing it
+        """
+        if backend not in BACKENDS:
+            raise ValueError(f'Unknown HTML backend: {backend}')
+        self.transforms = list(transforms)
+        self.backend = backend
+        self.timer = timer or _no_timer
+
+    def run(self, document):
+        """Return the document with every transform applied."""
+        return BACKENDS[self.backend](document, self.transforms, self.timer)
@@ -0,0 +1,249 @@
+import asyncio
+import threading
+from contextlib import asynccontextmanager
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import httpx
+except ImportError:  # Only needed for the async server in asgi.py
+    httpx = None
+
+
+class PoolExhausted(requests.exceptions.ConnectionError):
+    """Raised when every connection slot for an upstream host stays busy."""
+
+
+class BodyTooLarge(requests.exceptions.RequestException):
+    """Raised when an upstream body is larger than the allowed maximum."""
+
+
+def content_length(response):
+    """Return the declared Content-Length of a response, or None."""
+    try:
+        return int(response.headers.get('content-length', ''))
+    except ValueError:
+        return None
+
+
+def read_body(response, max_bytes, chunk_size=64 * 1024):
+    """Read a streamed response body, refusing bodies larger than max_bytes.
+
+    Raises:
+        BodyTooLarge: The declared or actual size exceeds max_bytes
+    """
+    declared = content_length(response)
+    if declared is not None and declared > max_bytes:
+        raise BodyTooLarge(f'Response body of {declared} bytes exceeds the {max_bytes} byte limit')
+
+    chunks = []
+    size = 0
+    for chunk in response.iter_content(chunk_size=chunk_size):
+        size += len(chunk)
+        if size > max_bytes:
+            raise BodyTooLarge(f'Response body exceeds the {max_bytes} byte limit')
+        chunks.append(chunk)
+    return b''.join(chunks)
+
+
+class HttpClient:
+    """Shared HTTP client with keep-alive connection pools per upstream host.
+
+    Every host (scheme and netloc) gets its own requests.Session, so TCP and
+    TLS connections are reused between requests. A semaphore per host caps how
+    many requests may be in flight to it at once.
+    """
+
+    def __init__(self, pool_size=10, max_per_host=10, connect_timeout=3, read_timeout=5,
+                 host_settings=None):
+        """Create a client.
+
+        Args:
+            pool_size (int): Keep-alive connections kept open per host
+            max_per_host (int): Requests allowed in flight per host
+            connect_timeout (float): Seconds to establish a connection
+            read_timeout (float): Default seconds to wait for response data
+            host_settings (callable): Called with a netloc, returns a dict that may
+                override "pool_size" and "max_concurrency" for that host
+        """
+        self.pool_size = pool_size
+        self.max_per_host = max_per_host
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._host_settings = host_settings or (lambda netloc: {})
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def get(self, url, **kwargs):
+        """Send a GET request, see request()."""
+        return self.request('GET', url, **kwargs)
+
+    def head(self, url, **kwargs):
+        """Send a HEAD request, see request()."""
+        return self.request('HEAD', url, **kwargs)
+
+    def request(self, method, url, read_timeout=None, **kwargs):
+        """Send a request over the pooled session for the URL's host.
+
+        Args:
+            method (str): HTTP method
+            url (str): Absolute URL
+            read_timeout (float): Seconds to wait for data, defaults to the client's
+            **kwargs: Passed on to requests.Session.request
+
+        With stream=True the host slot is held until the response is closed.
+
+        Raises:
+            PoolExhausted: No slot for the host freed up within the connect timeout
+            requests.exceptions.RequestException: The request itself failed
+        """
+        session, slots = self._host(url)
+        if not slots.acquire(timeout=self.connect_timeout):
+            raise PoolExhausted(f'Too many concurrent requests to {urlsplit(url).netloc}')
+
+        timeout = (self.connect_timeout, read_timeout or self.read_timeout)
+        try:
+            response = session.request(method, url, timeout=timeout, **kwargs)
+        except BaseException:
+            slots.release()
+            raise
+
+        if not kwargs.get('stream'):
+            slots.release()
+            return response
+
+        # Keep the slot until the caller is done reading the body
+        close = response.close
+        released = threading.Event()
+
+        def close_and_release():
+            try:
+                close()
+            finally:
+                if not released.is_set():
+                    released.set()
+                    slots.release()
+
+        response.close = close_and_release
+        return response
+
+    def close(self):
+        """Close every pooled connection."""
+        with self._lock:
+            hosts, self._hosts = self._hosts, {}
+        for session, _ in hosts.values():
+            session.close()
+
+    def _host(self, url):
+        """Return the session and concurrency semaphore for the URL's host."""
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        with self._lock:
+            host = self._hosts.get(key)
+            if host:
+                return host
+
+            settings = self._host_settings(parts.netloc) or {}
+            pool_size = settings.get('pool_size', self.pool_size)
+            max_concurrency = settings.get('max_concurrency', self.max_per_host)
+
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+
+            host = (session, threading.BoundedSemaphore(max_concurrency))
+            self._hosts[key] = host
+            return host
+
+
+async def read_body_async(response, max_bytes):
+    """Read a streamed httpx response body, refusing bodies larger than max_bytes.
+
+    Raises:
+        BodyTooLarge: The declared or actual size exceeds max_bytes
+    """
+    declared = content_length(response)
+    if declared is not None and declared > max_bytes:
+        raise BodyTooLarge(f'Response body of {declared} bytes exceeds the {max_bytes} byte limit')
+
+    chunks = []
+    size = 0
+    async for chunk in response.aiter_bytes():
+        size += len(chunk)
+        if size > max_bytes:
+            raise BodyTooLarge(f'Response body exceeds the {max_bytes} byte limit')
+        chunks.append(chunk)
+    return b''.join(chunks)
+
+
+class AsyncHttpClient:
+    """Non-blocking counterpart of HttpClient, built on httpx.
+
+    Like HttpClient it keeps a keep-alive pool per upstream host and caps
+    the requests in flight to each host, but waiting for an upstream does not
+    hold a thread, so one process can have thousands of requests in flight.
+    Must be used from a single event loop.
+    """
+
+    def __init__(self, pool_size=10, max_per_host=10, connect_timeout=3, read_timeout=5,
+                 host_settings=None):
+        """Create a client, see HttpClient for the arguments."""
+        if httpx is None:
+            raise RuntimeError('The async HTTP client requires httpx, install it with: pip install httpx')
+
+        self.pool_size = pool_size
+        self.max_per_host = max_per_host
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._host_settings = host_settings or (lambda netloc: {})
+        self._hosts = {}
+
+    @asynccontextmanager
+    async def stream(self, method, url, read_timeout=None, **kwargs):
+        """Send a request and yield the response before its body is read.
+
+        The host slot is held until the block exits.
+
+        Raises:
+            PoolExhausted: No slot for the host freed up within the connect timeout
+            httpx.HTTPError: The request itself failed
+        """
+        client, slots = self._host(url)
+        try:
+            await asyncio.wait_for(slots.acquire(), self.connect_timeout)
+        except asyncio.TimeoutError:
+            raise PoolExhausted(f'Too many concurrent requests to {urlsplit(url).netloc}')
+
+        try:
+            timeout = httpx.Timeout(read_timeout or self.read_timeout, connect=self.connect_timeout)
+            async with client.stream(method, url, timeout=timeout, **kwargs) as response:
+                yield response
+        finally:
+            slots.release()
+
+    async def aclose(self):
+        """Close every pooled connection."""
+        hosts, self._hosts = self._hosts, {}
+        for client, _ in hosts.values():
+            await client.aclose()
+
+    def _host(self, url):
+        """Return the client and concurrency semaphore for the URL's host."""
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        host = self._hosts.get(key)
+        if host:
+            return host
+
+        settings = self._host_settings(parts.netloc) or {}
+        pool_size = settings.get('pool_size', self.pool_size)
+        max_concurrency = settings.get('max_concurrency', self.max_per_host)
+
+        limits = httpx.Limits(max_connections=max_concurrency, max_keepalive_connections=pool_size)
+        client = httpx.AsyncClient(limits=limits, follow_redirects=True)
+        host = (client, asyncio.Semaphore(max_concurrency))
+        self._hosts[key] = host
+        return host
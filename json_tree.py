@@ -0,0 +1,97 @@
+from itertools import islice
+
+# Children returned per page when the client doesn't ask for a size
+DEFAULT_PAGE_SIZE = 100
+
+# Largest page a client may ask for
+MAX_PAGE_SIZE = 1000
+
+
+class PathNotFound(LookupError):
+    """Raised when a JSON pointer doesn't lead to a value in the document."""
+
+
+def parse_pointer(pointer):
+    """Split a JSON pointer (RFC 6901) such as "/items/0/name" into its reference tokens."""
+    if pointer == '':
+        return []
+    if not pointer.startswith('/'):
+        raise PathNotFound(f'Invalid JSON pointer: {pointer}')
+    return [token.replace('~1', '/').replace('~0', '~') for token in pointer[1:].split('/')]
+
+
+def child_pointer(pointer, key):
+    """Return the JSON pointer of a child of the value at pointer."""
+    return f"{pointer}/{str(key).replace('~', '~0').replace('/', '~1')}"
+
+
+def resolve(document, pointer):
+    """Return the value at a JSON pointer.
+
+    Raises:
+        PathNotFound: The pointer is invalid or leads nowhere
+    """
+    value = document
+    for token in parse_pointer(pointer):
+        if isinstance(value, dict) and token in value:
+            value = value[token]
+        elif isinstance(value, list) and token.isdigit() and int(token) < len(value):
+            value = value[int(token)]
+        else:
+            raise PathNotFound(f'No value at {pointer}')
+    return value
+
+
+def value_type(value):
+    """Return the JSON type name of a value."""
+    if isinstance(value, dict):
+        return 'object'
+    if isinstance(value, list):
+        return 'array'
+    if isinstance(value, bool):
+        return 'boolean'
+    if isinstance(value, (int, float)):
+        return 'number'
+    if value is None:
+        return 'null'
+    return 'string'
+
+
+def describe(value, pointer, key=None):
+    """Summarise a value: containers by their size, primitives by their value."""
+    summary = {'path': pointer, 'type': value_type(value)}
+    if key is not None:
+        summary['key'] = key
+    if isinstance(value, (dict, list)):
+        summary['size'] = len(value)
+    else:
+        summary['value'] = value
+    return summary
+
+
+def page(document, pointer='', offset=0, limit=DEFAULT_PAGE_SIZE):
+    """Return the value at pointer with one page of its children summarised.
+
+    Containers list at most limit children starting at offset. Each child is
+    described without its own children, so the response size depends on the
+    page size only, never on how large the document is.
+
+    Raises:
+        PathNotFound: The pointer is invalid or leads nowhere
+    """
+    value = resolve(document, pointer)
+    summary = describe(value, pointer)
+    if not isinstance(value, (dict, list)):
+        return summary
+
+    offset = max(offset, 0)
+    limit = min(max(limit, 1), MAX_PAGE_SIZE)
+    if isinstance(value, dict):
+        items = islice(value.items(), offset, offset + limit)
+    else:
+        items = enumerate(value[offset:offset + limit], start=offset)
+
+    summary['offset'] = offset
+    summary['limit'] = limit
+    summary['children'] = [describe(child, child_pointer(pointer, key), key) for key, child in items]
+    return summary
@@ -0,0 +1,167 @@
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+
+# Histogram bounds for durations, in seconds
+TIME_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Histogram bounds for payload sizes, in bytes
+SIZE_BUCKETS = (1024, 10 * 1024, 100 * 1024, 1024 * 1024, 10 * 1024 * 1024, 100 * 1024 * 1024)
+
+# Phases timed during the current request, for the Server-Timing header
+_request_phases = ContextVar('request_phases', default=None)
+
+_DISABLED = nullcontext()
+
+
+def _disabled_timer(phase):
+    return _DISABLED
+
+
+class Metrics:
+    """Counters and histograms of the portal, exported in the Prometheus text format.
+
+    Every phase is also added to the phases of the current request, which
+    server_timing() turns into a Server-Timing header. A disabled instance
+    records nothing and its phase() returns a shared no-op context manager.
+    """
+
+    def __init__(self, enabled=True):
+        """Create a registry.
+
+        Args:
+            enabled (bool): Record anything at all
+        """
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._kinds = {}
+        self._help = {}
+        self._buckets = {}
+        self._counters = {}
+        self._histograms = {}
+
+    def counter(self, name, help):
+        """Declare a counter."""
+        self._kinds[name] = 'counter'
+        self._help[name] = help
+
+    def histogram(self, name, help, buckets=TIME_BUCKETS):
+        """Declare a histogram with the given bucket upper bounds."""
+        self._kinds[name] = 'histogram'
+        self._help[name] = help
+        self._buckets[name] = tuple(buckets)
+
+    def inc(self, name, amount=1, **labels):
+        """Add to a counter."""
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        """Record a value in a histogram."""
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        buckets = self._buckets[name]
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(buckets), 0.0, 0]
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram[0][index] += 1
+                    break
+            histogram[1] += value
+            histogram[2] += 1
+
+    def phase(self, phase, **labels):
+        """Time a block as one phase of the work, see record_phase()."""
+        if not self.enabled:
+            return _DISABLED
+        return self._timed(phase, labels)
+
+    def timer(self, **labels):
+        """Return a function timing phases with the given labels, for code that takes a timer."""
+        if not self.enabled:
+            return _disabled_timer
+        return lambda phase: self._timed(phase, labels)
+
+    def record_phase(self, phase, seconds, **labels):
+        """Record how long a phase took, in the phase histogram and the current request."""
+        if not self.enabled:
+            return
+        self.observe('portal_phase_seconds', seconds, phase=phase, **labels)
+        phases = _request_phases.get()
+        if phases is not None:
+            phases.append((phase, seconds))
+
+    def start_request(self):
+        """Start collecting the phases of a request in the current context."""
+        if self.enabled:
+            _request_phases.set([])
+
+    def server_timing(self):
+        """Return a Server-Timing header value for the current request, or None.
+
+        Phases that ran several times are reported once with their total.
+        """
+        phases = _request_phases.get() if self.enabled else None
+        if not phases:
+            return None
+        totals = {}
+        for phase, seconds in phases:
+            totals[phase] = totals.get(phase, 0) + seconds
+        return ', '.join(f'{phase};dur={seconds * 1000:.1f}' for phase, seconds in totals.items())
+
+    def render(self):
+        """Return every metric in the Prometheus text exposition format."""
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: (list(value[0]), value[1], value[2]) for key, value in self._histograms.items()}
+
+        lines = []
+        for name, kind in sorted(self._kinds.items()):
+            lines.append(f'# HELP {name} {self._help[name]}')
+            lines.append(f'# TYPE {name} {kind}')
+            if kind == 'counter':
+                for (metric, labels), value in sorted(counters.items()):
+                    if metric == name:
+                        lines.append(f'{name}{_labels(labels)} {value}')
+                continue
+
+            for (metric, labels), (counts, total, count) in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                cumulative = 0
+                for bound, bucket_count in zip(self._buckets[name], counts):
+                    cumulative += bucket_count
+                    lines.append(f'{name}_bucket{_labels(labels + (("le", _number(bound)),))} {cumulative}')
+                lines.append(f'{name}_bucket{_labels(labels + (("le", "+Inf"),))} {count}')
+                lines.append(f'{name}_sum{_labels(labels)} {_number(total)}')
+                lines.append(f'{name}_count{_labels(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+    @contextmanager
+    def _timed(self, phase, labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_phase(phase, time.perf_counter() - started, **labels)
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
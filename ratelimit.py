@@ -0,0 +1,174 @@
+import asyncio
+import math
+import threading
+import time
+
+import requests
+
+# Seconds between checks for a free slot while waiting asynchronously
+_SLOT_POLL_INTERVAL = 0.02
+
+
+class RateLimited(requests.exceptions.ConnectionError):
+    """Raised instead of contacting an upstream that is over its rate limit."""
+
+
+class RateLimiter:
+    """Admission control for one upstream, used to keep fragile services from being overloaded.
+
+    Every call takes a token from a bucket holding up to burst tokens, which
+    refills at rate tokens per second, and occupies one of max_concurrent
+    slots until release(). Either limit may be None for no limit. A call
+    that can't be admitted at once waits up to max_wait seconds for a token
+    or slot, and is rejected with RateLimited after that.
+    """
+
+    def __init__(self, rate=None, burst=None, max_concurrent=None, max_wait=0, clock=time.monotonic):
+        """Create a limiter.
+
+        Args:
+            rate (float): Requests per second on average, None for no limit
+            burst (int): Requests allowed back to back, defaults to rate rounded up
+            max_concurrent (int): Requests in flight at once, None for no limit
+            max_wait (float): Seconds a call may wait to be admitted
+            clock (callable): Returns the current time in seconds
+        """
+        self.rate = rate
+        self.burst = burst
+        self.max_concurrent = max_concurrent
+        self.max_wait = max_wait
+        self._clock = clock
+        self._condition = threading.Condition()
+        self._tokens = None
+        self._updated_at = None
+        self._in_flight = 0
+        self._deferred = 0
+        self._rejected = 0
+
+    def acquire(self):
+        """Wait until a call may go to the upstream, blocking the thread.
+
+        Returns:
+            bool: Whether the call had to wait
+
+        Raises:
+            RateLimited: The call was not admitted within max_wait seconds
+        """
+        deadline = None
+        with self._condition:
+            while True:
+                delay = self._try_acquire(waited=deadline is not None)
+                if delay == 0:
+                    return deadline is not None
+                now = self._clock()
+                if deadline is None:
+                    deadline = now + self.max_wait
+                if now >= deadline:
+                    raise self._reject()
+                # A release() wakes the wait early when a slot frees up
+                self._condition.wait(deadline - now if delay is None else min(delay, deadline - now))
+
+    async def acquire_async(self):
+        """Wait until a call may go to the upstream without blocking the event loop, see acquire()."""
+        deadline = None
+        while True:
+            with self._condition:
+                delay = self._try_acquire(waited=deadline is not None)
+                if delay == 0:
+                    return deadline is not None
+                now = self._clock()
+                if deadline is None:
+                    deadline = now + self.max_wait
+                if now >= deadline:
+                    raise self._reject()
+            await asyncio.sleep(min(_SLOT_POLL_INTERVAL if delay is None else delay, deadline - now))
+
+    def release(self):
+        """Free the slot of a finished call."""
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify()
+
+    def snapshot(self):
+        """Return the limits and counters as a dict for display."""
+        with self._condition:
+            if self.rate:
+                self._refill(self._clock())
+            return {
+                'rate': self.rate,
+                'burst': self._capacity() if self.rate else None,
+                'max_concurrent': self.max_concurrent,
+                'tokens': round(self._tokens, 2) if self.rate else None,
+                'in_flight': self._in_flight,
+                'deferred': self._deferred,
+                'rejected': self._rejected
+            }
+
+    def _try_acquire(self, waited):
+        """Admit a call if both limits allow it now.
+
+        Returns:
+            float: 0 when the call was admitted, otherwise the seconds until
+                a token is due, or None when it has to wait for a free slot
+        """
+        if self.max_concurrent and self._in_flight >= self.max_concurrent:
+            return None
+        if self.rate:
+            self._refill(self._clock())
+            if self._tokens < 1:
+                return (1 - self._tokens) / self.rate
+            self._tokens -= 1
+        self._in_flight += 1
+        if waited:
+            self._deferred += 1
+        return 0
+
+    def _reject(self):
+        self._rejected += 1
+        limits = []
+        if self.rate:
+            limits.append(f'{self.rate:g} requests/s')
+        if self.max_concurrent:
+            limits.append(f'{self.max_concurrent} concurrent')
+        return RateLimited(f"Rate limit reached ({', '.join(limits)}), not contacting the service")
+
+    def _capacity(self):
+        return self.burst or max(1, math.ceil(self.rate))
+
+    def _refill(self, now):
+        if self._tokens is None:
+            self._tokens = self._capacity()
+        else:
+            self._tokens = min(self._capacity(), self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+
+class LimiterRegistry:
+    """One RateLimiter per upstream, created on first use."""
+
+    def __init__(self, **defaults):
+        """Create a registry.
+
+        Args:
+            **defaults: Arguments for every new RateLimiter
+        """
+        self.defaults = defaults
+        self._limiters = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, **settings):
+        """Return the limiter for key, applying any per-upstream settings."""
+        with self._lock:
+            limiter = self._limiters.get(key)
+            if limiter is None:
+                limiter = RateLimiter(**self.defaults)
+                self._limiters[key] = limiter
+        for name, value in settings.items():
+            setattr(limiter, name, value)
+        return limiter
+
+    def states(self):
+        """Return the limits and counters of every known upstream by key."""
+        with self._lock:
+            limiters = dict(self._limiters)
+        return {key: limiter.snapshot() for key, limiter in limiters.items()}
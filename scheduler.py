@@ -0,0 +1,336 @@
+import json
+import random
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class SnapshotStore:
+    """Latest fetched result of every service, shared by all requests in the process."""
+
+    def __init__(self, on_put=None):
+        """Create a store.
+
+        Args:
+            on_put (callable): Called with every result stored
+        """
+        self._snapshots = {}
+        self._lock = threading.Lock()
+        self._on_put = on_put
+
+    def get(self, name, url=None, max_age=None):
+        """Return the snapshot of a service, or None.
+
+        Args:
+            name (str): Service name
+            url (str): Ignore snapshots taken from a different URL
+            max_age (float): Ignore snapshots older than this many seconds
+        """
+        with self._lock:
+            snapshot = self._snapshots.get(name)
+        return _matching(snapshot, url, max_age)
+
+    def put(self, name, result):
+        """Store the latest result of a service."""
+        snapshot = {'result': result, 'updated_at': time.time()}
+        with self._lock:
+            self._snapshots[name] = snapshot
+        if self._on_put:
+            self._on_put(result)
+        return snapshot
+
+    def remove(self, name):
+        """Forget the snapshot of a service."""
+        with self._lock:
+            self._snapshots.pop(name, None)
+
+    def names(self):
+        """Return the names of every service with a snapshot."""
+        with self._lock:
+            return list(self._snapshots)
+
+
+class SqliteSnapshotStore(SnapshotStore):
+    """SnapshotStore persisted in a SQLite database.
+
+    Every process using the same file shares the snapshots, and they survive
+    restarts. The database runs in WAL mode, so reads never wait for a
+    write. Snapshots are kept in memory as well: a read only checks the
+    timestamp in the database and loads the row when another process stored
+    a newer one, which is then passed to on_put like a local put.
+    """
+
+    def __init__(self, path, on_put=None):
+        """Create a store.
+
+        Args:
+            path (str): Database file, created if missing
+            on_put (callable): Called with every result stored or loaded
+        """
+        super().__init__(on_put=on_put)
+        self.path = path
+        self._local = threading.local()
+        self._execute(
+            'CREATE TABLE IF NOT EXISTS snapshots '
+            '(name TEXT PRIMARY KEY, updated_at REAL NOT NULL, result TEXT NOT NULL)'
+        )
+
+    def get(self, name, url=None, max_age=None):
+        """Return the snapshot of a service, or None, see SnapshotStore.get()."""
+        with self._lock:
+            snapshot = self._snapshots.get(name)
+        row = self._execute('SELECT updated_at FROM snapshots WHERE name = ?', (name,)).fetchone()
+        if row and (snapshot is None or row[0] > snapshot['updated_at']):
+            snapshot = self._load(name) or snapshot
+        return _matching(snapshot, url, max_age)
+
+    def put(self, name, result):
+        """Store the latest result of a service in memory and in the database."""
+        snapshot = {'result': result, 'updated_at': time.time()}
+        with self._lock:
+            previous = self._snapshots.get(name)
+            self._snapshots[name] = snapshot
+
+        if previous and _same_content(previous['result'], result):
+            # Only the time changed, don't write the data again
+            self._execute('UPDATE snapshots SET updated_at = ? WHERE name = ?', (snapshot['updated_at'], name))
+        else:
+            try:
+                encoded = json.dumps(result)
+            except (TypeError, ValueError) as e:
+                print(f"Error saving snapshot of {name}: {e}")
+            else:
+                self._execute(
+                    'INSERT OR REPLACE INTO snapshots (name, updated_at, result) VALUES (?, ?, ?)',
+                    (name, snapshot['updated_at'], encoded)
+                )
+
+        if self._on_put:
+            self._on_put(result)
+        return snapshot
+
+    def remove(self, name):
+        """Forget the snapshot of a service, in every process."""
+        super().remove(name)
+        self._execute('DELETE FROM snapshots WHERE name = ?', (name,))
+
+    def names(self):
+        """Return the names of every service with a snapshot."""
+        rows = self._execute('SELECT name FROM snapshots').fetchall()
+        return sorted(set(super().names()) | {row[0] for row in rows})
+
+    def _load(self, name):
+        row = self._execute('SELECT updated_at, result FROM snapshots WHERE name = ?', (name,)).fetchone()
+        if not row:
+            return None
+        snapshot = {'result': json.loads(row[1]), 'updated_at': row[0]}
+        with self._lock:
+            current = self._snapshots.get(name)
+            if current and current['updated_at'] >= snapshot['updated_at']:
+                return current
+            self._snapshots[name] = snapshot
+        if self._on_put:
+            self._on_put(snapshot['result'])
+        return snapshot
+
+    def _execute(self, sql, parameters=()):
+        """Run a statement on this thread's connection.
+
+        Database errors are printed and leave the in-memory snapshots to
+        carry on alone.
+        """
+        try:
+            return self._connection().execute(sql, parameters)
+        except sqlite3.Error as e:
+            print(f"Error accessing snapshot database {self.path}: {e}")
+            return _NO_ROWS
+
+    def _connection(self):
+        # sqlite3 connections can't be shared between threads
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+
+class _NoRows:
+    def fetchone(self):
+        return None
+
+    def fetchall(self):
+        return []
+
+
+_NO_ROWS = _NoRows()
+
+
+def _matching(snapshot, url, max_age):
+    """Return snapshot if it was taken from url and is recent enough, else None."""
+    if not snapshot:
+        return None
+    if url is not None and snapshot['result'].get('url') != url:
+        return None
+    if max_age is not None and time.time() - snapshot['updated_at'] > max_age:
+        return None
+    return snapshot
+
+
+def _same_content(previous, result):
+    """Return whether two results differ in nothing but their data, which data_hash covers."""
+    if previous.get('data_hash') is None and previous.get('data') is not None:
+        return False
+    return dict(previous, data=None) == dict(result, data=None)
+
+
+class PollScheduler:
+    """Poll every configured service on its own interval in a background thread.
+
+    Each poll is delayed by a random jitter so services sharing an interval
+    don't fire together. A failing service is polled less often, with the
+    delay doubling per consecutive failure up to max_backoff. At most
+    max_concurrent polls run at the same time, and never two for one service.
+    """
+
+    def __init__(self, services, poll, store, default_interval=30, max_concurrent=4,
+                 jitter=0.1, max_backoff=300):
+        """Create a scheduler.
+
+        Args:
+            services (callable): Returns the current list of service configurations
+            poll (callable): Fetches one service and returns its result dict
+            store (SnapshotStore): Receives every poll result
+            default_interval (float): Seconds between polls unless a service sets poll_interval
+            max_concurrent (int): Polls allowed to run at the same time
+            jitter (float): Fraction of the interval added or removed at random
+            max_backoff (float): Longest delay in seconds for a failing service
+        """
+        self._services = services
+        self._poll = poll
+        self.store = store
+        self.default_interval = default_interval
+        self.max_concurrent = max_concurrent
+        self.jitter = jitter
+        self.max_backoff = max_backoff
+        self._due = {}
+        self._failures = {}
+        self._in_flight = set()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._executor = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """Start polling in the background. Does nothing if already running."""
+        with self._lock:
+            if self.running:
+                return
+            self._stopped.clear()
+            self._executor = ThreadPoolExecutor(max_workers=self.max_concurrent, thread_name_prefix='poll')
+            self._thread = threading.Thread(target=self._run, name='poll-scheduler', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stop polling and wait for the scheduler thread to finish."""
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        if self._executor:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def poll_soon(self, name):
+        """Move the next poll of a service forward to now."""
+        with self._lock:
+            if name in self._due:
+                self._due[name] = time.monotonic()
+        self._wakeup.set()
+
+    def interval(self, service):
+        """Return the poll interval of a service in seconds, 0 if it is not polled."""
+        return service.get('poll_interval', self.default_interval)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            now = time.monotonic()
+            try:
+                services = {s['name']: s for s in self._services() if self.interval(s) > 0}
+            except Exception as e:
+                print(f"Error reading services to poll: {e}")
+                self._stopped.wait(1.0)
+                continue
+
+            with self._lock:
+                # Pick up added services and forget removed ones
+                for name in list(self._due):
+                    if name not in services:
+                        del self._due[name]
+                        self._failures.pop(name, None)
+                for name, service in services.items():
+                    if name not in self._due:
+                        # Spread the first polls over a fraction of the interval
+                        self._due[name] = now + random.uniform(0, self.jitter * self.interval(service))
+
+                due = [
+                    services[name] for name, at in self._due.items()
+                    if at <= now and name not in self._in_flight
+                ]
+                for service in due:
+                    self._in_flight.add(service['name'])
+
+            for service in due:
+                self._executor.submit(self._poll_service, service)
+
+            with self._lock:
+                waiting = [at for name, at in self._due.items() if name not in self._in_flight]
+            timeout = min(waiting) - time.monotonic() if waiting else 1.0
+            self._wakeup.wait(max(0.01, min(timeout, 1.0)))
+            self._wakeup.clear()
+
+    def _poll_service(self, service):
+        name = service['name']
+        interval = self.interval(service)
+        snapshot = self.store.get(name, url=service['url'], max_age=interval / 2)
+        if snapshot:
+            # Polled elsewhere a moment ago, by another worker sharing the store
+            # or by an on-demand refresh. Follow that poll's schedule instead.
+            with self._lock:
+                self._in_flight.discard(name)
+                if name in self._due:
+                    delay = snapshot['updated_at'] + interval - time.time()
+                    self._due[name] = time.monotonic() + delay * (1 + random.uniform(0, self.jitter))
+            self._wakeup.set()
+            return
+
+        ok = False
+        try:
+            result = self._poll(service)
+            self.store.put(name, result)
+            ok = result.get('status') == 'Connected'
+        except Exception as e:
+            print(f"Error polling {name}: {e}")
+        finally:
+            with self._lock:
+                failures = 0 if ok else self._failures.get(name, 0) + 1
+                self._failures[name] = failures
+                self._in_flight.discard(name)
+                if name in self._due:
+                    self._due[name] = time.monotonic() + self._next_delay(service, failures)
+            self._wakeup.set()
+
+    def _next_delay(self, service, failures):
+        """Return seconds until the next poll, with backoff and jitter applied."""
+        delay = self.interval(service)
+        if failures:
+            delay = min(delay * 2 ** failures, max(self.max_backoff, delay))
+        return delay * (1 + random.uniform(-self.jitter, self.jitter))
@@ -0,0 +1,189 @@
+import csv
+import io
+import json
+from urllib.parse import urlsplit
+
+from html_pipeline import BACKENDS
+
+# Largest number of services accepted in one import or connection test batch
+MAX_BATCH_SERVICES = 1000
+
+
+class InvalidImport(ValueError):
+    """Raised when an import can't be read or has invalid entries.
+
+    Attributes:
+        errors (list): One dict per problem, with the 1-based "entry" it was
+            found in (None for the file as a whole) and an "error" message
+    """
+
+    def __init__(self, errors):
+        super().__init__('; '.join(error['error'] for error in errors))
+        self.errors = errors
+
+
+def _number(value):
+    if isinstance(value, bool):
+        raise ValueError('must be a number')
+    if isinstance(value, (int, float)):
+        return value
+    text = str(value).strip()
+    try:
+        return int(text)
+    except ValueError:
+        try:
+            return float(text)
+        except ValueError:
+            raise ValueError('must be a number') from None
+
+
+def _positive(value):
+    value = _number(value)
+    if value <= 0:
+        raise ValueError('must be greater than 0')
+    return value
+
+
+def _non_negative(value):
+    value = _number(value)
+    if value < 0:
+        raise ValueError('must not be negative')
+    return value
+
+
+def _positive_int(value):
+    value = _positive(value)
+    if value != int(value):
+        raise ValueError('must be a whole number')
+    return int(value)
+
+
+def _choice(*options):
+    def convert(value):
+        if value not in options:
+            raise ValueError(f"must be one of: {', '.join(options)}")
+        return value
+    return convert
+
+
+# Optional keys of a service entry and how their values are checked
+OPTIONAL_FIELDS = {
+    'timeout': _positive,
+    'cache_ttl': _non_negative,
+    'poll_interval': _non_negative,
+    'mode': _choice('proxy'),
+    'max_body_bytes': _positive_int,
+    'html_backend': _choice(*BACKENDS),
+    'failure_threshold': _positive_int,
+    'circuit_reset': _positive,
+    'rate_limit': _positive,
+    'rate_burst': _positive_int,
+    'max_concurrent': _positive_int,
+    'rate_limit_wait': _non_negative
+}
+
+
+def import_format(filename=None, mimetype=None):
+    """Return "csv" or "json" for an uploaded file, judged by its name and media type."""
+    if (filename or '').lower().endswith('.csv') or (mimetype or '').lower() in ('text/csv', 'application/csv'):
+        return 'csv'
+    return 'json'
+
+
+def read_entries(content, format='json'):
+    """Read raw service entries from a JSON or CSV document.
+
+    JSON may be a list of services or an object with a "services" list, as
+    in config.json. CSV needs a header row naming the columns, at least
+    name and url. Empty CSV cells are left out.
+
+    Raises:
+        InvalidImport: The document can't be parsed
+    """
+    if format == 'csv':
+        reader = csv.DictReader(io.StringIO(content))
+        if not reader.fieldnames or not {'name', 'url'} <= {field.strip() for field in reader.fieldnames}:
+            raise InvalidImport([{'entry': None, 'error': 'CSV needs a header row with name and url columns'}])
+        return [
+            {key.strip(): value.strip() for key, value in row.items() if key and value and value.strip()}
+            for row in reader
+        ]
+
+    try:
+        document = json.loads(content)
+    except ValueError as e:
+        raise InvalidImport([{'entry': None, 'error': f'Invalid JSON: {e}'}]) from None
+    if isinstance(document, dict):
+        document = document.get('services')
+    if not isinstance(document, list):
+        raise InvalidImport([{'entry': None, 'error': 'Expected a list of services or an object with a "services" list'}])
+    return document
+
+
+def validate_service(entry):
+    """Return a clean service config from a raw entry.
+
+    Raises:
+        ValueError: The entry is invalid, with a message saying why
+    """
+    if not isinstance(entry, dict):
+        raise ValueError('must be an object with name and url')
+
+    name = entry.get('name')
+    url = entry.get('url')
+    if not isinstance(name, str) or not name.strip():
+        raise ValueError('name is required')
+    if not isinstance(url, str) or not url.strip():
+        raise ValueError('url is required')
+    url = url.strip()
+    parts = urlsplit(url)
+    if parts.scheme not in ('http', 'https') or not parts.netloc:
+        raise ValueError(f'url must be an absolute http(s) URL: {url}')
+
+    service = {'name': name.strip(), 'url': url}
+    for key, value in entry.items():
+        if key in ('name', 'url'):
+            continue
+        if key not in OPTIONAL_FIELDS:
+            raise ValueError(f'unknown key: {key}')
+        try:
+            service[key] = OPTIONAL_FIELDS[key](value)
+        except ValueError as e:
+            raise ValueError(f'{key} {e}') from None
+    return service
+
+
+def parse_services(content, format='json'):
+    """Read and validate every service in an import.
+
+    Returns:
+        list: Clean service configs, in the order given
+
+    Raises:
+        InvalidImport: The document can't be parsed or any entry is invalid.
+            Every invalid entry is reported, not just the first.
+    """
+    entries = read_entries(content, format)
+    if not entries:
+        raise InvalidImport([{'entry': None, 'error': 'No services found'}])
+    if len(entries) > MAX_BATCH_SERVICES:
+        raise InvalidImport([{'entry': None, 'error': f'At most {MAX_BATCH_SERVICES} services can be imported at once'}])
+
+    services = []
+    errors = []
+    seen = set()
+    for number, entry in enumerate(entries, start=1):
+        try:
+            service = validate_service(entry)
+        except ValueError as e:
+            errors.append({'entry': number, 'error': str(e)})
+            continue
+        if service['name'] in seen:
+            errors.append({'entry': number, 'error': f"duplicate name: {service['name']}"})
+            continue
+        seen.add(service['name'])
+        services.append(service)
+
+    if errors:
+        raise InvalidImport(errors)
+    return services
@@ -0,0 +1,263 @@
+// Interactive JSON viewer for service iframes. The page only contains the
+// container, the data is loaded from the URL in its data-src attribute.
+//
+// Nodes are rendered lazily: a collapsed object or array only shows its size,
+// its children are requested when it is expanded, one page at a time. Huge
+// documents are therefore never downloaded or rendered in full.
+
+const PAGE_SIZE = 100;
+
+// Where pages of the document come from, see remoteSource() and localSource()
+let source = null;
+
+// Pages are loaded from the server, which slices the document by JSON pointer
+function remoteSource(url) {
+    async function getJSON(requestUrl) {
+        // Revalidate the browser's copy, an unchanged page costs a 304
+        const response = await fetch(requestUrl, { cache: 'no-cache' });
+        if (!response.ok) throw new Error(`HTTP ${response.status}`);
+        return response.json();
+    }
+
+    return {
+        page(path, offset) {
+            const params = new URLSearchParams({ path, offset, limit: PAGE_SIZE });
+            return getJSON(`${url}?${params}`);
+        },
+        full() {
+            return getJSON(url);
+        }
+    };
+}
+
+// Pages are cut from a document already in memory, e.g. one pushed by the dashboard
+function localSource(data) {
+    return {
+        page(path, offset) {
+            return Promise.resolve(localPage(data, path, offset));
+        },
+        full() {
+            return Promise.resolve(data);
+        }
+    };
+}
+
+// Same format as the server's /iframe/<name>/data?path= responses
+function localPage(data, path, offset) {
+    let value = data;
+    if (path !== '') {
+        for (const token of path.slice(1).split('/')) {
+            value = value[token.replace(/~1/g, '/').replace(/~0/g, '~')];
+        }
+    }
+
+    const node = describe(value, path);
+    if (node.size === undefined) return node;
+
+    const keys = Array.isArray(value) ? null : Object.keys(value);
+    node.offset = offset;
+    node.limit = PAGE_SIZE;
+    node.children = [];
+    for (let index = offset; index < Math.min(offset + PAGE_SIZE, node.size); index++) {
+        const key = keys ? keys[index] : index;
+        node.children.push(describe(value[key], childPath(path, key), key));
+    }
+    return node;
+}
+
+function describe(value, path, key) {
+    const node = { path, type: valueType(value) };
+    if (key !== undefined) node.key = key;
+    if (node.type === 'array') {
+        node.size = value.length;
+    } else if (node.type === 'object') {
+        node.size = Object.keys(value).length;
+    } else {
+        node.value = value;
+    }
+    return node;
+}
+
+function valueType(value) {
+    if (Array.isArray(value)) return 'array';
+    if (value === null) return 'null';
+    return typeof value;
+}
+
+function childPath(path, key) {
+    return `${path}/${String(key).replace(/~/g, '~0').replace(/\//g, '~1')}`;
+}
+
+// Render one node, containers start collapsed unless expanded is set
+function renderNode(node, container, expanded) {
+    if (typeof node.key === 'string') {
+        const keySpan = document.createElement('span');
+        keySpan.className = 'json-key';
+        keySpan.textContent = `"${node.key}": `;
+        container.appendChild(keySpan);
+    }
+
+    if (node.size === undefined) {
+        renderPrimitive(node.value, container);
+        return;
+    }
+
+    const isArray = node.type === 'array';
+    if (node.size === 0) {
+        const empty = document.createElement('span');
+        empty.className = 'json-value';
+        empty.textContent = isArray ? '[ ]' : '{ }';
+        container.appendChild(empty);
+        return;
+    }
+
+    const toggle = document.createElement('span');
+    toggle.className = 'collapsible collapsed';
+    toggle.textContent = isArray ? '[ ' : '{ ';
+    container.appendChild(toggle);
+
+    const summary = document.createElement('span');
+    summary.className = 'json-summary';
+    summary.textContent = `${node.size} ${isArray ? 'items' : 'keys'}`;
+    container.appendChild(summary);
+
+    const list = document.createElement('ul');
+    container.appendChild(list);
+    container.appendChild(document.createTextNode(isArray ? ' ]' : ' }'));
+
+    toggle.addEventListener('click', function(e) {
+        e.stopPropagation();
+        if (!toggle.loaded) {
+            // Children are only requested the first time the node is opened
+            toggle.loaded = true;
+            loadChildren(node.path, 0, node.size, list, node.children);
+        }
+        toggle.classList.toggle('collapsed');
+    });
+
+    if (expanded) toggle.click();
+}
+
+// Append a page of children to a list, with a button for the next page
+async function loadChildren(path, offset, size, list, children) {
+    try {
+        if (!children) {
+            children = (await source.page(path, offset)).children;
+        }
+        children.forEach(child => {
+            const listItem = document.createElement('li');
+            renderNode(child, listItem, false);
+            list.appendChild(listItem);
+        });
+
+        const next = offset + children.length;
+        if (next < size) {
+            const more = document.createElement('li');
+            const button = document.createElement('button');
+            button.className = 'json-more';
+            button.textContent = `Show ${Math.min(PAGE_SIZE, size - next)} more (${next} of ${size} shown)`;
+            button.addEventListener('click', function(e) {
+                e.stopPropagation();
+                more.remove();
+                loadChildren(path, next, size, list);
+            });
+            more.appendChild(button);
+            list.appendChild(more);
+        }
+    } catch (error) {
+        const listItem = document.createElement('li');
+        listItem.className = 'json-error';
+        listItem.textContent = `Error loading data: ${error.message}`;
+        list.appendChild(listItem);
+    }
+}
+
+function renderPrimitive(value, container) {
+    const valueSpan = document.createElement('span');
+    valueSpan.className = 'json-value';
+
+    if (typeof value === 'string') {
+        valueSpan.className += ' json-string';
+        valueSpan.textContent = `"${value}"`;
+    } else if (typeof value === 'number') {
+        valueSpan.className += ' json-number';
+        valueSpan.textContent = value;
+    } else if (typeof value === 'boolean') {
+        valueSpan.className += ' json-boolean';
+        valueSpan.textContent = value;
+    } else if (value === null) {
+        valueSpan.className += ' json-null';
+        valueSpan.textContent = 'null';
+    } else {
+        valueSpan.textContent = value;
+    }
+
+    container.appendChild(valueSpan);
+}
+
+// Render the document from the current source, starting with the root expanded
+async function showRoot() {
+    const container = document.getElementById('json-container');
+    try {
+        const root = await source.page('', 0);
+        container.innerHTML = '';
+        renderNode(root, container, true);
+    } catch (error) {
+        container.innerHTML = '<span class="json-error"></span>';
+        container.firstChild.textContent = `Error loading data: ${error.message}`;
+    }
+}
+
+// Expand every node whose children are loaded, without fetching anything new
+function expandAll() {
+    document.querySelectorAll('.collapsible').forEach(el => {
+        if (el.loaded) el.classList.remove('collapsed');
+    });
+}
+
+// Collapse all collapsible elements
+function collapseAll() {
+    document.querySelectorAll('.collapsible').forEach(el => {
+        el.classList.add('collapsed');
+    });
+}
+
+// Copy JSON to clipboard, fetching the whole document only now
+async function copyToClipboard() {
+    const button = document.getElementById('copy-json');
+    const originalText = button.textContent;
+    try {
+        const data = await source.full();
+        const textArea = document.createElement('textarea');
+        textArea.value = JSON.stringify(data, null, 2);
+        document.body.appendChild(textArea);
+        textArea.select();
+        document.execCommand('copy');
+        document.body.removeChild(textArea);
+        button.textContent = 'Copied!';
+    } catch (error) {
+        button.textContent = 'Copy failed';
+    }
+
+    setTimeout(() => {
+        button.textContent = originalText;
+    }, 1500);
+}
+
+// Initialize the JSON viewer
+document.addEventListener('DOMContentLoaded', function() {
+    document.getElementById('expand-all').addEventListener('click', expandAll);
+    document.getElementById('collapse-all').addEventListener('click', collapseAll);
+    document.getElementById('copy-json').addEventListener('click', copyToClipboard);
+    source = remoteSource(document.getElementById('json-container').dataset.src);
+    showRoot();
+});
+
+// Re-render in place when the dashboard pushes new data
+window.addEventListener('message', function(event) {
+    if (event.origin !== window.location.origin) return;
+    if (!event.data || event.data.type !== 'service-data') return;
+
+    source = localSource(event.data.data);
+    showRoot();
+});
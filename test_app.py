@@ -1,3 +1,8 @@
+import os
+
+# Keep snapshots of test runs in memory rather than in snapshots.db next to config.json
+os.environ.setdefault('SNAPSHOT_DB', '')
+
 def test_app_import():
     """Test that the app module can be imported."""
     import app
@@ -9,4 +14,1305 @@ def test_hello_world():
     with app.app.test_client() as client:
         response = client.get('/')
         assert response.status_code == 200
-        assert b'Barda' in response.data 
\ No newline at end of file
+        assert b'Barda' in response.data 
+
+def test_fetch_service_data_marks_slow_services_pending(monkeypatch):
+    """Test that services missing the dashboard deadline are reported as pending."""
+    import time
+    import app
+
+    def fake_fetch(service):
+        if service['name'] == 'slow':
+            time.sleep(1)
+        return {'name': service['name'], 'url': service['url'], 'status': 'Connected', 'data': 'ok'}
+
+    monkeypatch.setattr(app, 'fetch_data_from_service', fake_fetch)
+    services = [
+        {'name': 'fast', 'url': 'http://fast.invalid'},
+        {'name': 'slow', 'url': 'http://slow.invalid'},
+    ]
+
+    start = time.monotonic()
+    results = app.fetch_service_data(services, deadline=0.2)
+
+    assert time.monotonic() - start < 0.9
+    assert [r['status'] for r in results] == ['Connected', 'Pending']
+
+
+def test_probe_service_uses_head_and_caches(monkeypatch):
+    """Test that the status probe never downloads the body and reuses its result."""
+    import app
+
+    calls = []
+
+    class FakeResponse:
+        status_code = 200
+
+    def fake_head(url, **kwargs):
+        calls.append(url)
+        return FakeResponse()
+
+    def fail_get(*args, **kwargs):
+        raise AssertionError('probe should not GET the body')
+
+    monkeypatch.setattr(app.http_client, 'head', fake_head)
+    monkeypatch.setattr(app.http_client, 'get', fail_get)
+    monkeypatch.setattr(app, '_status_cache', {})
+    service = {'name': 'probe', 'url': 'http://probe.invalid'}
+
+    assert app.probe_service(service)['status'] == 'Connected'
+    assert app.probe_service(service)['status'] == 'Connected'
+    assert calls == ['http://probe.invalid']
+
+
+def test_response_cache_serves_hits_and_bypasses_on_force():
+    """Test that the response cache reuses fresh values and counts hits and misses."""
+    from cache import ResponseCache
+
+    cache = ResponseCache(max_bytes=100)
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        return 'value'
+
+    assert cache.get_or_fetch('key', fetch, ttl=60) == 'value'
+    assert cache.get_or_fetch('key', fetch, ttl=60) == 'value'
+    assert cache.get_or_fetch('key', fetch, ttl=60, force=True) == 'value'
+
+    stats = cache.stats()
+    assert len(calls) == 2
+    assert (stats['hits'], stats['misses'], stats['bypasses']) == (1, 1, 1)
+
+
+def test_response_cache_serves_stale_while_revalidating():
+    """Test that an expired entry is served while one background refresh runs."""
+    import threading
+    import time
+    from cache import ResponseCache
+
+    cache = ResponseCache(max_bytes=100, stale_ttl=60)
+    cache.put('key', 'old', ttl=0.01)
+    refreshed = threading.Event()
+
+    def fetch():
+        refreshed.set()
+        return 'new'
+
+    time.sleep(0.02)
+    assert cache.get_or_fetch('key', fetch, ttl=60) == 'old'
+    assert refreshed.wait(1)
+    time.sleep(0.05)
+    assert cache.get_or_fetch('key', fetch, ttl=60) == 'new'
+    assert cache.stats()['stale_hits'] == 1
+
+
+def test_response_cache_evicts_least_recently_used_by_size():
+    """Test that the cache stays within its byte budget."""
+    from cache import ResponseCache
+
+    cache = ResponseCache(max_bytes=10)
+    cache.put('a', 'aaaaa', ttl=60)
+    cache.put('b', 'bbbbb', ttl=60)
+    cache.get_or_fetch('a', lambda: 'unused', ttl=60)
+    cache.put('c', 'ccccc', ttl=60)
+
+    assert cache.get_or_fetch('b', lambda: 'refetched', ttl=60) == 'refetched'
+    assert cache.stats()['evictions'] >= 1
+
+
+def test_single_flight_shares_one_call_between_concurrent_callers():
+    """Test that identical concurrent calls result in a single upstream call."""
+    import threading
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+    from cache import SingleFlight
+
+    flight = SingleFlight()
+    calls = []
+    started = threading.Event()
+
+    def slow_call():
+        calls.append(1)
+        started.set()
+        time.sleep(0.2)
+        return 'result'
+
+    with ThreadPoolExecutor(max_workers=5) as pool:
+        leader = pool.submit(flight.do, 'key', slow_call)
+        started.wait(1)
+        followers = [pool.submit(flight.do, 'key', slow_call) for _ in range(4)]
+        results = [leader.result()] + [f.result() for f in followers]
+
+    assert results == ['result'] * 5
+    assert len(calls) == 1
+    assert flight.stats()['shared'] == 4
+
+
+def test_http_client_limits_concurrent_requests_per_host():
+    """Test that a host's slots are held by open streams and freed on close."""
+    import pytest
+    from http_client import HttpClient, PoolExhausted
+
+    class FakeResponse:
+        def close(self):
+            pass
+
+    client = HttpClient(max_per_host=1, connect_timeout=0.05)
+    session, _ = client._host('http://upstream.invalid/a')
+    session.request = lambda *args, **kwargs: FakeResponse()
+
+    response = client.get('http://upstream.invalid/a', stream=True)
+    with pytest.raises(PoolExhausted):
+        client.get('http://upstream.invalid/b')
+
+    response.close()
+    assert isinstance(client.get('http://upstream.invalid/b'), FakeResponse)
+
+
+SAMPLE_HTML = (
+    '<!DOCTYPE html><html><head><script>if (a < b) { document.write("x"); }</script>'
+    '<script src="app.js"></script><style>a > b { color: red; }</style></head>'
+    '<body><form action="http://4.223.117.60:5100/submit"><input name=q></form>'
+    '<a href="http://4.223.117.60:5100/page?a=1&amp;b=2">Page</a><br>'
+    '<a href="/local">Local</a><!-- comment --></body></html>'
+)
+
+
+def test_soup_pipeline_matches_previous_two_pass_output():
+    """Test that the single-pass soup backend produces the same HTML as before."""
+    from bs4 import BeautifulSoup
+    import app
+
+    # Previous behaviour: script processing, serialise, parse again, rewrite URLs
+    soup = BeautifulSoup(SAMPLE_HTML, 'html.parser')
+    for script in soup.find_all('script'):
+        if script.get('src'):
+            script['defer'] = 'defer'
+        if script.string:
+            script.string = script.string.replace('document.write', '// document.write')
+    soup = BeautifulSoup(str(soup), 'html.parser')
+    for tag, attribute in (('form', 'action'), ('a', 'href')):
+        for element in soup.find_all(tag):
+            value = element.get(attribute)
+            for external_url, internal_url in app.URL_MAPPINGS.items():
+                if value and external_url in value:
+                    element[attribute] = value.replace(external_url, internal_url)
+                    break
+
+    # The second parse used to add an extra newline after the doctype
+    expected = str(soup).replace('<!DOCTYPE html>\n\n', '<!DOCTYPE html>\n')
+    assert app.process_html_content(SAMPLE_HTML, backend='soup') == expected
+
+
+def test_stream_pipeline_applies_transforms_and_keeps_other_markup():
+    """Test that the token backend rewrites only what the transforms change."""
+    import app
+
+    output = app.process_html_content(SAMPLE_HTML, backend='stream')
+
+    assert '// document.write("x")' in output
+    assert '<script src="app.js" defer="defer">' in output
+    assert 'action="http://172.17.0.4:8080/submit"' in output
+    assert 'href="http://172.17.0.4:8080/page?a=1&amp;b=2"' in output
+    assert '<style>a > b { color: red; }</style>' in output
+    assert '<input name=q><' in output
+    assert '<br><a href="/local">Local</a><!-- comment -->' in output
+
+
+def test_stream_and_soup_backends_produce_the_same_document():
+    """Test that the backends differ only in how untouched markup is serialised."""
+    from bs4 import BeautifulSoup
+    import app
+
+    page = SAMPLE_HTML.replace(
+        '<br>', '<br/><input type="checkbox" checked disabled>'
+        '<p title="a" class="b">x&nbsp;y</p><img src="http://4.223.117.60:5100/i.png">'
+    )
+    soup_output = app.process_html_content(page, backend='soup')
+    stream_output = app.process_html_content(page, backend='stream')
+
+    assert stream_output != soup_output
+    assert '<p title="a" class="b">x&nbsp;y</p>' in stream_output
+    assert str(BeautifulSoup(stream_output, 'html.parser')) == soup_output
+
+
+def test_url_rewriter_maps_every_url_bearing_attribute():
+    """Test that mapped origins are rewritten in src, srcset, CSS and meta refresh."""
+    from html_pipeline import HtmlPipeline, RewriteUrls, UrlRewriter
+
+    mappings = {f'http://10.0.0.{i}:5100': f'http://internal-{i}:8080' for i in range(200)}
+    mappings['http://10.0.0.7:5100/app'] = 'http://app-7:9000'
+    rewriter = UrlRewriter(mappings)
+
+    assert rewriter.rewrite('http://10.0.0.3:5100/x') == 'http://internal-3:8080/x'
+    assert rewriter.rewrite('http://10.0.0.7:5100/app/y') == 'http://app-7:9000/y'
+    assert rewriter.rewrite('http://10.0.0.3:51000/x') == 'http://10.0.0.3:51000/x'
+
+    document = (
+        '<meta http-equiv="refresh" content="5; url=http://10.0.0.1:5100/next">'
+        '<img src="http://10.0.0.2:5100/a.png" srcset="http://10.0.0.2:5100/a.png 1x, http://10.0.0.4:5100/b.png 2x">'
+        '<div style="background: url(http://10.0.0.5:5100/bg.png)"></div>'
+        '<style>body { background: url("http://10.0.0.6:5100/bg.png"); }</style>'
+    )
+    for backend in ('soup', 'stream'):
+        output = HtmlPipeline([RewriteUrls(rewriter)], backend=backend).run(document)
+        assert '10.0.0.' not in output
+        assert 'url=http://internal-1:8080/next' in output
+        assert 'http://internal-2:8080/a.png 1x, http://internal-4:8080/b.png 2x' in output
+        assert 'url(http://internal-5:8080/bg.png)' in output
+        assert 'url("http://internal-6:8080/bg.png")' in output
+
+
+def test_config_store_reloads_only_when_file_changes(tmp_path):
+    """Test that the config store caches the parsed file and indexes services."""
+    import json
+    import os
+    from config_store import ConfigStore
+
+    path = tmp_path / 'config.json'
+    path.write_text(json.dumps({'services': [{'name': 'My Service', 'url': 'http://a.invalid'}]}))
+    store = ConfigStore(str(path))
+
+    first = store.get()
+    assert store.get() is first
+    assert store.service_by_name('My Service')['url'] == 'http://a.invalid'
+    assert store.service_by_id('my_service')['name'] == 'My Service'
+
+    path.write_text(json.dumps({'services': [{'name': 'Other', 'url': 'http://b.invalid'}]}))
+    os.utime(path, ns=(1, 1))
+    assert store.get() is not first
+    assert store.service_by_name('My Service') is None
+
+
+def test_config_store_update_writes_atomically(tmp_path):
+    """Test that updates are written through a temporary file and re-indexed."""
+    import json
+    from config_store import ConfigStore
+
+    path = tmp_path / 'config.json'
+    store = ConfigStore(str(path))
+    store.update(lambda config: config['services'].append({'name': 'New', 'url': 'http://new.invalid'}))
+
+    assert json.loads(path.read_text())['services'] == [{'name': 'New', 'url': 'http://new.invalid'}]
+    assert store.service_by_name('New')['url'] == 'http://new.invalid'
+    assert [p.name for p in tmp_path.iterdir() if p.name.endswith('.tmp')] == []
+
+
+def test_settings_adds_and_removes_services(tmp_path, monkeypatch):
+    """Test that the settings routes update the config file through the store."""
+    import app
+    from config_store import ConfigStore
+
+    monkeypatch.setattr(app, 'config_store', ConfigStore(str(tmp_path / 'config.json')))
+    with app.app.test_client() as client:
+        client.post('/settings', data={'service_name': 'New', 'service_url': 'http://new.invalid'})
+        client.post('/settings', data={'service_name': 'New', 'service_url': 'http://dup.invalid'})
+        assert app.load_config()['services'] == [{'name': 'New', 'url': 'http://new.invalid'}]
+
+        service = app.config_store.service_by_name('New')
+        upstream = app.UpstreamResponse(200, {'content-type': 'text/plain'}, b'cached', 'utf-8')
+        app.response_cache.put('http://new.invalid', upstream, 60)
+        app.snapshot_store.put('New', app.processed_service_result(service, upstream))
+        app.store_probe_result(service, 'Connected')
+
+        client.post('/remove-service', data={'service_name': 'New'})
+        assert app.load_config()['services'] == []
+        assert app.response_cache.peek('http://new.invalid') is None
+        assert app.snapshot_store.get('New') is None
+        assert 'New' not in app.snapshot_store.names()
+        assert 'New' not in app._processed_results
+        assert app.cached_probe_result(service, max_age=None) is None
+        assert 'New' not in [event['name'] for event in app.event_broker.changes_since(0, timeout=0)[1]]
+
+
+def serve_in_background(wsgi_app):
+    """Start a WSGI app on a free local port and return the running server."""
+    import threading
+    from werkzeug.serving import make_server
+
+    server = make_server('127.0.0.1', 0, wsgi_app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def test_proxy_mode_streams_non_html_bodies(tmp_path, monkeypatch):
+    """Test that proxy services are streamed with their headers and size limit."""
+    import json
+    import app
+    from config_store import ConfigStore
+    from werkzeug.wrappers import Response
+
+    body = b'id,value\n' + b'1,abc\n' * 5000
+    server = serve_in_background(Response(body, mimetype='text/csv', headers={'Cache-Control': 'max-age=60'}))
+    url = f'http://127.0.0.1:{server.port}/export.csv'
+    try:
+        config_path = tmp_path / 'config.json'
+        config_path.write_text(json.dumps({'services': [
+            {'name': 'export', 'url': url, 'mode': 'proxy'},
+            {'name': 'limited', 'url': url, 'mode': 'proxy', 'max_body_bytes': 1000}
+        ]}))
+        monkeypatch.setattr(app, 'config_store', ConfigStore(str(config_path)))
+
+        with app.app.test_client() as client:
+            response = client.get('/iframe/export')
+            assert response.status_code == 200
+            assert response.data == body
+            assert response.headers['Content-Type'].startswith('text/csv')
+            assert response.headers['Content-Length'] == str(len(body))
+            assert response.headers['Cache-Control'] == 'max-age=60'
+
+            assert client.get('/iframe/limited').status_code == 502
+    finally:
+        server.shutdown()
+
+
+def test_proxy_mode_aborts_unsized_bodies_over_the_limit(tmp_path, monkeypatch):
+    """Test that a body without Content-Length over the limit fails the transfer in both apps."""
+    import asyncio
+    import json
+    import httpx
+    import pytest
+    import app
+    import asgi
+    from config_store import ConfigStore
+    from http_client import BodyTooLarge
+    from werkzeug.wrappers import Response
+
+    def unsized(environ, start_response):
+        return Response((b'x' * 500 for _ in range(10)), mimetype='text/csv')(environ, start_response)
+
+    server = serve_in_background(unsized)
+    config_path = tmp_path / 'config.json'
+    config_path.write_text(json.dumps({'services': [
+        {'name': 'unsized', 'url': f'http://127.0.0.1:{server.port}/stream.csv', 'mode': 'proxy', 'max_body_bytes': 1000}
+    ]}))
+    monkeypatch.setattr(app, 'config_store', ConfigStore(str(config_path)))
+
+    async def run():
+        transport = httpx.ASGITransport(app=asgi.application)
+        try:
+            async with httpx.AsyncClient(transport=transport, base_url='http://portal') as client:
+                await client.get('/iframe/unsized')
+        finally:
+            await asgi.http.aclose()
+
+    try:
+        with app.app.test_client() as client:
+            response = client.get('/iframe/unsized')
+            assert response.status_code == 200
+            with pytest.raises(BodyTooLarge):
+                response.get_data()
+        with pytest.raises(BodyTooLarge):
+            asyncio.run(run())
+    finally:
+        server.shutdown()
+
+
+def test_poll_scheduler_keeps_snapshots_warm_and_backs_off():
+    """Test that the scheduler stores poll results and delays failing services."""
+    import threading
+    import time
+    from scheduler import PollScheduler, SnapshotStore
+
+    services = [
+        {'name': 'up', 'url': 'http://up.invalid', 'poll_interval': 0.05},
+        {'name': 'down', 'url': 'http://down.invalid', 'poll_interval': 0.05},
+        {'name': 'manual', 'url': 'http://manual.invalid', 'poll_interval': 0},
+    ]
+    polls = {'up': 0, 'down': 0, 'manual': 0}
+    running = []
+    peak = []
+    lock = threading.Lock()
+
+    def poll(service):
+        with lock:
+            polls[service['name']] += 1
+            running.append(1)
+            peak.append(len(running))
+        time.sleep(0.01)
+        with lock:
+            running.pop()
+        status = 'Connected' if service['name'] == 'up' else 'Error: HTTP 500'
+        return {'name': service['name'], 'url': service['url'], 'status': status, 'data': None}
+
+    store = SnapshotStore()
+    scheduler = PollScheduler(lambda: services, poll, store, max_concurrent=1, jitter=0)
+    scheduler.start()
+    time.sleep(0.6)
+    scheduler.stop()
+
+    assert store.get('up', url='http://up.invalid')['result']['status'] == 'Connected'
+    assert store.get('down')['result']['status'] == 'Error: HTTP 500'
+    assert store.get('up', url='http://moved.invalid') is None
+    assert polls['manual'] == 0
+    assert polls['up'] > polls['down'] >= 2
+    assert max(peak) == 1
+
+
+def test_event_broker_pushes_only_changes():
+    """Test that clients receive status changes and changed JSON data only."""
+    from events import EventBroker
+
+    broker = EventBroker()
+    result = {'name': 'api', 'url': 'http://api.invalid', 'status': 'Connected', 'data': {'value': 1}}
+
+    assert broker.publish(result)
+    assert not broker.publish(dict(result))
+    version, changes = broker.changes_since(0, timeout=0)
+    assert version == 1
+    assert changes == [{'name': 'api', 'status': 'Connected', 'version': 1, 'data_changed': True, 'data': {'value': 1}}]
+
+    broker.publish(dict(result, status='Error: HTTP 500'))
+    version, changes = broker.changes_since(1, timeout=0)
+    assert changes == [{'name': 'api', 'status': 'Error: HTTP 500', 'version': 2, 'data_changed': False}]
+
+    assert broker.changes_since(version, timeout=0.01) == (2, [])
+
+
+def test_event_broker_wakes_async_waiters_on_publish():
+    """Test that coroutines wait for a change published by another thread without polling."""
+    import asyncio
+    import threading
+    import time
+    from events import EventBroker
+
+    broker = EventBroker()
+
+    async def run():
+        assert await broker.wait_for_changes(0, timeout=0.05) == (0, [])
+        publisher = threading.Timer(0.1, broker.publish, [{'name': 'api', 'status': 'Connected', 'data': None}])
+        started = time.monotonic()
+        publisher.start()
+        waiters = [broker.wait_for_changes(0, timeout=5) for _ in range(3)]
+        results = await asyncio.gather(*waiters)
+        return results, time.monotonic() - started
+
+    results, elapsed = asyncio.run(run())
+
+    assert elapsed < 2
+    assert [(version, [change['name'] for change in changes]) for version, changes in results] == [(1, ['api'])] * 3
+
+
+def test_event_cursor_from_another_broker_resyncs_everything():
+    """Test that a cursor from another worker's broker sends the full state instead of nothing."""
+    from events import EventBroker
+
+    first, second = EventBroker(), EventBroker()
+    for version in range(5):
+        first.publish({'name': 'api', 'url': 'http://api.invalid', 'status': 'Connected', 'data': {'value': version}})
+    second.publish({'name': 'api', 'url': 'http://api.invalid', 'status': 'Connected', 'data': {'value': 4}})
+    second.publish({'name': 'db', 'url': 'http://db.invalid', 'status': 'Connected', 'data': None})
+
+    assert first.parse_cursor(first.cursor()) == 5
+    assert second.parse_cursor(first.cursor()) == 0
+    assert second.parse_cursor(second.cursor(7)) == 0
+    assert second.parse_cursor('3') == 0
+    assert second.parse_cursor(None) == 0
+
+    version, changes = second.changes_since(second.parse_cursor(first.cursor()), timeout=0)
+    assert version == 2
+    assert sorted(change['name'] for change in changes) == ['api', 'db']
+    assert all(change['data_changed'] for change in changes)
+
+
+def test_events_poll_returns_snapshot_changes(monkeypatch):
+    """Test that the long-poll endpoint reports changes stored as snapshots."""
+    import app
+
+    monkeypatch.setattr(app, 'start_background_tasks', lambda: None)
+    since = app.event_broker.cursor()
+    app.snapshot_store.put('poll-test', {'name': 'poll-test', 'url': 'http://x.invalid', 'status': 'Connected', 'data': 'text'})
+
+    with app.app.test_client() as client:
+        result = client.get(f'/events/poll?since={since}').get_json()
+
+    assert [event['name'] for event in result['events']] == ['poll-test']
+    assert result['events'][0]['data_changed'] is True
+    assert 'data' not in result['events'][0]
+
+
+def test_asgi_app_serves_upstream_routes_and_falls_back_to_flask(tmp_path, monkeypatch):
+    """Test that the async routes fetch upstreams and other routes reach Flask."""
+    import asyncio
+    import json
+    import httpx
+    import app
+    import asgi
+    from config_store import ConfigStore
+    from werkzeug.wrappers import Response
+
+    server = serve_in_background(Response(json.dumps({'value': 42}), mimetype='application/json'))
+    url = f'http://127.0.0.1:{server.port}/api/data'
+    config_path = tmp_path / 'config.json'
+    config_path.write_text(json.dumps({'services': [{'name': 'api', 'url': url, 'poll_interval': 0}]}))
+    monkeypatch.setattr(app, 'config_store', ConfigStore(str(config_path)))
+
+    async def run():
+        transport = httpx.ASGITransport(app=asgi.application)
+        try:
+            async with httpx.AsyncClient(transport=transport, base_url='http://portal') as client:
+                dashboard = await client.get('/')
+                refreshed = await client.get('/refresh-service-data', params={'name': 'api', 'force': '1'})
+                iframe = await client.get('/iframe/api')
+                iframe_data = await client.get('/iframe/api/data')
+                missing = await client.get('/iframe/unknown')
+                settings = await client.get('/settings')
+                return dashboard, refreshed, iframe, iframe_data, missing, settings
+        finally:
+            await asgi.http.aclose()
+
+    try:
+        dashboard, refreshed, iframe, iframe_data, missing, settings = asyncio.run(run())
+    finally:
+        server.shutdown()
+
+    assert dashboard.status_code == 200
+    assert 'api' in dashboard.text
+    assert refreshed.json()['status'] == 'Connected'
+    assert refreshed.json()['data'] == {'value': 42}
+    assert iframe.status_code == 200
+    assert '/iframe/api/data' in iframe.text
+    assert iframe_data.json() == {'value': 42}
+    assert missing.status_code == 404
+    assert settings.status_code == 200
+
+
+def test_circuit_breaker_opens_half_opens_and_closes():
+    """Test the breaker state transitions and the growing open period."""
+    from breaker import CircuitBreaker, CircuitOpen
+
+    now = [0.0]
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10, max_reset_timeout=15, clock=lambda: now[0])
+
+    breaker.record_failure('timed out', 5.0)
+    breaker.allow()
+    breaker.record_failure('timed out', 5.0)
+    assert breaker.state == 'open'
+    try:
+        breaker.allow()
+        assert False, 'open circuit allowed a call'
+    except CircuitOpen as e:
+        assert 'timed out' in str(e)
+
+    now[0] = 10.0
+    assert breaker.state == 'half-open'
+    breaker.allow()
+    try:
+        breaker.allow()
+        assert False, 'second trial call allowed'
+    except CircuitOpen:
+        pass
+    breaker.record_failure('timed out', 5.0)
+    now[0] = 20.0
+    assert breaker.state == 'open'
+    now[0] = 25.0
+    assert breaker.state == 'half-open'
+
+    breaker.allow()
+    breaker.record_success(0.1)
+    assert breaker.snapshot()['state'] == 'closed'
+    assert breaker.snapshot()['failures'] == 0
+
+
+def test_dead_service_fails_fast_once_its_circuit_opens(tmp_path, monkeypatch):
+    """Test that an open circuit answers without contacting the upstream."""
+    import json
+    import requests
+    import app
+    from config_store import ConfigStore
+
+    calls = []
+
+    class DeadClient:
+        def get(self, url, **kwargs):
+            calls.append(url)
+            raise requests.exceptions.ConnectTimeout('timed out')
+
+    monkeypatch.setattr(app, 'http_client', DeadClient())
+    service = {'name': 'dead', 'url': 'http://circuit-test.invalid', 'failure_threshold': 2, 'cache_ttl': 0}
+    config_path = tmp_path / 'config.json'
+    config_path.write_text(json.dumps({'services': [service]}))
+    monkeypatch.setattr(app, 'config_store', ConfigStore(str(config_path)))
+
+    for _ in range(4):
+        result = app.fetch_data_from_service(service, force=True)
+
+    assert len(calls) == 2
+    assert result['status'].startswith('Error: timed out (circuit open')
+    assert app.circuit_breakers.states()['http://circuit-test.invalid']['state'] == 'open'
+
+    with app.app.test_client() as client:
+        assert b'Circuit open' in client.get('/settings').data
+
+
+def test_rate_limiter_token_bucket_and_concurrency():
+    """Test that the limiter admits bursts, refills over time and caps concurrent calls."""
+    import threading
+    from ratelimit import RateLimited, RateLimiter
+
+    now = [0.0]
+    limiter = RateLimiter(rate=2, burst=2, clock=lambda: now[0])
+    assert limiter.acquire() is False
+    assert limiter.acquire() is False
+    try:
+        limiter.acquire()
+        assert False, 'empty bucket admitted a call'
+    except RateLimited as e:
+        assert '2 requests/s' in str(e)
+    now[0] = 0.5
+    limiter.acquire()
+    assert limiter.snapshot()['rejected'] == 1
+
+    limiter = RateLimiter(max_concurrent=1, max_wait=5)
+    limiter.acquire()
+    threading.Timer(0.1, limiter.release).start()
+    assert limiter.acquire() is True
+    state = limiter.snapshot()
+    assert state['in_flight'] == 1
+    assert state['deferred'] == 1
+
+
+def test_upstream_policy_is_shared_by_blocking_and_async_callers():
+    """Test that with and async with apply the same admission and breaker bookkeeping."""
+    import asyncio
+    from breaker import BreakerRegistry, CircuitOpen
+    from cache import ResponseCache
+    from http_client import BodyTooLarge
+    from metrics import Metrics
+    from ratelimit import LimiterRegistry, RateLimited
+    from upstream import UpstreamPolicy
+
+    metrics = Metrics()
+    metrics.counter('portal_upstream_errors_total', 'Failed upstream requests')
+    metrics.counter('portal_upstream_throttled_total', 'Upstream requests held back')
+    policy = UpstreamPolicy(
+        BreakerRegistry(), LimiterRegistry(), ResponseCache(max_bytes=1024, sizeof=len), metrics,
+        failure_threshold=2, reset_timeout=60, rate_limit_wait=0, cache_ttl=30
+    )
+    service = {'name': 'api', 'url': 'http://api.invalid', 'max_concurrent': 1}
+
+    with policy.admission(service), policy.attempt(service) as attempt:
+        try:
+            with policy.admission(service):
+                assert False, 'a second concurrent call was admitted'
+        except RateLimited:
+            pass
+        try:
+            with policy.attempt(service):
+                raise BodyTooLarge('too large')
+        except BodyTooLarge:
+            pass
+        attempt.finished(503, status_code=lambda code: code)
+    assert policy.circuit_breaker(service).snapshot()['failures'] == 1
+
+    async def fail():
+        async with policy.admission(service):
+            with policy.attempt(service):
+                raise ConnectionError('refused')
+
+    try:
+        asyncio.run(fail())
+    except ConnectionError:
+        pass
+    try:
+        with policy.attempt(service):
+            assert False, 'an open circuit let a call through'
+    except CircuitOpen:
+        pass
+
+    assert policy.rate_limiter(service).snapshot()['in_flight'] == 0
+    rendered = metrics.render()
+    for line in (
+        'portal_upstream_throttled_total{outcome="rejected",service="api"} 1',
+        'portal_upstream_errors_total{reason="body_too_large",service="api"} 1',
+        'portal_upstream_errors_total{reason="http_503",service="api"} 1',
+        'portal_upstream_errors_total{reason="ConnectionError",service="api"} 1',
+        'portal_upstream_errors_total{reason="circuit_open",service="api"} 1'
+    ):
+        assert line in rendered
+
+
+def test_rate_limited_service_serves_last_good_result(tmp_path, monkeypatch):
+    """Test that a service over its limit isn't contacted and its last response is reused."""
+    import json
+    import app
+    from config_store import ConfigStore
+    from werkzeug.wrappers import Request, Response
+
+    calls = []
+
+    @Request.application
+    def upstream(request):
+        calls.append(request.method)
+        return Response(json.dumps({'calls': len(calls)}), mimetype='application/json')
+
+    server = serve_in_background(upstream)
+    url = f'http://127.0.0.1:{server.port}/limited'
+    service = {'name': 'limited', 'url': url, 'poll_interval': 0, 'rate_limit': 0.01, 'rate_limit_wait': 0}
+    config_path = tmp_path / 'config.json'
+    config_path.write_text(json.dumps({'services': [service]}))
+    monkeypatch.setattr(app, 'config_store', ConfigStore(str(config_path)))
+    try:
+        first = app.fetch_data_from_service(service, force=True)
+        second = app.fetch_data_from_service(service, force=True)
+        assert len(calls) == 1
+        assert second['status'] == 'Connected'
+        assert second['data'] == first['data'] == {'calls': 1}
+
+        # Probes are held back too, with no earlier status there is nothing to show but the limit
+        assert app.probe_service(service)['status'].startswith('Error: Rate limit reached')
+        assert len(calls) == 1
+
+        with app.app.test_client() as client:
+            stats = client.get('/cache-stats').get_json()['rate_limits'][url]
+            assert stats['rejected'] == 2
+            if app.METRICS_ENABLED:
+                assert b'portal_upstream_throttled_total{outcome="rejected",service="limited"}' in client.get('/metrics').data
+    finally:
+        server.shutdown()
+
+
+def test_upstream_revalidation_and_iframe_etags(tmp_path, monkeypatch):
+    """Test that unchanged upstreams answer 304 and browsers can revalidate iframes."""
+    import json
+    import app
+    from config_store import ConfigStore
+    from werkzeug.wrappers import Request, Response
+
+    seen = []
+
+    @Request.application
+    def upstream(request):
+        seen.append(request.headers.get('If-None-Match'))
+        response = Response('<html><body><a href="/x">x</a></body></html>', mimetype='text/html')
+        response.set_etag('v1')
+        return response.make_conditional(request)
+
+    server = serve_in_background(upstream)
+    service = {'name': 'etag', 'url': f'http://127.0.0.1:{server.port}/page', 'poll_interval': 0}
+    config_path = tmp_path / 'config.json'
+    config_path.write_text(json.dumps({'services': [service]}))
+    monkeypatch.setattr(app, 'config_store', ConfigStore(str(config_path)))
+    try:
+        first = app.fetch_data_from_service(service, force=True)
+        second = app.fetch_data_from_service(service, force=True)
+        assert seen == [None, '"v1"']
+        assert second is first
+
+        with app.app.test_client() as client:
+            page = client.get('/iframe/etag')
+            assert page.status_code == 200
+            assert page.headers['Cache-Control'] == 'no-cache'
+            etag = page.headers['ETag']
+
+            revalidated = client.get('/iframe/etag', headers={'If-None-Match': etag})
+            assert revalidated.status_code == 304
+            assert revalidated.data == b''
+    finally:
+        server.shutdown()
+
+
+def test_iframe_pages_are_rendered_once_per_content_and_config(tmp_path, monkeypatch):
+    """Test that the render cache serves repeat hits and follows config changes."""
+    import gzip
+    import json
+    import app
+    from config_store import ConfigStore
+
+    service = {'name': 'rendered', 'url': 'http://rendered.invalid', 'poll_interval': 0}
+    config_path = tmp_path / 'config.json'
+    config_path.write_text(json.dumps({'services': [service]}))
+    store = ConfigStore(str(config_path))
+    monkeypatch.setattr(app, 'config_store', store)
+    # Serve the seeded snapshot as if the poller kept it fresh
+    monkeypatch.setattr(app, 'snapshot_max_age', lambda service: app.SNAPSHOT_MAX_AGE)
+    app.snapshot_store.put('rendered', {
+        'name': 'rendered', 'url': service['url'], 'status': 'Connected',
+        'data': 'line of text\n' * 500, 'content_type': 'text/plain'
+    })
+
+    renders = []
+    render_iframe = app.render_iframe
+    monkeypatch.setattr(app, 'render_iframe', lambda *args: renders.append(args) or render_iframe(*args))
+
+    with app.app.test_client() as client:
+        plain = client.get('/iframe/rendered')
+        compressed = client.get('/iframe/rendered', headers={'Accept-Encoding': 'gzip'})
+        assert len(renders) == 1
+        assert compressed.headers['Content-Encoding'] == 'gzip'
+        assert gzip.decompress(compressed.data) == plain.data
+
+        store.update(lambda config: config.update(url_mappings={'http://a.invalid': 'http://b.invalid'}))
+        changed = client.get('/iframe/rendered')
+        assert len(renders) == 2
+        assert changed.headers['ETag'] != plain.headers['ETag']
+
+
+def test_json_viewer_is_a_shell_around_cached_assets_and_data():
+    """Test that JSON iframes load versioned assets and their data separately."""
+    import gzip
+    import json
+    import re
+    import app
+
+    service = {'name': 'viewer', 'url': 'http://viewer.invalid'}
+    data = {'items': [{'id': i, 'name': f'item {i}'} for i in range(200)]}
+    shell = app.render_iframe('viewer', service, {'status': 'Connected', 'data': data}).get_data(as_text=True)
+    assert 'item 199' not in shell
+
+    with app.app.test_client() as client:
+        for asset in re.findall(r'(?:href|src)="(/assets/[^"]+)"', shell):
+            response = client.get(asset)
+            assert response.status_code == 200
+            assert 'immutable' in response.headers['Cache-Control']
+            response.close()
+        outdated = client.get('/assets/0000/json-viewer.js')
+        assert outdated.headers['Cache-Control'] == 'no-cache'
+        outdated.close()
+        assert client.get('/assets/0000/missing.js').status_code == 404
+
+    with app.app.test_request_context(headers={'Accept-Encoding': 'gzip'}):
+        from flask import request
+        response = app.iframe_data_response(request, {'status': 'Connected', 'data': data})
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert json.loads(gzip.decompress(response.get_data())) == data
+
+    with app.app.test_request_context(headers={'If-None-Match': response.headers['ETag']}):
+        assert app.iframe_data_response(request, {'status': 'Connected', 'data': data}).status_code == 304
+
+
+def test_json_data_endpoint_pages_subtrees_by_pointer():
+    """Test that the viewer can load a large document one page of one node at a time."""
+    import json
+    import app
+
+    data = {'meta': {'a/b': True}, 'rows': [{'id': i} for i in range(250)]}
+    result = {'status': 'Connected', 'data': data}
+
+    def get(query):
+        with app.app.test_request_context(query_string=query):
+            from flask import request
+            response = app.iframe_data_response(request, result)
+            return response.status_code, json.loads(response.get_data())
+
+    status, root = get({'path': ''})
+    assert root['size'] == 2
+    assert [child['key'] for child in root['children']] == ['meta', 'rows']
+    assert 'children' not in root['children'][1]
+
+    status, rows = get({'path': '/rows', 'offset': 200, 'limit': 100})
+    assert rows['size'] == 250
+    assert [child['path'] for child in rows['children']][:2] == ['/rows/200', '/rows/201']
+    assert len(rows['children']) == 50
+
+    status, leaf = get({'path': '/meta/a~1b'})
+    assert leaf == {'path': '/meta/a~1b', 'type': 'boolean', 'value': True}
+
+    status, missing = get({'path': '/rows/999'})
+    assert status == 404
+
+
+def test_event_broker_leaves_large_json_to_the_viewer():
+    """Test that JSON data above the size limit is only flagged as changed."""
+    from events import EventBroker
+
+    broker = EventBroker(max_data_bytes=100)
+    broker.publish({'name': 'small', 'status': 'Connected', 'data': {'value': 1}})
+    broker.publish({'name': 'large', 'status': 'Connected', 'data': {'rows': list(range(100))}})
+
+    _, changes = broker.changes_since(0, timeout=0)
+    events = {change['name']: change for change in changes}
+    assert events['small']['data'] == {'value': 1}
+    assert events['large']['data_changed'] and 'data' not in events['large']
+
+
+def test_text_responses_are_compressed_once_per_body():
+    """Test negotiated compression and reuse of compressed bodies."""
+    import gzip
+    import app
+    from compression import brotli
+
+    app.compressor.cache.clear()
+    with app.app.test_client() as client:
+        plain = client.get('/settings')
+        first = client.get('/settings', headers={'Accept-Encoding': 'gzip'})
+        second = client.get('/settings', headers={'Accept-Encoding': 'gzip'})
+        small = client.get('/cache-stats', headers={'Accept-Encoding': 'gzip'})
+
+        assert 'Content-Encoding' not in plain.headers
+        assert first.headers['Content-Encoding'] == 'gzip'
+        assert 'Accept-Encoding' in first.headers['Vary']
+        assert gzip.decompress(first.data) == gzip.decompress(second.data) == plain.data
+        assert app.compressor.cache.stats()['hits'] == 1
+        assert 'Content-Encoding' not in small.headers
+
+        if brotli:
+            compressed = client.get('/settings', headers={'Accept-Encoding': 'gzip, br'})
+            assert compressed.headers['Content-Encoding'] == 'br'
+            assert brotli.decompress(compressed.data) == plain.data
+
+def test_dashboard_streams_shell_before_probes_finish(tmp_path, monkeypatch):
+    """Test that the dashboard is sent before probes finish and statuses follow as they arrive."""
+    import gzip
+    import json
+    import time
+    import app
+    from config_store import ConfigStore
+
+    def fake_probe(service):
+        if service['name'] == 'slow-stream':
+            time.sleep(0.5)
+            return {'name': service['name'], 'url': service['url'], 'status': 'Error: HTTP 503', 'data': None}
+        return {'name': service['name'], 'url': service['url'], 'status': 'Connected', 'data': None}
+
+    config_path = tmp_path / 'config.json'
+    config_path.write_text(json.dumps({'services': [
+        {'name': 'fast-stream', 'url': 'http://fast.invalid', 'poll_interval': 0},
+        {'name': 'slow-stream', 'url': 'http://slow.invalid', 'poll_interval': 0}
+    ]}))
+    monkeypatch.setattr(app, 'config_store', ConfigStore(str(config_path)))
+    monkeypatch.setattr(app, 'probe_service', fake_probe)
+
+    with app.app.test_client() as client:
+        start = time.monotonic()
+        response = client.get('/', buffered=False)
+        chunks = iter(response.response)
+        shell = next(chunks).decode('utf-8')
+        assert time.monotonic() - start < 0.4
+        assert shell.count('status pending') == 2
+        assert 'applyStatus' not in shell.split('</script>')[-1]
+
+        rest = b''.join(chunks).decode('utf-8')
+        assert rest.index('"fast-stream"') < rest.index('"slow-stream"')
+        assert 'applyStatus({"name": "slow-stream", "status": "Error: HTTP 503"})' in rest
+        assert rest.rstrip().endswith('</html>')
+        response.close()
+
+        compressed = client.get('/', headers={'Accept-Encoding': 'gzip'})
+        assert compressed.headers['Content-Encoding'] == 'gzip'
+        assert b'applyStatus({"name": "fast-stream"' in gzip.decompress(compressed.data)
+
+def test_simulated_upstream_and_benchmark_comparison():
+    """Test the tunable sample service and the benchmark's regression check."""
+    import json
+    import benchmark
+    import external_service
+
+    external_service.reset_stats()
+    with external_service.app.test_client() as client:
+        data = client.get('/api/sim?size=5000')
+        page = client.get('/api/sim?size=2000&format=html')
+        failed = client.get('/api/sim?error_rate=1')
+        dripped = client.get('/api/sim?size=1000&drip=0.05&chunks=5')
+        stats = client.get('/api/stats?reset=1').get_json()
+
+    assert data.mimetype == 'application/json'
+    assert len(json.loads(data.data)['items']) > 0 and len(data.data) >= 5000
+    assert page.mimetype == 'text/html' and len(page.data) >= 2000
+    assert failed.status_code == 503
+    assert dripped.is_streamed and len(json.loads(dripped.data)['items']) > 0
+    assert stats['/api/sim'] == 4
+    assert external_service.request_counts['total'] == 0
+
+    assert benchmark.percentile([5, 1, 4, 2, 3], 50) == 3
+    assert benchmark.percentile(list(range(1, 101)), 99) == 99
+    baseline = {'scenarios': {'iframe': {'p95_ms': 10.0, 'throughput_rps': 500, 'upstream_calls': 6}}}
+    results = {'scenarios': {'iframe': {'p95_ms': 12.0, 'throughput_rps': 300, 'upstream_calls': 12}}}
+    assert benchmark.compare(results, baseline) == [
+        'iframe upstream_calls: 6 -> 12',
+        'iframe throughput_rps: 500 -> 300'
+    ]
+
+def test_metrics_endpoint_and_server_timing(tmp_path, monkeypatch):
+    """Test that request phases are exported at /metrics and reported in Server-Timing."""
+    import json
+    import app
+    from config_store import ConfigStore
+    from metrics import Metrics
+    from werkzeug.wrappers import Response
+
+    server = serve_in_background(Response('<html><body><a href="/x">x</a></body></html>', mimetype='text/html'))
+    url = f'http://127.0.0.1:{server.port}/page'
+    config_path = tmp_path / 'config.json'
+    config_path.write_text(json.dumps({'services': [{'name': 'timed', 'url': url, 'poll_interval': 0}]}))
+    monkeypatch.setattr(app, 'config_store', ConfigStore(str(config_path)))
+    monkeypatch.setattr(app, 'SERVER_TIMING', True)
+    try:
+        with app.app.test_client() as client:
+            page = client.get('/iframe/timed')
+            exported = client.get('/metrics').get_data(as_text=True)
+    finally:
+        server.shutdown()
+
+    timing = page.headers['Server-Timing']
+    for phase in ('config_load', 'upstream_ttfb', 'upstream_download', 'html_parse', 'html_rewrite', 'template_render'):
+        assert f'{phase};dur=' in timing
+    assert 'portal_phase_seconds_count{phase="html_parse",service="timed"} 1' in exported
+    assert 'portal_upstream_body_bytes_bucket{service="timed",le="1024"} 1' in exported
+    assert 'portal_requests_total{method="GET",route="/iframe/<service_name>",status="200"} ' in exported
+    assert '# TYPE portal_upstream_errors_total counter' in exported
+
+    disabled = Metrics(enabled=False)
+    disabled.histogram('portal_phase_seconds', 'Phases')
+    with disabled.phase('config_load'):
+        pass
+    disabled.start_request()
+    assert disabled.phase('a') is disabled.phase('b')
+    assert disabled.server_timing() is None
+    assert 'portal_phase_seconds_count' not in disabled.render()
+
+def test_sqlite_snapshots_are_shared_between_processes_and_restarts(tmp_path):
+    """Test that stores on one database file see each other's snapshots and skip fresh polls."""
+    import time
+    from scheduler import PollScheduler, SqliteSnapshotStore
+
+    path = str(tmp_path / 'snapshots.db')
+    published = []
+    first = SqliteSnapshotStore(path)
+    second = SqliteSnapshotStore(path, on_put=published.append)
+    result = {'name': 'shared', 'url': 'http://shared.invalid', 'status': 'Connected',
+              'data': {'value': 1}, 'data_hash': 'abc'}
+
+    assert second.get('shared') is None
+    first.put('shared', result)
+    assert second.get('shared', url='http://shared.invalid')['result'] == result
+    assert published == [result]
+    # Only a newer snapshot is loaded again
+    second.get('shared')
+    assert len(published) == 1
+
+    updated = dict(result, data={'value': 2}, data_hash='def')
+    first.put('shared', updated)
+    assert second.get('shared')['result']['data'] == {'value': 2}
+
+    restarted = SqliteSnapshotStore(path)
+    assert restarted.get('shared', max_age=60)['result'] == updated
+    assert restarted.names() == ['shared']
+
+    polls = []
+    scheduler = PollScheduler(
+        services=lambda: [{'name': 'shared', 'url': 'http://shared.invalid', 'poll_interval': 60}],
+        poll=lambda service: polls.append(service) or result,
+        store=restarted,
+        jitter=0
+    )
+    scheduler.start()
+    try:
+        time.sleep(0.3)
+    finally:
+        scheduler.stop()
+    assert polls == []
+
+    first.remove('shared')
+    assert SqliteSnapshotStore(path).get('shared') is None
+
+def test_bulk_import_and_batch_connection_test(tmp_path, monkeypatch):
+    """Test that imports are validated as a whole and batch tests stream one line per URL."""
+    import asyncio
+    import io
+    import json
+    import httpx
+    import app
+    import asgi
+    from config_store import ConfigStore
+    from werkzeug.wrappers import Response
+
+    server = serve_in_background(Response('{}', mimetype='application/json'))
+    url = f'http://127.0.0.1:{server.port}/api'
+    config_path = tmp_path / 'config.json'
+    config_path.write_text(json.dumps({'services': [{'name': 'existing', 'url': 'http://old.invalid'}]}))
+    monkeypatch.setattr(app, 'config_store', ConfigStore(str(config_path)))
+
+    try:
+        with app.app.test_client() as client:
+            invalid = client.post('/import-services', json=[
+                {'name': 'ok', 'url': url},
+                {'name': 'no-scheme', 'url': 'example.com'},
+                {'name': 'ok', 'url': url, 'timeout': 'soon'}
+            ])
+            assert invalid.status_code == 400
+            assert [e['entry'] for e in invalid.get_json()['errors']] == [2, 3]
+            assert [s['name'] for s in json.loads(config_path.read_text())['services']] == ['existing']
+
+            csv_file = f'name,url,timeout,poll_interval\napi,{url},2,\nexisting,{url},,0\n'
+            imported = client.post('/import-services', data={
+                'file': (io.BytesIO(csv_file.encode('utf-8')), 'services.csv')
+            }, content_type='multipart/form-data')
+            assert imported.get_json() == {'status': 'Imported', 'added': ['api'], 'updated': [], 'skipped': ['existing']}
+
+            polled_soon = []
+            monkeypatch.setattr(app.scheduler, 'poll_soon', polled_soon.append)
+            replaced = client.post('/import-services?replace=1', json={'services': [{'name': 'existing', 'url': url}]})
+            assert replaced.get_json()['updated'] == ['existing']
+            assert polled_soon == ['existing']
+            assert json.loads(config_path.read_text())['services'] == [
+                {'name': 'existing', 'url': url},
+                {'name': 'api', 'url': url, 'timeout': 2}
+            ]
+
+            streamed = client.post('/test-connections', json={'urls': [url, 'http://127.0.0.1:1/down']})
+            lines = [json.loads(line) for line in streamed.get_data(as_text=True).splitlines()]
+            assert streamed.mimetype == 'application/x-ndjson'
+            assert {line['url']: line['status'] for line in lines} == {url: 'Connected', 'http://127.0.0.1:1/down': 'Error'}
+            assert client.post('/test-connections', json={'urls': []}).status_code == 400
+
+        async def run():
+            transport = httpx.ASGITransport(app=asgi.application)
+            try:
+                async with httpx.AsyncClient(transport=transport, base_url='http://portal') as client:
+                    return await client.post('/test-connections')
+            finally:
+                await asgi.http.aclose()
+
+        configured = asyncio.run(run())
+    finally:
+        server.shutdown()
+
+    results = [json.loads(line) for line in configured.text.splitlines()]
+    assert sorted(result['name'] for result in results) == ['api', 'existing']
+    assert all(result['status'] == 'Connected' and 'elapsed_ms' in result for result in results)
+
+
+def test_card_actions_are_batched_and_logged_in_background(tmp_path, monkeypatch):
+    """Test that batched card actions are checked one by one and their logs written in bulk."""
+    import json
+    import app
+    from card_actions import ActionLog
+    from config_store import ConfigStore
+
+    config_path = tmp_path / 'config.json'
+    config_path.write_text(json.dumps({'services': [{'name': 'My App', 'url': 'http://my-app.invalid'}]}))
+    monkeypatch.setattr(app, 'config_store', ConfigStore(str(config_path)))
+    log_path = tmp_path / 'actions.log'
+    action_log = ActionLog(path=str(log_path))
+    monkeypatch.setattr(app, 'action_log', action_log)
+
+    actions = [
+        {'serviceId': 'my_app', 'action': 'log', 'data': {'message': 'first'}},
+        {'serviceId': 'unknown', 'action': 'log', 'data': {'message': 'lost'}},
+        {'serviceId': 'my_app', 'action': 'click'},
+        {'serviceId': 'my_app', 'action': 'log', 'data': {'message': 'second'}}
+    ]
+    with app.app.test_client() as client:
+        # Beacons are sent as a plain text body
+        response = client.post('/card-actions', data=json.dumps(actions), content_type='text/plain')
+        assert response.get_json() == {'processed': 3, 'errors': [{'index': 1, 'error': 'Service not found'}]}
+
+        single = client.post('/card-action', json={'serviceId': 'my_app', 'action': 'log', 'data': {'message': 'third'}})
+        assert single.get_json()['success'] is True
+
+        assert client.post('/card-actions', json={'actions': 'nope'}).status_code == 400
+        assert client.post('/card-actions', json=[{}] * (app.CARD_ACTIONS_MAX_BATCH + 1)).status_code == 413
+
+        assert action_log.flush(timeout=5)
+        assert log_path.read_text().splitlines() == [
+            'Log from My App: first', 'Log from My App: second', 'Log from My App: third'
+        ]
+        stats = client.get('/cache-stats').get_json()['card_action_log']
+        assert stats['written'] == 3
+        assert stats['dropped'] == 0
+    action_log.close()
+
+
+def test_snapshots_are_skipped_for_unpolled_services(tmp_path, monkeypatch):
+    """Test that a service's cache_ttl applies when no poller keeps its snapshot fresh."""
+    import json
+    import time
+    import app
+    from config_store import ConfigStore
+    from werkzeug.wrappers import Request, Response
+
+    calls = []
+
+    @Request.application
+    def upstream(request):
+        calls.append(request.path)
+        return Response(f'version {len(calls)}', mimetype='text/plain')
+
+    server = serve_in_background(upstream)
+    service = {'name': 'unpolled', 'url': f'http://127.0.0.1:{server.port}/v', 'poll_interval': 0, 'cache_ttl': 1}
+    config_path = tmp_path / 'config.json'
+    config_path.write_text(json.dumps({'services': [service]}))
+    monkeypatch.setattr(app, 'config_store', ConfigStore(str(config_path)))
+    try:
+        assert app.latest_service_data(service)['data'] == 'version 1'
+        time.sleep(1.1)
+        with app.app.test_client() as client:
+            # The expired response is refreshed in the background, not held by the snapshot
+            client.get('/refresh-service-data?name=unpolled')
+            for _ in range(50):
+                if client.get('/refresh-service-data?name=unpolled').get_json()['data'] == 'version 2':
+                    break
+                time.sleep(0.05)
+            assert len(calls) == 2
+        assert app.snapshot_max_age(dict(service, poll_interval=30)) is None  # scheduler not running
+    finally:
+        server.shutdown()
+
+
+def test_proxy_mode_iframes_go_through_the_circuit_breaker(tmp_path, monkeypatch):
+    """Test that a dead proxy-mode service fails fast in both apps once its circuit opens."""
+    import asyncio
+    import json
+    import socket
+    import httpx
+    import app
+    import asgi
+    from config_store import ConfigStore
+
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    services = [
+        {'name': 'proxied', 'url': f'http://127.0.0.1:{port}/sync', 'mode': 'proxy', 'failure_threshold': 2},
+        {'name': 'proxied-async', 'url': f'http://127.0.0.1:{port}/async', 'mode': 'proxy', 'failure_threshold': 2}
+    ]
+    config_path = tmp_path / 'config.json'
+    config_path.write_text(json.dumps({'services': services}))
+    monkeypatch.setattr(app, 'config_store', ConfigStore(str(config_path)))
+
+    with app.app.test_client() as client:
+        responses = [client.get('/iframe/proxied') for _ in range(3)]
+    assert [response.status_code for response in responses] == [502, 502, 502]
+    assert b'circuit open' in responses[2].data
+
+    async def run():
+        transport = httpx.ASGITransport(app=asgi.application)
+        try:
+            async with httpx.AsyncClient(transport=transport, base_url='http://portal') as client:
+                return [await client.get('/iframe/proxied-async') for _ in range(3)]
+        finally:
+            await asgi.http.aclose()
+
+    responses = asyncio.run(run())
+    assert [response.status_code for response in responses] == [502, 502, 502]
+    assert 'circuit open' in responses[2].text
+    assert app.circuit_breakers.states()[services[1]['url']]['state'] == 'open'
+
+
+def test_malformed_json_becomes_an_error_for_that_card(tmp_path, monkeypatch):
+    """Test that a body declared as JSON but not parseable doesn't fail the page."""
+    import json
+    import app
+    from config_store import ConfigStore
+    from werkzeug.wrappers import Response
+
+    server = serve_in_background(Response('{"broken": ', mimetype='application/json'))
+    service = {'name': 'broken', 'url': f'http://127.0.0.1:{server.port}/api', 'poll_interval': 0}
+    config_path = tmp_path / 'config.json'
+    config_path.write_text(json.dumps({'services': [service]}))
+    monkeypatch.setattr(app, 'config_store', ConfigStore(str(config_path)))
+    try:
+        result = app.fetch_data_from_service(service, force=True)
+        assert result['status'].startswith('Error: Invalid JSON')
+        assert result['data'] is None
+
+        with app.app.test_client() as client:
+            refreshed = client.get('/refresh-service-data?name=broken&force=1')
+            assert refreshed.status_code == 200
+            assert refreshed.get_json()['status'].startswith('Error: Invalid JSON')
+            # The iframe shows the error like for any other failing service
+            assert b'Invalid JSON' in client.get('/iframe/broken').data
+    finally:
+        server.shutdown()
@@ -0,0 +1,227 @@
+import time
+
+from breaker import CircuitOpen
+from http_client import BodyTooLarge
+from ratelimit import RateLimited
+
+
+def is_upstream_failure(status_code):
+    """Return whether an HTTP status means the upstream itself is failing."""
+    return status_code >= 500
+
+
+class Admission:
+    """A request's turn at its service's rate limiter.
+
+    Use it with `with` or `async with` around the request, or call
+    acquire() or acquire_async() and later release() when the slot has to
+    outlive a block, e.g. while a proxied body is streamed.
+    """
+
+    def __init__(self, limiter, metrics, service_name):
+        self.limiter = limiter
+        self._metrics = metrics
+        self._service_name = service_name
+
+    def acquire(self):
+        """Wait for the limiter, blocking the thread.
+
+        Raises:
+            RateLimited: The request was not admitted in time
+        """
+        try:
+            waited = self.limiter.acquire()
+        except RateLimited:
+            self._count('rejected')
+            raise
+        if waited:
+            self._count('deferred')
+        return self
+
+    async def acquire_async(self):
+        """Wait for the limiter without blocking the event loop, see acquire()."""
+        try:
+            waited = await self.limiter.acquire_async()
+        except RateLimited:
+            self._count('rejected')
+            raise
+        if waited:
+            self._count('deferred')
+        return self
+
+    def release(self):
+        """Free the slot once the request is done."""
+        self.limiter.release()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+        return False
+
+    async def __aenter__(self):
+        return await self.acquire_async()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.release()
+        return False
+
+    def _count(self, outcome):
+        self._metrics.inc('portal_upstream_throttled_total', service=self._service_name, outcome=outcome)
+
+
+class Attempt:
+    """One call to an upstream, as seen by its circuit breaker.
+
+    Entering the block raises CircuitOpen if the breaker refuses calls. An
+    exception leaving the block is recorded as a failure, except BodyTooLarge
+    since the upstream did answer. A result is recorded with finished().
+    """
+
+    def __init__(self, breaker, metrics, service_name):
+        self.breaker = breaker
+        self._metrics = metrics
+        self._service_name = service_name
+        self._started = None
+
+    def __enter__(self):
+        try:
+            self.breaker.allow()
+        except CircuitOpen:
+            self._count('circuit_open')
+            raise
+        self._started = time.monotonic()
+        return self
+
+    def finished(self, result, status_code=lambda result: result.status_code):
+        """Record the HTTP status of a result and return the result."""
+        code = status_code(result)
+        if is_upstream_failure(code):
+            self.breaker.record_failure(f'HTTP {code}', self._elapsed())
+            self._count(f'http_{code}')
+        else:
+            self.breaker.record_success(self._elapsed())
+        return result
+
+    def __exit__(self, exc_type, exc, tb):
+        if isinstance(exc, BodyTooLarge):
+            # The upstream answered, the body is just larger than we accept
+            self.breaker.record_success(self._elapsed())
+            self._count('body_too_large')
+        elif isinstance(exc, Exception):
+            self.breaker.record_failure(exc, self._elapsed())
+            self._count(type(exc).__name__)
+        return False
+
+    def _elapsed(self):
+        return time.monotonic() - self._started
+
+    def _count(self, reason):
+        self._metrics.inc('portal_upstream_errors_total', service=self._service_name, reason=reason)
+
+
+class UpstreamPolicy:
+    """What happens around every request to an upstream, whichever client sends it.
+
+    app.py talks to upstreams through a blocking HttpClient and asgi.py
+    through an AsyncHttpClient. Only that transport differs between them:
+    admission by the rate limiter, circuit breaking, conditional requests
+    and the response cache all go through here.
+    """
+
+    def __init__(self, circuit_breakers, rate_limiters, response_cache, metrics,
+                 failure_threshold, reset_timeout, rate_limit_wait, cache_ttl):
+        """Create a policy.
+
+        Args:
+            circuit_breakers (BreakerRegistry): Breakers keyed by service URL
+            rate_limiters (LimiterRegistry): Limiters keyed by service URL
+            response_cache (ResponseCache): Upstream responses keyed by service URL
+            metrics (Metrics): Where throttling and errors are counted
+            failure_threshold (int): Default of the "failure_threshold" service setting
+            reset_timeout (float): Default of the "circuit_reset" service setting
+            rate_limit_wait (float): Default of the "rate_limit_wait" service setting
+            cache_ttl (float): Default of the "cache_ttl" service setting
+        """
+        self.circuit_breakers = circuit_breakers
+        self.rate_limiters = rate_limiters
+        self.response_cache = response_cache
+        self.metrics = metrics
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.rate_limit_wait = rate_limit_wait
+        self.cache_ttl = cache_ttl
+
+    def circuit_breaker(self, service):
+        """Return the circuit breaker of a service, with its configured settings."""
+        return self.circuit_breakers.get(
+            service['url'],
+            failure_threshold=service.get('failure_threshold', self.failure_threshold),
+            reset_timeout=service.get('circuit_reset', self.reset_timeout)
+        )
+
+    def rate_limiter(self, service):
+        """Return the rate limiter of a service, with its configured limits."""
+        return self.rate_limiters.get(
+            service['url'],
+            rate=service.get('rate_limit'),
+            burst=service.get('rate_burst'),
+            max_concurrent=service.get('max_concurrent'),
+            max_wait=service.get('rate_limit_wait', self.rate_limit_wait)
+        )
+
+    def admission(self, service):
+        """Return the Admission a request to a service has to pass first."""
+        return Admission(self.rate_limiter(service), self.metrics, service['name'])
+
+    def attempt(self, service):
+        """Return the Attempt recording an admitted call to a service with its breaker."""
+        return Attempt(self.circuit_breaker(service), self.metrics, service['name'])
+
+    def conditional_headers(self, previous):
+        """Return the headers revalidating a previously fetched UpstreamResponse."""
+        headers = {}
+        if previous is not None:
+            if previous.headers.get('etag'):
+                headers['If-None-Match'] = previous.headers['etag']
+            if previous.headers.get('last-modified'):
+                headers['If-Modified-Since'] = previous.headers['last-modified']
+        return headers
+
+    def not_modified(self, previous, status_code):
+        """Return whether a revalidation answer means previous can be used as is."""
+        return status_code == 304 and previous is not None
+
+    def cache_ttl_of(self, service):
+        """Return the seconds a response of a service is served from the cache."""
+        return service.get('cache_ttl', self.cache_ttl)
+
+    def cached_response(self, service, force=False):
+        """Look up the cached response of a service, see ResponseCache.lookup()."""
+        return self.response_cache.lookup(service['url'], force=force)
+
+    def previous_response(self, service):
+        """Return the last response of a service, even an expired one, to revalidate it."""
+        return self.response_cache.peek(service['url'])
+
+    def store_response(self, service, response):
+        """Cache a fresh response of a service."""
+        self.response_cache.put(service['url'], response, self.cache_ttl_of(service))
+
+    def refresh_done(self, service, error=None):
+        """Mark the background refresh of a service's cached response as finished."""
+        if error:
+            print(f"Error refreshing cache entry {service['url']}: {error}")
+        self.response_cache.refresh_done(service['url'], error)
+
+    def last_good_response(self, service):
+        """Return the last cached response of a rate limited service, whatever its age.
+
+        Raises:
+            RateLimited: Nothing was cached for the service yet
+        """
+        previous = self.previous_response(service)
+        if previous is None:
+            raise RateLimited(f"{service['name']} is over its rate limit and has no earlier response")
+        return previous